@@ -0,0 +1,192 @@
+"""内容寻址的文件内容存储模块
+
+sync_context 上传的文件内容按 SHA-256 去重、zlib 压缩后存放，
+历史记录里只保存引用（"sha256:<hex>"），需要发送时再按需读取。
+同一个文件在多轮、多个会话中同步，只会占用一份存储。
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from .config import get_server_config
+
+logger = logging.getLogger(__name__)
+
+# 引用前缀
+BLOB_REF_PREFIX = "sha256:"
+
+# 存储目录名（位于历史文件所在目录下）
+BLOB_DIR_NAME = "blobs"
+
+# 压缩级别：文本压缩率与速度的折中
+BLOB_COMPRESS_LEVEL = 6
+
+# 垃圾回收宽限期（秒）：新写入或刚被复用的 blob 不会被回收，
+# 避免另一个进程刚写入 blob、还没来得及追加历史记录就被删掉
+BLOB_GC_GRACE_SECONDS = 3600
+
+
+def is_blob_ref(value: object) -> bool:
+    """判断一个值是否是 blob 引用。"""
+    return isinstance(value, str) and value.startswith(BLOB_REF_PREFIX)
+
+
+class BlobStore:
+    """
+    内容寻址的文本存储。
+
+    root 为 None 时只在内存中保存（未启用持久化时使用）；
+    否则写入 root/<前两位>/<哈希>.z，写入过程先写临时文件再原子替换。
+    """
+
+    def __init__(self, root: Path | None):
+        self.root = root
+        self._memory: dict[str, tuple[bytes, float]] = {}
+        self._lock = threading.Lock()
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / f"{digest}.z"
+
+    def put(self, text: str) -> str:
+        """保存文本并返回引用；内容已存在时只刷新其时间戳。"""
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        ref = BLOB_REF_PREFIX + digest
+
+        if self.root is None:
+            with self._lock:
+                existing = self._memory.get(digest)
+                payload = existing[0] if existing else zlib.compress(data, BLOB_COMPRESS_LEVEL)
+                self._memory[digest] = (payload, time.time())
+            return ref
+
+        blob_path = self._blob_path(digest)
+        if blob_path.exists():
+            try:
+                os.utime(blob_path)
+            except OSError:
+                logger.debug("刷新 blob 时间戳失败: %s", blob_path, exc_info=True)
+            return ref
+
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path: Path | None = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                mode="wb",
+                dir=blob_path.parent,
+                prefix=f".{digest[:8]}.",
+                suffix=".tmp",
+                delete=False,
+            ) as temp_file:
+                temp_file.write(zlib.compress(data, BLOB_COMPRESS_LEVEL))
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+                temp_path = Path(temp_file.name)
+
+            os.replace(temp_path, blob_path)
+        finally:
+            if temp_path and temp_path.exists():
+                try:
+                    temp_path.unlink()
+                except OSError:
+                    logger.warning("清理 blob 临时文件失败: %s", temp_path, exc_info=True)
+
+        logger.debug("已写入 blob %s (%s 字节)", digest[:12], len(data))
+        return ref
+
+    def get(self, ref: str) -> str | None:
+        """按引用读取文本；不存在或已损坏时返回 None。"""
+        if not is_blob_ref(ref):
+            return None
+
+        digest = ref[len(BLOB_REF_PREFIX):]
+        try:
+            if self.root is None:
+                with self._lock:
+                    stored = self._memory.get(digest)
+                if stored is None:
+                    return None
+                payload = stored[0]
+            else:
+                payload = self._blob_path(digest).read_bytes()
+            return zlib.decompress(payload).decode("utf-8")
+        except FileNotFoundError:
+            return None
+        except (OSError, zlib.error, UnicodeDecodeError):
+            logger.warning("读取 blob 失败: %s", ref, exc_info=True)
+            return None
+
+    def collect_garbage(self, live_refs: set[str], now: float | None = None) -> int:
+        """
+        删除未被引用且超过宽限期的 blob。
+
+        Returns:
+            删除的 blob 数量
+        """
+        current_time = now if now is not None else time.time()
+        live_digests = {
+            ref[len(BLOB_REF_PREFIX):] for ref in live_refs if is_blob_ref(ref)
+        }
+        removed = 0
+
+        if self.root is None:
+            with self._lock:
+                for digest, (_, touched_at) in list(self._memory.items()):
+                    if digest in live_digests or current_time - touched_at < BLOB_GC_GRACE_SECONDS:
+                        continue
+                    del self._memory[digest]
+                    removed += 1
+            return removed
+
+        if not self.root.exists():
+            return 0
+
+        for blob_path in self.root.glob("*/*.z"):
+            digest = blob_path.stem
+            if digest in live_digests:
+                continue
+            try:
+                if current_time - blob_path.stat().st_mtime < BLOB_GC_GRACE_SECONDS:
+                    continue
+                blob_path.unlink()
+                removed += 1
+            except FileNotFoundError:
+                continue
+            except OSError:
+                logger.warning("删除 blob 失败: %s", blob_path, exc_info=True)
+
+        if removed:
+            logger.info("blob 垃圾回收完成，删除 %s 个未引用的文件内容", removed)
+        return removed
+
+
+# 全局存储实例
+_blob_store: BlobStore | None = None
+
+
+def _configured_blob_root() -> Path | None:
+    server_config = get_server_config()
+    if not server_config.enable_persistence:
+        return None
+    return Path(server_config.history_path).parent / BLOB_DIR_NAME
+
+
+def get_blob_store() -> BlobStore:
+    """获取 blob 存储实例；历史路径或持久化开关变化时重新创建。"""
+    global _blob_store
+    root = _configured_blob_root()
+    if _blob_store is None or _blob_store.root != root:
+        _blob_store = BlobStore(root)
+    return _blob_store
+
+
+def reset_blob_store():
+    """重置 blob 存储（主要用于测试）"""
+    global _blob_store
+    _blob_store = None
@@ -0,0 +1,334 @@
+"""token 估算自校准模块
+
+estimate_tokens 用固定比例（中文 1.5 字符/token、其他 4 字符/token）估算，
+不同模型的分词器差异很大，预算要么浪费上下文窗口、要么溢出。
+这里把估算拆成中文 / 英文 / 代码三部分，用服务商返回的 usage.prompt_tokens
+为每个模型在线拟合三个修正系数，并持久化到历史目录，重启后继续生效。
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from .config import get_server_config
+from .utils import count_chinese_chars, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 估算特征：(中文部分, 英文部分, 代码部分)，单位为未校准的估算 tokens
+TokenFeatures = tuple[float, float, float]
+
+# 持久化文件名（位于历史文件所在目录下）
+CALIBRATION_FILE_NAME = "token_calibration.json"
+
+# 这些符号在非中文字符中的占比达到阈值时，按代码计
+CODE_SYMBOLS = "{}()[];=<>_/\\*&|#$"
+CODE_SYMBOL_RATIO = 0.06
+
+# 每条消息除角色外的固定协议开销
+MESSAGE_OVERHEAD_TOKENS = 6
+
+# 遗忘因子：越小越快适应模型或网关的变化
+CALIBRATION_DECAY = 0.98
+
+# 先验强度：样本少时系数向 1.0 收缩，避免一两次调用就大幅偏移
+CALIBRATION_PRIOR_WEIGHT = 0.3
+
+# 系数的取值范围
+CALIBRATION_FACTOR_MIN = 0.25
+CALIBRATION_FACTOR_MAX = 4.0
+
+# 误差统计的滑动平均权重
+CALIBRATION_ERROR_SMOOTHING = 0.1
+
+# 系数相对上次生效值的变化超过该比例才生效（并使缓存的历史分组重算 token 数）
+CALIBRATION_VERSION_THRESHOLD = 0.02
+
+# 持久化节流：累计这么多次观测或距上次写盘超过这么多秒才写一次（退出时补写）
+CALIBRATION_SAVE_EVERY = 20
+CALIBRATION_SAVE_INTERVAL_SECONDS = 60.0
+
+IDENTITY_FACTORS: TokenFeatures = (1.0, 1.0, 1.0)
+
+
+def text_features(text: str) -> TokenFeatures:
+    """把一段文本的估算 tokens 拆为中文 / 英文 / 代码三部分。"""
+    if not text:
+        return 0.0, 0.0, 0.0
+
+    chinese_chars = count_chinese_chars(text)
+    other_chars = len(text) - chinese_chars
+    chinese_part = chinese_chars / 1.5
+    other_part = other_chars / 4
+    if other_chars and sum(text.count(symbol) for symbol in CODE_SYMBOLS) >= other_chars * CODE_SYMBOL_RATIO:
+        return chinese_part, 0.0, other_part
+    return chinese_part, other_part, 0.0
+
+
+def message_overhead(message: dict[str, str]) -> int:
+    """单条消息的角色与协议开销（按英文部分校准）。"""
+    return estimate_tokens(message.get("role", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def prompt_features(messages: list[dict[str, str]]) -> TokenFeatures:
+    """整个请求的估算特征，消息开销计入英文部分。"""
+    chinese_part = latin_part = code_part = 0.0
+    for message in messages:
+        features = text_features(message.get("content", ""))
+        chinese_part += features[0]
+        latin_part += features[1] + message_overhead(message)
+        code_part += features[2]
+    return chinese_part, latin_part, code_part
+
+
+def _solve_3x3(matrix: list[list[float]], vector: list[float]) -> list[float] | None:
+    """高斯消元求解 3x3 线性方程组；奇异时返回 None。"""
+    rows = [list(matrix[i]) + [vector[i]] for i in range(3)]
+    for column in range(3):
+        pivot = max(range(column, 3), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(3):
+            if row == column:
+                continue
+            ratio = rows[row][column] / rows[column][column]
+            for k in range(column, 4):
+                rows[row][k] -= ratio * rows[column][k]
+    return [rows[i][3] / rows[i][i] for i in range(3)]
+
+
+class ModelCalibration:
+    """
+    单个模型的在线拟合状态。
+
+    以各部分占估算总量的比例为特征、实际/估算为目标，做带遗忘因子的岭回归，
+    先验为三个系数都等于 1（即与未校准的估算一致）。
+    """
+
+    def __init__(self, data: dict | None = None):
+        data = data or {}
+        self.gram = data.get("gram") or [[0.0] * 3 for _ in range(3)]
+        self.moment = data.get("moment") or [0.0] * 3
+        self.factors: TokenFeatures = tuple(data.get("factors") or IDENTITY_FACTORS)
+        self.samples = int(data.get("samples", 0))
+        self.raw_error_pct = data.get("raw_error_pct")
+        self.calibrated_error_pct = data.get("calibrated_error_pct")
+        self.last_error_pct = data.get("last_error_pct")
+
+    def estimate(self, features: TokenFeatures) -> float:
+        return sum(factor * value for factor, value in zip(self.factors, features))
+
+    def observe(self, features: TokenFeatures, actual_tokens: int):
+        raw_estimate = sum(features)
+        if raw_estimate <= 0 or actual_tokens <= 0:
+            return
+
+        # 先用旧系数评估误差（样本外），再纳入本次样本
+        raw_error = abs(raw_estimate - actual_tokens) / actual_tokens * 100
+        calibrated_error = abs(self.estimate(features) - actual_tokens) / actual_tokens * 100
+        self.raw_error_pct = self._smooth(self.raw_error_pct, raw_error)
+        self.calibrated_error_pct = self._smooth(self.calibrated_error_pct, calibrated_error)
+        self.last_error_pct = round(calibrated_error, 2)
+
+        shares = [value / raw_estimate for value in features]
+        target = actual_tokens / raw_estimate
+        for i in range(3):
+            self.moment[i] = self.moment[i] * CALIBRATION_DECAY + shares[i] * target
+            for j in range(3):
+                self.gram[i][j] = self.gram[i][j] * CALIBRATION_DECAY + shares[i] * shares[j]
+        self.samples += 1
+
+        matrix = [
+            [self.gram[i][j] + (CALIBRATION_PRIOR_WEIGHT if i == j else 0.0) for j in range(3)]
+            for i in range(3)
+        ]
+        vector = [self.moment[i] + CALIBRATION_PRIOR_WEIGHT * IDENTITY_FACTORS[i] for i in range(3)]
+        solution = _solve_3x3(matrix, vector)
+        if solution is not None:
+            self.factors = tuple(
+                min(max(value, CALIBRATION_FACTOR_MIN), CALIBRATION_FACTOR_MAX) for value in solution
+            )
+
+    @staticmethod
+    def _smooth(previous: float | None, value: float) -> float:
+        if previous is None:
+            return round(value, 2)
+        return round(previous + (value - previous) * CALIBRATION_ERROR_SMOOTHING, 2)
+
+    def to_dict(self) -> dict:
+        return {
+            "gram": self.gram,
+            "moment": self.moment,
+            "factors": list(self.factors),
+            "samples": self.samples,
+            "raw_error_pct": self.raw_error_pct,
+            "calibrated_error_pct": self.calibrated_error_pct,
+            "last_error_pct": self.last_error_pct,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "factors": {
+                "chinese": round(self.factors[0], 3),
+                "latin": round(self.factors[1], 3),
+                "code": round(self.factors[2], 3),
+            },
+            "raw_error_pct": self.raw_error_pct,
+            "calibrated_error_pct": self.calibrated_error_pct,
+            "last_error_pct": self.last_error_pct,
+        }
+
+
+class TokenCalibrator:
+    """
+    按模型保存修正系数。
+
+    path 为 None 时只在内存中保存（未启用持久化时使用）。
+    拟合出的系数相对生效值变化超过 CALIBRATION_VERSION_THRESHOLD 时才生效，同时递增 version，
+    供消息分组缓存判断 token 数是否需要重算；写盘按 CALIBRATION_SAVE_EVERY /
+    CALIBRATION_SAVE_INTERVAL_SECONDS 节流，退出前调用 flush 补写。
+    """
+
+    def __init__(self, path: Path | None):
+        self.path = path
+        self.version = 0
+        self._models: dict[str, ModelCalibration] = {}
+        self._active: dict[str, TokenFeatures] = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._saved_at = time.monotonic()
+        self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            for model, state in (data.get("models") or {}).items():
+                self._models[model] = ModelCalibration(state)
+                self._active[model] = self._models[model].factors
+        except (OSError, ValueError, TypeError):
+            logger.warning("读取 token 校准数据失败，将重新校准: %s", self.path, exc_info=True)
+            self._models = {}
+            self._active = {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        payload = json.dumps(
+            {"models": {model: state.to_dict() for model, state in self._models.items()}},
+            ensure_ascii=False,
+        )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path: Path | None = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=self.path.parent,
+                prefix=f".{self.path.stem}.",
+                suffix=".tmp",
+                delete=False,
+            ) as temp_file:
+                temp_file.write(payload)
+                temp_path = Path(temp_file.name)
+            os.replace(temp_path, self.path)
+        except OSError:
+            logger.warning("保存 token 校准数据失败: %s", self.path, exc_info=True)
+        finally:
+            if temp_path and temp_path.exists():
+                try:
+                    temp_path.unlink()
+                except OSError:
+                    pass
+
+    def factors(self, model: str | None) -> TokenFeatures:
+        """当前生效的修正系数（未校准时为 1）。"""
+        return self._active.get(model or "", IDENTITY_FACTORS)
+
+    def estimate_message(self, features: TokenFeatures, overhead: int, model: str | None) -> int:
+        """
+        按模型的修正系数估算单条消息的 tokens。
+
+        features 为消息内容的估算特征，overhead 为角色与协议开销；
+        尚未校准时结果与 estimate_tokens(content) + overhead 完全一致。
+        """
+        factors = self.factors(model)
+        if factors == IDENTITY_FACTORS:
+            return int(features[0] + features[1] + features[2]) + overhead
+        content_tokens = factors[0] * features[0] + factors[1] * features[1] + factors[2] * features[2]
+        return int(content_tokens) + int(factors[1] * overhead)
+
+    def observe(self, model: str, features: TokenFeatures, actual_prompt_tokens: int | None):
+        """记录一次调用的估算特征与服务商报告的实际输入 tokens，并更新系数。"""
+        if not model or not actual_prompt_tokens:
+            return
+        with self._lock:
+            state = self._models.setdefault(model, ModelCalibration())
+            state.observe(features, actual_prompt_tokens)
+            active = self._active.get(model, IDENTITY_FACTORS)
+            if any(
+                abs(fitted - current) > current * CALIBRATION_VERSION_THRESHOLD
+                for fitted, current in zip(state.factors, active)
+            ):
+                self._active[model] = state.factors
+                self.version += 1
+
+            self._pending += 1
+            if (
+                self._pending >= CALIBRATION_SAVE_EVERY
+                or time.monotonic() - self._saved_at >= CALIBRATION_SAVE_INTERVAL_SECONDS
+            ):
+                self._flush_locked()
+
+    def flush(self):
+        """把尚未写盘的观测写入文件（退出前调用）。"""
+        with self._lock:
+            if self._pending:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        self._save()
+        self._pending = 0
+        self._saved_at = time.monotonic()
+
+    def stats(self) -> dict[str, dict]:
+        return {model: state.stats() for model, state in self._models.items()}
+
+
+# 全局校准器实例
+_calibrator: TokenCalibrator | None = None
+
+
+def _configured_calibration_path() -> Path | None:
+    server_config = get_server_config()
+    if not server_config.enable_persistence:
+        return None
+    return Path(server_config.history_path).parent / CALIBRATION_FILE_NAME
+
+
+def get_token_calibrator() -> TokenCalibrator:
+    """获取校准器实例；历史路径或持久化开关变化时重新加载。"""
+    global _calibrator
+    path = _configured_calibration_path()
+    if _calibrator is None or _calibrator.path != path:
+        _calibrator = TokenCalibrator(path)
+    return _calibrator
+
+
+def flush_token_calibrator():
+    """退出前把校准器尚未写盘的观测写入文件。"""
+    if _calibrator is not None:
+        _calibrator.flush()
+
+
+def reset_token_calibrator():
+    """重置校准器（主要用于测试）"""
+    global _calibrator
+    _calibrator = None
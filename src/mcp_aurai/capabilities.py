@@ -0,0 +1,359 @@
+"""端点能力探测模块
+
+很多 OpenAI 兼容网关不支持严格的 json_schema 输出格式、流式 usage 等特性：
+要么直接 400，要么静默忽略。不探测的话每次调用都会以同样的方式失败或退化。
+这里对每个（Base URL, 模型）组合各探测一次：
+
+- response_format=json_schema / json_object 是否可用；
+- 是否支持流式输出，以及流式时能否通过 stream_options 返回 usage；
+- 非流式响应是否返回 usage。
+
+结果连同探测时间保存在历史目录下的 endpoint_capabilities.json，过期（TTL）后重新探测。
+探测因网络、限流等原因中止时，PROBE_RETRY_SECONDS 内不再重试，期间按默认方式请求。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from .config import get_server_config
+
+logger = logging.getLogger(__name__)
+
+# 持久化文件名（位于历史文件所在目录下）
+CAPABILITIES_FILE_NAME = "endpoint_capabilities.json"
+
+# 单个端点整轮探测的最长时间（秒）
+PROBE_TIMEOUT = 30.0
+
+# 探测请求的输出上限（推理模型会先输出思考内容，太小时回复为空或被截断）
+PROBE_MAX_TOKENS = 512
+
+# 探测中止（限流、5xx、超时等）后多久内不再重新探测（秒）
+PROBE_RETRY_SECONDS = 300.0
+
+# 这些状态码说明请求参数不被支持（而不是端点故障），据此判定能力缺失
+UNSUPPORTED_STATUS_CODES = frozenset({400, 415, 422})
+
+# 输出格式（由强到弱）
+RESPONSE_FORMAT_JSON_SCHEMA = "json_schema"
+RESPONSE_FORMAT_JSON_OBJECT = "json_object"
+
+_PROBE_MESSAGES = [
+    {"role": "user", "content": 'Reply with exactly this JSON and nothing else: {"ok": true}'},
+]
+
+_PROBE_JSON_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "capability_probe",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"ok": {"type": "boolean"}},
+            "required": ["ok"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+class ProbeAborted(Exception):
+    """探测遇到与能力无关的错误（网络、鉴权、限流等），本轮结果不可信。"""
+
+
+class EndpointCapabilities:
+    """
+    单个（Base URL, 模型）组合的能力。
+
+    各项为 None 表示未知（未探测或探测中止），按默认行为处理。
+    """
+
+    FIELDS = ("json_schema", "json_object", "streaming", "stream_usage", "usage")
+
+    def __init__(self, data: dict | None = None):
+        data = data or {}
+        self.json_schema: bool | None = data.get("json_schema")
+        self.json_object: bool | None = data.get("json_object")
+        self.streaming: bool | None = data.get("streaming")
+        self.stream_usage: bool | None = data.get("stream_usage")
+        self.usage: bool | None = data.get("usage")
+        self.probed_at: float = float(data.get("probed_at", 0.0))
+
+    def response_format_mode(self) -> str | None:
+        """选择支持的最强输出格式；都不支持时返回 None（不发送 response_format）。"""
+        if self.json_schema is not False:
+            return RESPONSE_FORMAT_JSON_SCHEMA
+        if self.json_object is not False:
+            return RESPONSE_FORMAT_JSON_OBJECT
+        return None
+
+    def to_dict(self) -> dict[str, Any]:
+        data: dict[str, Any] = {name: getattr(self, name) for name in self.FIELDS}
+        data["probed_at"] = self.probed_at
+        return data
+
+    def stats(self) -> dict[str, Any]:
+        data = self.to_dict()
+        data["response_format"] = self.response_format_mode() or "none"
+        return data
+
+
+def _is_unsupported(exc: BaseException) -> bool:
+    return getattr(exc, "status_code", None) in UNSUPPORTED_STATUS_CODES
+
+
+def _parses_as_object(content: str | None) -> bool:
+    try:
+        return isinstance(json.loads((content or "").strip()), dict)
+    except json.JSONDecodeError:
+        return False
+
+
+async def _probe_response_format(client, model: str, response_format: dict) -> tuple[bool | None, bool | None]:
+    """
+    探测一种输出格式。
+
+    Returns:
+        (是否支持，回复为空或被截断无法判断时为 None, 响应是否带 usage；请求被拒绝时为 None)
+    """
+    try:
+        response = await client.chat.completions.create(
+            model=model,
+            messages=_PROBE_MESSAGES,
+            max_tokens=PROBE_MAX_TOKENS,
+            response_format=response_format,
+        )
+    except Exception as exc:
+        if _is_unsupported(exc):
+            return False, None
+        raise ProbeAborted(str(exc)) from exc
+
+    usage = getattr(response, "usage", None) is not None
+    choice = response.choices[0] if response.choices else None
+    content = choice.message.content if choice is not None else None
+    if _parses_as_object(content):
+        return True, usage
+    if not (content or "").strip() or getattr(choice, "finish_reason", None) == "length":
+        # 输出预算耗在思考内容上，说明不了格式是否被支持
+        return None, usage
+    # 网关静默忽略 response_format 时回复不是 JSON，同样视为不支持
+    return False, usage
+
+
+async def _probe_streaming(client, model: str) -> tuple[bool, bool]:
+    """探测流式输出，返回 (是否支持流式, 流式时是否返回 usage)。"""
+    request = {"model": model, "messages": _PROBE_MESSAGES, "max_tokens": PROBE_MAX_TOKENS, "stream": True}
+    try:
+        stream = await client.chat.completions.create(**request, stream_options={"include_usage": True})
+    except Exception as exc:
+        if not _is_unsupported(exc):
+            raise ProbeAborted(str(exc)) from exc
+        # 可能只是不认识 stream_options
+        try:
+            stream = await client.chat.completions.create(**request)
+        except Exception as retry_exc:
+            if _is_unsupported(retry_exc):
+                return False, False
+            raise ProbeAborted(str(retry_exc)) from retry_exc
+
+    saw_usage = False
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                saw_usage = True
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            await close()
+    return True, saw_usage
+
+
+async def probe_capabilities(client, model: str) -> EndpointCapabilities | None:
+    """
+    探测端点能力；遇到与能力无关的错误或超时时返回 None。
+
+    json_schema 可用时不再探测 json_object；无法判断的格式记为 None（按支持处理，真实请求被拒绝时再降级）。
+    """
+
+    async def run() -> EndpointCapabilities:
+        capabilities = EndpointCapabilities()
+        capabilities.json_schema, usage = await _probe_response_format(client, model, _PROBE_JSON_SCHEMA)
+        if not capabilities.json_schema:
+            capabilities.json_object, object_usage = await _probe_response_format(
+                client,
+                model,
+                {"type": "json_object"},
+            )
+            usage = usage if usage is not None else object_usage
+        capabilities.usage = usage
+        capabilities.streaming, capabilities.stream_usage = await _probe_streaming(client, model)
+        capabilities.probed_at = time.time()
+        return capabilities
+
+    try:
+        return await asyncio.wait_for(run(), timeout=PROBE_TIMEOUT)
+    except ProbeAborted as exc:
+        logger.warning("端点能力探测中止（模型 %s），按默认方式请求: %s", model, exc)
+    except asyncio.TimeoutError:
+        logger.warning("端点能力探测超时（模型 %s），按默认方式请求", model)
+    return None
+
+
+class CapabilityStore:
+    """
+    按（Base URL, 模型）缓存端点能力。
+
+    path 为 None 时只在内存中保存；超过 ttl_seconds 的记录视为过期，需要重新探测。
+    同一组合的并发请求只探测一次，其余请求等待结果；探测中止的组合在内存中记下时间，
+    PROBE_RETRY_SECONDS 内直接按未知处理，不再重复探测。
+    """
+
+    def __init__(self, path: Path | None, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._entries: dict[str, EndpointCapabilities] = {}
+        self._aborted_at: dict[str, float] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._file_lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def key(base_url: str | None, model: str) -> str:
+        return f"{base_url or ''}|{model}"
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            for key, entry in (data.get("endpoints") or {}).items():
+                self._entries[key] = EndpointCapabilities(entry)
+        except (OSError, ValueError, TypeError):
+            logger.warning("读取端点能力缓存失败，将重新探测: %s", self.path, exc_info=True)
+            self._entries = {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        payload = json.dumps(
+            {"endpoints": {key: entry.to_dict() for key, entry in self._entries.items()}},
+            ensure_ascii=False,
+            indent=2,
+        )
+        with self._file_lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path: Path | None = None
+            try:
+                with tempfile.NamedTemporaryFile(
+                    mode="w",
+                    encoding="utf-8",
+                    dir=self.path.parent,
+                    prefix=f".{self.path.stem}.",
+                    suffix=".tmp",
+                    delete=False,
+                ) as temp_file:
+                    temp_file.write(payload)
+                    temp_path = Path(temp_file.name)
+                os.replace(temp_path, self.path)
+            except OSError:
+                logger.warning("保存端点能力缓存失败: %s", self.path, exc_info=True)
+            finally:
+                if temp_path and temp_path.exists():
+                    try:
+                        temp_path.unlink()
+                    except OSError:
+                        pass
+
+    def get(self, key: str) -> EndpointCapabilities | None:
+        """返回未过期的能力记录。"""
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry.probed_at > self.ttl_seconds:
+            return None
+        return entry
+
+    def peek(self, key: str) -> EndpointCapabilities | None:
+        """返回能力记录（不论是否过期）；不探测时使用，过期的记录也比没有强。"""
+        return self._entries.get(key)
+
+    def put(self, key: str, capabilities: EndpointCapabilities):
+        self._entries[key] = capabilities
+        self._save()
+
+    async def resolve(self, key: str, client, model: str) -> EndpointCapabilities | None:
+        """
+        获取能力记录，过期或缺失时探测一次（同一组合的并发调用共享这次探测）。
+
+        探测中止时沿用过期的记录（没有则返回 None），PROBE_RETRY_SECONDS 后再探测。
+        """
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        if self._recently_aborted(key):
+            return self._entries.get(key)
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.get(key)
+            if entry is not None:
+                return entry
+            if self._recently_aborted(key):
+                return self._entries.get(key)
+            logger.info("探测端点能力: %s", key)
+            entry = await probe_capabilities(client, model)
+            if entry is None:
+                # 沿用过期的记录（如果有），稍后再探测
+                self._aborted_at[key] = time.time()
+                return self._entries.get(key)
+            self._aborted_at.pop(key, None)
+            logger.info("端点能力 %s: %s", key, entry.stats())
+            self.put(key, entry)
+            return entry
+
+    def _recently_aborted(self, key: str) -> bool:
+        aborted_at = self._aborted_at.get(key)
+        return aborted_at is not None and time.time() - aborted_at < PROBE_RETRY_SECONDS
+
+    def mark_unsupported(self, key: str, field: str):
+        """真实请求被拒绝时记录某项能力不可用（未探测过的组合也会建立记录）。"""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = EndpointCapabilities({"probed_at": time.time()})
+        setattr(entry, field, False)
+        self.put(key, entry)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {key: entry.stats() for key, entry in self._entries.items()}
+
+
+# 全局能力缓存实例
+_store: CapabilityStore | None = None
+
+
+def _configured_capabilities_path() -> Path | None:
+    server_config = get_server_config()
+    if not server_config.enable_persistence:
+        return None
+    return Path(server_config.history_path).parent / CAPABILITIES_FILE_NAME
+
+
+def get_capability_store(ttl_seconds: float) -> CapabilityStore:
+    """获取能力缓存实例；历史路径或持久化开关变化时重新加载。"""
+    global _store
+    path = _configured_capabilities_path()
+    if _store is None or _store.path != path:
+        _store = CapabilityStore(path, ttl_seconds)
+    _store.ttl_seconds = ttl_seconds
+    return _store
+
+
+def reset_capability_store():
+    """重置能力缓存（主要用于测试）"""
+    global _store
+    _store = None
@@ -0,0 +1,233 @@
+"""按行与代码结构拆分大文件
+
+超过 max_message_tokens 的文件需要拆成多段发送。按固定字符数切分会把一行、
+一个函数甚至一个字符切成两半，顾问看到的上下文残缺，常常需要再问一轮。
+这里的切分点只落在行边界上，并尽量落在代码结构的边界上：
+
+- Python：顶层 def / class（连同前面的装饰器）；
+- C 系语言（C/C++/Java/JS/TS/Go/Rust 等）：花括号配平的顶层块；
+- 其他文件：逐行。
+
+每段的大小按真实的 token 计数累加，每段都带有起止行号，便于顾问引用具体行。
+"""
+
+import re
+from collections.abc import Callable
+from pathlib import PurePath
+
+PYTHON_SUFFIXES = frozenset({".py", ".pyi", ".pyw"})
+
+C_LIKE_SUFFIXES = frozenset({
+    ".c", ".h", ".cc", ".cpp", ".cxx", ".hpp", ".hh", ".cs", ".java", ".kt", ".kts", ".scala",
+    ".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx", ".go", ".rs", ".swift", ".php", ".dart",
+})
+
+# sync_context 会把代码文件改名为 "<原路径>.txt" 发送，并在内容前加上两行说明和一个空行
+_CONVERTED_SUFFIX = ".txt"
+_CONVERTED_HEADER = re.compile(r"\[原始文件: [^\n]*\]\n\[自动转换后发送名: [^\n]*\]\n\n")
+
+# Python 顶层块的起始行
+_PYTHON_BLOCK_START = re.compile(r"(?:async\s+def|def|class)\b|@")
+
+# 统计花括号前去掉字符串字面量和行注释（块注释单独跟踪）
+_C_STRING_LITERAL = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`(?:\\.|[^`\\])*`')
+_C_LINE_COMMENT = re.compile(r"//.*")
+
+
+class FileChunk:
+    """文件的一段内容及其在原文件中的起止行号（从 1 开始，含两端）。"""
+
+    __slots__ = ("text", "start_line", "end_line")
+
+    def __init__(self, text: str, start_line: int, end_line: int):
+        self.text = text
+        self.start_line = start_line
+        self.end_line = end_line
+
+    def __repr__(self) -> str:
+        return f"FileChunk(lines={self.start_line}-{self.end_line}, chars={len(self.text)})"
+
+
+def source_file_info(file_path: str, content: str) -> tuple[str, int]:
+    """
+    还原自动转换前的文件信息。
+
+    Returns:
+        (用于识别语言的原始路径, 原文件第 1 行之前的说明行数)
+    """
+    header = _CONVERTED_HEADER.match(content)
+    if header is None:
+        return file_path, 0
+    source_path = file_path
+    if source_path.endswith(_CONVERTED_SUFFIX) and PurePath(source_path[:-len(_CONVERTED_SUFFIX)]).suffix:
+        source_path = source_path[:-len(_CONVERTED_SUFFIX)]
+    return source_path, header.group(0).count("\n")
+
+
+def _python_block_starts(lines: list[str]) -> list[int]:
+    """Python 顶层 def / class 的起始行下标；装饰器与其修饰的定义属于同一块。"""
+    starts = []
+    in_decorator = False
+    for index, line in enumerate(lines):
+        if not line or line[0].isspace():
+            continue
+        if _PYTHON_BLOCK_START.match(line):
+            if not in_decorator:
+                starts.append(index)
+            in_decorator = line.startswith("@")
+        else:
+            in_decorator = False
+    return starts
+
+
+def _c_like_block_starts(lines: list[str]) -> list[int]:
+    """C 系语言中花括号回到顶层之后的下一行下标（即下一个顶层块的起始行）。"""
+    starts = []
+    depth = 0
+    in_block_comment = False
+    for index, line in enumerate(lines):
+        code = line
+        if in_block_comment:
+            end = code.find("*/")
+            if end < 0:
+                continue
+            code = code[end + 2:]
+            in_block_comment = False
+
+        code = _C_LINE_COMMENT.sub("", _C_STRING_LITERAL.sub("", code))
+        while "/*" in code:
+            before, _, after = code.partition("/*")
+            end = after.find("*/")
+            if end < 0:
+                code = before
+                in_block_comment = True
+                break
+            code = before + after[end + 2:]
+
+        opened = depth > 0 or "{" in code
+        depth = max(depth + code.count("{") - code.count("}"), 0)
+        if opened and depth == 0 and index + 1 < len(lines):
+            starts.append(index + 1)
+    return starts
+
+
+def _block_boundaries(file_path: str, lines: list[str]) -> list[int]:
+    """按文件类型确定代码块的起始行下标（首个块总是从 0 开始）。"""
+    suffix = PurePath(file_path).suffix.lower()
+    if suffix in PYTHON_SUFFIXES:
+        starts = _python_block_starts(lines)
+    elif suffix in C_LIKE_SUFFIXES:
+        starts = _c_like_block_starts(lines)
+    else:
+        return list(range(len(lines)))
+    return sorted({0, *starts})
+
+
+def _split_long_line(line: str, max_tokens: int, count_tokens: Callable[[str], int]) -> list[str]:
+    """单行超过预算（如压缩过的 JS）时按 token 计数切成若干段。"""
+    pieces = []
+    rest = line
+    while rest:
+        tokens = count_tokens(rest)
+        if tokens <= max_tokens:
+            pieces.append(rest)
+            break
+        # 按当前密度估计能放下的字符数，再逐步收缩到确实不超过预算
+        size = max(int(len(rest) * max_tokens / tokens), 1)
+        while size > 1 and count_tokens(rest[:size]) > max_tokens:
+            size = max(int(size * 0.9), 1)
+        pieces.append(rest[:size])
+        rest = rest[size:]
+    return pieces
+
+
+def _chunk_units(
+    lines: list[str],
+    blocks: list[tuple[int, int]],
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> list[tuple[str, int, int]]:
+    """
+    把代码块展开为装填单元 (文本, 行下标, token 数)。
+
+    放得下的块整体作为一个单元；超过预算的块拆成逐行单元，超长的行再切成行内片段。
+    """
+    units: list[tuple[str, int, int]] = []
+    for start, end in blocks:
+        block_text = "".join(lines[start:end])
+        block_tokens = count_tokens(block_text)
+        if block_tokens <= max_tokens:
+            units.append((block_text, start, block_tokens))
+            continue
+
+        for line_index in range(start, end):
+            line = lines[line_index]
+            line_tokens = count_tokens(line)
+            if line_tokens <= max_tokens:
+                units.append((line, line_index, line_tokens))
+                continue
+            for piece in _split_long_line(line, max_tokens, count_tokens):
+                units.append((piece, line_index, count_tokens(piece)))
+    return units
+
+
+def split_into_chunks(
+    file_path: str,
+    content: str,
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> list[FileChunk]:
+    """
+    把文件内容拆成不超过 max_tokens 的若干段。
+
+    优先在代码块边界切分；单个块超过预算时退回到行边界，单行超过预算时才在行内切分。
+    装填时累加各单元的 token 数，每段再整体计数一次：估算按单元取整会略有低估，
+    超出时从段尾移出单元留给下一段。
+
+    Args:
+        file_path: 文件路径（用于按后缀识别语言）
+        content: 文件内容
+        max_tokens: 每段的 token 上限
+        count_tokens: token 计数函数
+
+    Returns:
+        按原顺序排列的片段，拼接起来与原内容完全一致；
+        自动转换的文件按原文件计算行号（说明行计入第 1 行）
+    """
+    lines = content.splitlines(keepends=True)
+    if not lines:
+        return [FileChunk(content, 1, 1)]
+
+    source_path, line_offset = source_file_info(file_path, content)
+    boundaries = _block_boundaries(source_path, lines)
+    blocks = list(zip(boundaries, [*boundaries[1:], len(lines)]))
+    units = _chunk_units(lines, blocks, max_tokens, count_tokens)
+
+    chunks: list[FileChunk] = []
+    index = 0
+    while index < len(units):
+        end = index
+        total = 0
+        while end < len(units) and (end == index or total + units[end][2] <= max_tokens):
+            total += units[end][2]
+            end += 1
+
+        text = "".join(unit[0] for unit in units[index:end])
+        overshoot = count_tokens(text) - max_tokens
+        while overshoot > 0 and end - index > 1:
+            removed = 0
+            while end - index > 1 and removed < overshoot:
+                end -= 1
+                removed += max(units[end][2], 1)
+            text = "".join(unit[0] for unit in units[index:end])
+            overshoot = count_tokens(text) - max_tokens
+
+        last_text, last_line, _ = units[end - 1]
+        end_line = last_line + last_text.count("\n", 0, len(last_text) - 1) + 1
+        chunks.append(FileChunk(
+            text,
+            max(units[index][1] + 1 - line_offset, 1),
+            max(end_line - line_offset, 1),
+        ))
+        index = end
+    return chunks
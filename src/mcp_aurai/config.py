@@ -1,10 +1,11 @@
 """配置管理模块"""
 
+import json
 import os
 import re
 from pathlib import Path
 from typing import Literal
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, field_validator, model_validator
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -37,6 +38,92 @@ DEFAULT_MAX_MESSAGE_TOKENS = 150000
 # 可通过 AURAI_MAX_TOKENS 环境变量覆盖
 DEFAULT_MAX_TOKENS = 32000
 
+# Base URL 格式：域名、IP、localhost、或单标签主机名（如 Docker 服务名）
+_BASE_URL_PATTERN = re.compile(
+    r'^https?://'
+    r'(?:'
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?)|'  # FQDN
+    r'(?:[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?)*)|'  # 主机名（含单标签）
+    r'localhost|'
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+    r')'
+    r'(?::\d+)?'
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE
+)
+
+
+def _validate_base_url(v: str | None) -> str | None:
+    """校验 Base URL 格式，空值返回 None。"""
+    if v is None or not v.strip():
+        return None
+
+    v = v.strip()
+
+    # 基本URL格式验证
+    if not v.startswith(('http://', 'https://')):
+        raise ValueError("Base URL 必须以 http:// 或 https:// 开头")
+
+    if not _BASE_URL_PATTERN.match(v):
+        raise ValueError(f"Base URL 格式无效: {v}")
+
+    return v
+
+
+def _validate_api_key(v: str | None) -> str | None:
+    """校验 API 密钥格式，空值返回 None（是否必填由端点配置整体决定）。"""
+    if v is None or not v.strip():
+        return None
+
+    v = v.strip()
+
+    # 基本长度验证（大多数API密钥至少20个字符）
+    if len(v) < 10:
+        raise ValueError("API密钥长度不能少于10个字符")
+
+    # 基本格式验证（不能包含空格或特殊控制字符）
+    if re.search(r'[\s\n\r\t]', v):
+        raise ValueError("API密钥不能包含空格或控制字符")
+
+    return v
+
+
+class EndpointConfig(BaseModel):
+    """
+    单个上级 AI 端点配置（多端点负载均衡）
+
+    未填写的 base_url / api_key / model 沿用 AURAI_BASE_URL / AURAI_API_KEY / AURAI_MODEL。
+    """
+
+    # 端点名称（日志与状态展示用）
+    name: str | None = None
+
+    # API基础URL
+    base_url: str | None = None
+
+    # API密钥
+    api_key: str | None = None
+
+    # 模型名称
+    model: str | None = None
+
+    # 权重：空闲时按权重比例分配请求
+    weight: int = Field(default=1, ge=1, le=100, description="负载均衡权重")
+
+    # 最大并发请求数（0 表示不限）
+    max_concurrency: int = Field(default=0, ge=0, le=1000, description="该端点最大并发请求数（0 表示不限）")
+
+    @field_validator('api_key')
+    @classmethod
+    def validate_api_key(cls, v: str | None) -> str | None:
+        """验证API密钥格式"""
+        return _validate_api_key(v)
+
+    @field_validator('base_url')
+    @classmethod
+    def validate_base_url(cls, v: str | None) -> str | None:
+        """验证Base URL格式"""
+        return _validate_base_url(v)
+
 
 class AuraiConfig(BaseModel):
     """上级AI配置"""
@@ -110,56 +197,283 @@ class AuraiConfig(BaseModel):
         description="上下文高水位线（默认 0.85 = 85%）。输入超过此比例时返回预警并主动压缩历史"
     )
 
-    @field_validator('api_key')
-    @classmethod
-    def validate_api_key(cls, v: str) -> str:
-        """验证API密钥格式"""
-        if not v or not v.strip():
-            raise ValueError("API密钥不能为空")
+    # 流式响应 — 边生成边接收，超时按分片计算，避免长回复整体超时
+    stream_responses: bool = Field(
+        default_factory=lambda: os.getenv("AURAI_STREAM_RESPONSES", "false").lower() == "true",
+        description="是否以流式方式接收上级 AI 回复（默认 false）。开启后超时按分片计算，并推送 MCP 进度通知"
+    )
 
-        v = v.strip()
+    # 流式分片超时（秒）— 两个分片之间的最长等待时间
+    stream_chunk_timeout: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_STREAM_CHUNK_TIMEOUT", "60")),
+        gt=0,
+        le=600,
+        description="流式模式下两个分片之间的最长等待时间（秒，默认 60）"
+    )
 
-        # 基本长度验证（大多数API密钥至少20个字符）
-        if len(v) < 10:
-            raise ValueError("API密钥长度不能少于10个字符")
+    # 请求失败后的最大尝试次数（含首次请求）
+    retry_max_attempts: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_RETRY_MAX_ATTEMPTS", "4")),
+        ge=1,
+        le=10,
+        description="可重试错误（429/5xx/超时/连接失败）的最大尝试次数，含首次请求（1 表示不重试）"
+    )
 
-        # 基本格式验证（不能包含空格或特殊控制字符）
-        if re.search(r'[\s\n\r\t]', v):
-            raise ValueError("API密钥不能包含空格或控制字符")
+    # 指数退避的初始等待时间（秒）
+    retry_base_delay: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_RETRY_BASE_DELAY", "1")),
+        gt=0,
+        le=60,
+        description="指数退避的初始等待时间（秒），第 n 次重试等待 base * 2^(n-1)"
+    )
 
-        return v
+    # 单次退避的最长等待时间（秒）
+    retry_max_delay: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_RETRY_MAX_DELAY", "30")),
+        gt=0,
+        le=600,
+        description="单次退避的最长等待时间（秒）。服务端 Retry-After 不受此限制，但受总时限约束"
+    )
+
+    # 退避抖动比例
+    retry_jitter: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_RETRY_JITTER", "0.5")),
+        ge=0.0,
+        le=1.0,
+        description="退避抖动比例：实际等待在 [delay*(1-jitter), delay] 之间随机，避免多个会话同时重试"
+    )
+
+    # 一次 chat 调用（含全部重试）的总时限（秒）
+    retry_deadline: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_RETRY_DEADLINE", "180")),
+        gt=0,
+        le=3600,
+        description="一次调用含全部重试的总时限（秒）。超过后不再发起新的尝试"
+    )
+
+    # 对话历史的发送方式
+    history_rendering: Literal["inline", "single"] = Field(
+        default_factory=lambda: os.getenv("AURAI_HISTORY_RENDERING", "inline").strip().lower(),
+        description="inline：历史既作为独立消息发送，又在当前问题中复述；single：每轮只作为历史消息发送一次，当前问题中只保留简短引用"
+    )
+
+    # 前缀缓存友好的消息布局
+    prompt_cache_layout: bool = Field(
+        default_factory=lambda: os.getenv("AURAI_PROMPT_CACHE_LAYOUT", "false").lower() == "true",
+        description="按前缀缓存友好的顺序排列消息（系统提示词 → 已同步文件按规范顺序 → 滚动轮次），同时按 single 方式发送历史（默认 false）"
+    )
+
+    # 大文件大纲模式的阈值（tokens），0 表示关闭
+    outline_threshold_tokens: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_OUTLINE_THRESHOLD_TOKENS", "0")),
+        ge=0,
+        description="已同步的代码文件超过该 token 数时只发送大纲（导入、签名、文档字符串和行号），顾问点名的符号再展开完整代码；0 表示关闭"
+    )
+
+    # 按相关度裁剪已同步的文件片段
+    relevance_selection: bool = Field(
+        default_factory=lambda: os.getenv("AURAI_RELEVANCE_SELECTION", "true").lower() == "true",
+        description="上下文预算不足时，按与当前错误信息、代码片段、终端输出的相关度（BM25）优先保留已同步的文件片段（默认 true）"
+    )
+
+    # 一次 chat 调用的硬性时限（秒），0 表示不限
+    call_timeout: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_CALL_TIMEOUT", "0")),
+        ge=0,
+        le=3600,
+        description="一次调用（含排队、重试、续写）的硬性时限（秒），到时立即中止上游请求；0 表示不限"
+    )
+
+    # 全局同时在途的上级 AI 请求数上限
+    max_concurrent_requests: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_MAX_CONCURRENT_REQUESTS", "8")),
+        ge=1,
+        le=100,
+        description="所有会话合计同时在途的请求数上限，超出的请求按会话公平排队（咨询优先于后台摘要）"
+    )
+
+    # 本地限流：每分钟请求数（0 表示不限）
+    rate_limit_rpm: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_RATE_LIMIT_RPM", "0")),
+        ge=0,
+        description="服务商每分钟请求数额度（RPM），0 表示不在本地限流"
+    )
+
+    # 本地限流：每分钟 tokens（0 表示不限）
+    rate_limit_tpm: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_RATE_LIMIT_TPM", "0")),
+        ge=0,
+        description="服务商每分钟 tokens 额度（TPM），按预估输入 + 输出上限预扣，完成后按实际用量修正；0 表示不限"
+    )
+
+    # 本地限流的最长等待时间（秒）
+    rate_limit_max_wait: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_RATE_LIMIT_MAX_WAIT", "60")),
+        ge=0,
+        le=3600,
+        description="额度不足时本地最多等待多久（秒），预计等待更久时直接拒绝"
+    )
+
+    # 对冲请求：主请求迟迟没有首字节时向另一个端点 / 备用模型发出同样的请求
+    hedge_enabled: bool = Field(
+        default_factory=lambda: os.getenv("AURAI_HEDGE_ENABLED", "false").lower() == "true",
+        description="是否开启对冲请求（默认 false）。主请求超过近期首字节延迟分位数仍无输出时，向另一个端点或备用模型发出同样的请求，先返回者胜出"
+    )
+
+    # 对冲触发的延迟分位数
+    hedge_percentile: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_HEDGE_PERCENTILE", "0.95")),
+        ge=0.5,
+        le=0.999,
+        description="主请求等待超过近期首字节延迟的该分位数后发起对冲"
+    )
+
+    # 对冲前的最短等待（秒）
+    hedge_min_delay: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_HEDGE_MIN_DELAY", "2")),
+        ge=0,
+        le=600,
+        description="发起对冲前至少等待的秒数，避免延迟普遍很低时频繁对冲"
+    )
+
+    # 每分钟最多发出的对冲请求数
+    hedge_max_per_minute: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_HEDGE_MAX_PER_MINUTE", "6")),
+        ge=1,
+        le=1000,
+        description="每分钟最多发出的对冲请求数，限制额外的 tokens 开销"
+    )
+
+    # 备用模型：没有其他可用端点时，在主端点上用该模型对冲
+    hedge_model: str = Field(
+        default_factory=lambda: os.getenv("AURAI_HEDGE_MODEL", ""),
+        description="对冲用的备用模型；没有其他可用端点时在主端点上用该模型发出对冲请求，为空表示只对冲到其他端点"
+    )
+
+    # 多端点配置（JSON 数组），为空时只使用 AURAI_BASE_URL / AURAI_API_KEY / AURAI_MODEL
+    endpoints: list[EndpointConfig] = Field(
+        default_factory=lambda: os.getenv("AURAI_ENDPOINTS", ""),
+        validate_default=True,
+        description="多端点配置（JSON 数组），每项可含 name/base_url/api_key/model/weight/max_concurrency"
+    )
+
+    # 端点连续失败多少次后暂时摘除
+    endpoint_failure_threshold: int = Field(
+        default_factory=lambda: int(os.getenv("AURAI_ENDPOINT_FAILURE_THRESHOLD", "3")),
+        ge=1,
+        le=100,
+        description="端点连续失败达到该次数后暂时摘除，冷却期内不再分配请求"
+    )
+
+    # 端点摘除后的冷却时间（秒）
+    endpoint_cooldown_seconds: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_ENDPOINT_COOLDOWN_SECONDS", "30")),
+        gt=0,
+        le=3600,
+        description="端点被摘除后的冷却时间（秒），到期后放行请求试探恢复"
+    )
+
+    # 是否探测端点能力（json_schema / json_object / 流式 / usage）
+    capability_probe: bool = Field(
+        default_factory=lambda: os.getenv("AURAI_CAPABILITY_PROBE", "true").lower() == "true",
+        description="首次使用端点时探测其支持的输出格式与流式能力，并自动选择最合适的请求方式"
+    )
+
+    # 端点能力探测结果的有效期（秒）
+    capability_ttl: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_CAPABILITY_TTL", "86400")),
+        gt=0,
+        description="端点能力探测结果的缓存有效期（秒），过期后重新探测"
+    )
+
+    # 按模型配置的本地词表文件（JSON 对象），未匹配的模型使用字符数估算
+    tokenizer_files: dict[str, str] = Field(
+        default_factory=lambda: os.getenv("AURAI_TOKENIZER_FILES", ""),
+        validate_default=True,
+        description="模型名（支持 * 通配符）到本地 BPE 词表文件的映射（JSON 对象），匹配的模型按词表精确计数"
+    )
+
+    @field_validator('api_key')
+    @classmethod
+    def validate_api_key(cls, v: str) -> str:
+        """验证API密钥格式（AURAI_ENDPOINTS 中每个端点都有自己的密钥时可以为空）"""
+        return _validate_api_key(v) or ""
+
+    @model_validator(mode='after')
+    def require_api_key(self) -> "AuraiConfig":
+        """每个实际使用的端点都必须有 API 密钥"""
+        missing = [endpoint.name for endpoint in self.resolved_endpoints() if not endpoint.api_key]
+        if missing:
+            if not self.endpoints:
+                raise ValueError("API密钥不能为空")
+            raise ValueError(f"API密钥不能为空：端点 {', '.join(missing)} 未配置 api_key，且未设置 AURAI_API_KEY")
+        return self
 
     @field_validator('base_url')
     @classmethod
     def validate_base_url(cls, v: str | None) -> str | None:
         """验证Base URL格式"""
-        if v is None or not v.strip():
-            return None
-
-        v = v.strip()
-
-        # 基本URL格式验证
-        if not v.startswith(('http://', 'https://')):
-            raise ValueError("Base URL 必须以 http:// 或 https:// 开头")
-
-        # URL格式检查：域名、IP、localhost、或单标签主机名（如 Docker 服务名）
-        url_pattern = re.compile(
-            r'^https?://'
-            r'(?:'
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?)|'  # FQDN
-            r'(?:[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?)*)|'  # 主机名（含单标签）
-            r'localhost|'
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
-            r')'
-            r'(?::\d+)?'
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE
-        )
-
-        if not url_pattern.match(v):
-            raise ValueError(f"Base URL 格式无效: {v}")
+        return _validate_base_url(v)
 
+    @field_validator('endpoints', mode='before')
+    @classmethod
+    def parse_endpoints(cls, v):
+        """解析 AURAI_ENDPOINTS（JSON 数组字符串）"""
+        if v is None:
+            return []
+        if isinstance(v, str):
+            if not v.strip():
+                return []
+            try:
+                v = json.loads(v)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"AURAI_ENDPOINTS 不是合法的 JSON: {e}") from e
+        if not isinstance(v, list):
+            raise ValueError("AURAI_ENDPOINTS 必须是 JSON 数组")
         return v
 
+    @field_validator('tokenizer_files', mode='before')
+    @classmethod
+    def parse_tokenizer_files(cls, v):
+        """解析 AURAI_TOKENIZER_FILES（JSON 对象字符串）"""
+        if v is None:
+            return {}
+        if isinstance(v, str):
+            if not v.strip():
+                return {}
+            try:
+                v = json.loads(v)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"AURAI_TOKENIZER_FILES 不是合法的 JSON: {e}") from e
+        if not isinstance(v, dict):
+            raise ValueError("AURAI_TOKENIZER_FILES 必须是 JSON 对象")
+        return v
+
+    def resolved_endpoints(self) -> list[EndpointConfig]:
+        """
+        返回实际使用的端点列表。
+
+        未配置 AURAI_ENDPOINTS 时只有一个由 AURAI_BASE_URL / AURAI_API_KEY / AURAI_MODEL
+        组成的端点；否则各端点缺失的字段沿用这三个值。
+        """
+        if not self.endpoints:
+            return [EndpointConfig(
+                name="default",
+                base_url=self.base_url,
+                api_key=self.api_key,
+                model=self.model,
+            )]
+
+        resolved = []
+        for index, endpoint in enumerate(self.endpoints, 1):
+            resolved.append(endpoint.model_copy(update={
+                "name": endpoint.name or f"endpoint-{index}",
+                "base_url": endpoint.base_url or self.base_url,
+                "api_key": endpoint.api_key or self.api_key,
+                "model": endpoint.model or self.model,
+            }))
+        return resolved
+
 
 class ServerConfig(BaseModel):
     """服务器配置"""
@@ -204,10 +518,18 @@ class ServerConfig(BaseModel):
         description="历史文件锁超时时间（秒）"
     )
 
-    # 是否启用历史摘要化（仅在接近 max_history 时触发）
+    # 是否启用历史摘要化（按 token 占用或接近 max_history 时触发）
     enable_history_summary: bool = Field(
         default_factory=lambda: os.getenv("AURAI_ENABLE_HISTORY_SUMMARY", "true").lower() == "true",
-        description="是否启用历史摘要化。仅在历史条数接近 max_history 时才压缩，不再按固定条数触发"
+        description="是否启用历史摘要化。历史估算 token 达到历史预算的 history_summary_token_ratio，或原始记录条数接近 max_history（80%）时压缩"
+    )
+
+    # 历史 token 占历史预算的比例达到多少时触发摘要
+    history_summary_token_ratio: float = Field(
+        default_factory=lambda: float(os.getenv("AURAI_HISTORY_SUMMARY_TOKEN_RATIO", "0.6")),
+        ge=0.1,
+        le=1.0,
+        description="历史消息估算 token 占可用历史预算的比例达到该值时触发摘要（条数接近 max_history 时同样触发）"
     )
 
     # 发送给上级顾问的最近对话轮数
@@ -0,0 +1,195 @@
+"""上级 AI 多端点负载均衡模块
+
+多个端点（不同账号 / 区域 / 网关）共同承接顾问请求：
+按权重选择在途请求最少的端点，遵守各端点的并发上限；
+被动健康检查——连续失败的端点会被暂时摘除，冷却期满后放行请求试探恢复。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    """单个端点及其运行时状态。"""
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        client: Any,
+        weight: int = 1,
+        max_concurrency: int = 0,
+        base_url: str | None = None,
+    ):
+        self.name = name
+        self.model = model
+        self.client = client
+        self.weight = max(weight, 1)
+        self.max_concurrency = max_concurrency
+        self.base_url = base_url
+
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        # 探测到的能力（EndpointCapabilities），未探测时为 None
+        self.capabilities = None
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.in_flight < self.max_concurrency
+
+    def load_score(self) -> tuple[float, float]:
+        """按权重归一化的负载：先比在途请求数，再比累计请求数（空闲时即加权轮询）。"""
+        return self.in_flight / self.weight, self.total_requests / self.weight
+
+    def stats(self, now: float | None = None) -> dict[str, Any]:
+        current_time = now if now is not None else time.monotonic()
+        return {
+            "name": self.name,
+            "model": self.model,
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejected": self.is_ejected(current_time),
+            "ejected_remaining_seconds": round(max(self.ejected_until - current_time, 0.0), 1),
+            "capabilities": self.capabilities.stats() if self.capabilities is not None else None,
+        }
+
+
+class EndpointPool:
+    """
+    端点池。
+
+    acquire/release 成对使用：acquire 选出端点并占用一个并发名额，
+    所有端点都满载时排队等待；release 归还名额并记录成败。
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        failure_threshold: int = 3,
+        cooldown_seconds: float = 30.0,
+    ):
+        if not endpoints:
+            raise ValueError("至少需要配置一个端点")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._condition = asyncio.Condition()
+
+    def _pick(self, exclude: set[str], now: float, prefer: str | None = None) -> Endpoint | None:
+        if prefer is not None:
+            pinned = next((endpoint for endpoint in self.endpoints if endpoint.name == prefer), None)
+            if pinned is not None and not pinned.is_ejected(now):
+                # 指定的端点健康时只用它，满载就排队等它
+                return pinned if pinned.has_capacity() else None
+
+        with_capacity = [endpoint for endpoint in self.endpoints if endpoint.has_capacity()]
+        healthy = [endpoint for endpoint in with_capacity if not endpoint.is_ejected(now)]
+        if healthy:
+            preferred = [endpoint for endpoint in healthy if endpoint.name not in exclude] or healthy
+            return min(preferred, key=Endpoint.load_score)
+
+        # 仍有健康端点只是满载：排队等待，不去打扰被摘除的端点
+        if any(not endpoint.is_ejected(now) for endpoint in self.endpoints):
+            return None
+
+        # 全部被摘除：与其直接失败，不如放行到最早恢复的端点试探
+        if with_capacity:
+            return min(with_capacity, key=lambda endpoint: endpoint.ejected_until)
+        return None
+
+    async def acquire(self, exclude: set[str] | None = None, prefer: str | None = None) -> Endpoint:
+        """
+        选出一个端点并占用并发名额；exclude 中的端点仅在没有其他健康端点时使用。
+
+        指定 prefer 时固定使用该端点，只有它被摘除（或不存在）时才按常规选择。
+        """
+        excluded = exclude or set()
+        async with self._condition:
+            while True:
+                endpoint = self._pick(excluded, time.monotonic(), prefer)
+                if endpoint is not None:
+                    endpoint.in_flight += 1
+                    endpoint.total_requests += 1
+                    return endpoint
+                await self._condition.wait()
+
+    def try_acquire(self, exclude: set[str]) -> Endpoint | None:
+        """
+        不等待地占用一个 exclude 之外、健康且有空闲名额的端点（用于对冲请求）；没有时返回 None。
+
+        与 acquire 一样只在单个事件循环内调用，选出与占用之间没有 await，不需要加锁。
+        """
+        now = time.monotonic()
+        candidates = [
+            endpoint for endpoint in self.endpoints
+            if endpoint.name not in exclude and endpoint.has_capacity() and not endpoint.is_ejected(now)
+        ]
+        if not candidates:
+            return None
+        endpoint = min(candidates, key=Endpoint.load_score)
+        endpoint.in_flight += 1
+        endpoint.total_requests += 1
+        return endpoint
+
+    async def release(
+        self,
+        endpoint: Endpoint,
+        failed: bool = False,
+        retry_after: float | None = None,
+    ):
+        """
+        归还并发名额并记录结果。
+
+        连续失败达到阈值时摘除端点 cooldown_seconds 秒；
+        服务端给出 Retry-After 时，至少摘除到该时间之后。
+        """
+        now = time.monotonic()
+        async with self._condition:
+            endpoint.in_flight = max(endpoint.in_flight - 1, 0)
+
+            if not failed:
+                endpoint.consecutive_failures = 0
+            else:
+                endpoint.total_failures += 1
+                endpoint.consecutive_failures += 1
+                ejected_until = endpoint.ejected_until
+                if endpoint.consecutive_failures >= self.failure_threshold:
+                    ejected_until = max(ejected_until, now + self.cooldown_seconds)
+                if retry_after is not None:
+                    ejected_until = max(ejected_until, now + retry_after)
+                if ejected_until > endpoint.ejected_until:
+                    endpoint.ejected_until = ejected_until
+                    logger.warning(
+                        "端点 %s 暂时摘除 %.1fs（连续失败 %s 次）",
+                        endpoint.name,
+                        ejected_until - now,
+                        endpoint.consecutive_failures,
+                    )
+
+            self._condition.notify_all()
+
+    def has_alternative(self, exclude: set[str]) -> bool:
+        """除 exclude 外是否还有未被摘除的端点（用于决定是否立即切换而不退避）。"""
+        now = time.monotonic()
+        return any(
+            endpoint.name not in exclude and not endpoint.is_ejected(now)
+            for endpoint in self.endpoints
+        )
+
+    def stats(self) -> list[dict[str, Any]]:
+        now = time.monotonic()
+        return [endpoint.stats(now) for endpoint in self.endpoints]
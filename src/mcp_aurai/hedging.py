@@ -0,0 +1,128 @@
+"""对冲请求模块（尾延迟控制）
+
+顾问调用的 p99 延迟主要由少数几次慢响应决定。开启对冲后：
+主请求在「最近首字节延迟的某个分位数」之后仍没有任何输出时，
+把同样的请求发给另一个端点（或备用模型），谁先返回用谁，另一个立即取消。
+
+对冲请求会额外消耗 tokens，按每分钟次数上限控制；样本不足时不对冲。
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+
+# 参与分位数计算的最近首字节延迟样本数
+HEDGE_LATENCY_WINDOW = 200
+
+# 样本少于该数量时分位数不可靠，不发起对冲
+HEDGE_MIN_SAMPLES = 20
+
+# 对冲次数上限的统计窗口（秒）
+HEDGE_BUDGET_WINDOW = 60.0
+
+
+class FirstByteSignal:
+    """
+    记录一次请求从发出到收到首字节（非流式为完整响应）的时间。
+
+    计时从 start() 开始（端点能力确定、请求真正发出时），之前的准备时间不计入延迟。
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.latency: float | None = None
+        self.started = asyncio.Event()
+        self.event = asyncio.Event()
+
+    def start(self):
+        if not self.started.is_set():
+            self.started_at = time.monotonic()
+            self.started.set()
+
+    def __call__(self):
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started_at
+            self.event.set()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+
+class LatencyTracker:
+    """最近若干次请求的首字节延迟（滑动窗口）。"""
+
+    def __init__(self, window: int = HEDGE_LATENCY_WINDOW):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float):
+        self._samples.append(max(seconds, 0.0))
+
+    def percentile(self, q: float) -> float | None:
+        """最近延迟的 q 分位数（最近秩法）；样本不足时返回 None。"""
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        index = min(max(math.ceil(q * len(ordered)) - 1, 0), len(ordered) - 1)
+        return ordered[index]
+
+
+class HedgePolicy:
+    """
+    对冲策略：何时发起对冲，以及每分钟最多对冲几次。
+
+    对冲等待时间取最近首字节延迟的 percentile 分位数，且不少于 min_delay 秒。
+    """
+
+    def __init__(self, percentile: float, min_delay: float, max_per_minute: int):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_per_minute = max_per_minute
+        self.latency = LatencyTracker()
+        self._sent_at: deque[float] = deque()
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_skipped = 0
+        self.unavailable_skipped = 0
+
+    def delay(self) -> float | None:
+        """主请求等待多久没有首字节后发起对冲；样本不足时返回 None（不对冲）。"""
+        threshold = self.latency.percentile(self.percentile)
+        if threshold is None:
+            return None
+        return max(threshold, self.min_delay)
+
+    def _prune(self, now: float):
+        while self._sent_at and now - self._sent_at[0] >= HEDGE_BUDGET_WINDOW:
+            self._sent_at.popleft()
+
+    def allow(self, now: float | None = None) -> bool:
+        """本分钟是否还有对冲额度（不扣减）；没有时计入 budget_skipped。"""
+        self._prune(now if now is not None else time.monotonic())
+        if len(self._sent_at) >= self.max_per_minute:
+            self.budget_skipped += 1
+            return False
+        return True
+
+    def record(self, now: float | None = None):
+        """记录一次已发出的对冲请求。"""
+        self._sent_at.append(now if now is not None else time.monotonic())
+        self.hedged += 1
+
+    def stats(self) -> dict[str, float | int | None]:
+        now = time.monotonic()
+        self._prune(now)
+        threshold = self.delay()
+        return {
+            "percentile": self.percentile,
+            "delay_seconds": round(threshold, 3) if threshold is not None else None,
+            "latency_samples": len(self.latency),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_remaining": max(self.max_per_minute - len(self._sent_at), 0),
+            "budget_skipped": self.budget_skipped,
+            "unavailable_skipped": self.unavailable_skipped,
+        }
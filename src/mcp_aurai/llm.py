@@ -1,9 +1,41 @@
 """AI客户端模块 - 使用 OpenAI 兼容 API"""
 
+import asyncio
+import hashlib
 import json
 import logging
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from .blob_store import get_blob_store
+from .capabilities import (
+    RESPONSE_FORMAT_JSON_OBJECT,
+    RESPONSE_FORMAT_JSON_SCHEMA,
+    CapabilityStore,
+    EndpointCapabilities,
+    get_capability_store,
+)
+from .calibration import (
+    TokenCalibrator,
+    TokenFeatures,
+    get_token_calibrator,
+    message_overhead,
+    prompt_features,
+    text_features,
+)
+from .chunking import FileChunk, split_into_chunks
 from .config import get_aurai_config
-from .utils import estimate_tokens
+from .endpoints import Endpoint, EndpointPool
+from .hedging import FirstByteSignal, HedgePolicy
+from .outline import SymbolMentions, get_file_outline
+from .prompts import HISTORY_REFERENCES_PLACEHOLDER, format_history_references
+from .rate_limit import RateLimiter, RateLimitExceeded
+from .response_parser import parse_advisor_response, strip_code_fence
+from .retrieval import BM25Index, get_session_index
+from .tokenizer import Tokenizer, get_tokenizer
 
 logger = logging.getLogger(__name__)
 
@@ -11,44 +43,552 @@ logger = logging.getLogger(__name__)
 DEFAULT_TIMEOUT = 30.0
 HTTP_TIMEOUT = 60.0
 
+# 共享连接池配置：所有会话复用同一个 AsyncClient，网络等待可以互相重叠
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
 
-class AuraiClient:
-    """上级AI客户端（OpenAI 兼容 API）"""
+# 流式模式下会被增量提取并推送给客户端的字段
+STREAM_PROGRESS_FIELDS = ("analysis", "guidance")
 
-    def __init__(self):
+# 流式模式下，部分字段每增长多少字符推送一次进度
+STREAM_PROGRESS_MIN_CHARS = 200
+
+# JSON 字符串转义字符映射
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# 流式进度回调：参数为当前已生成的部分字段
+ProgressCallback = Callable[[dict[str, str]], Awaitable[None]]
+
+# 历史消息分组缓存最多保留的条目数
+HISTORY_GROUP_CACHE_SIZE = 256
+
+# sync_context 消息段中项目背景的段标识（文件段以文件路径为标识）
+PROJECT_INFO_SECTION = ""
+
+# 可重试的 HTTP 状态码（另外所有 5xx 都视为可重试）
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429})
+
+# 只说明当前端点不可用的状态码：多端点时换一个端点重试
+ENDPOINT_FAILURE_STATUS_CODES = frozenset({401, 403, 404})
+
+# 服务商报告上下文超长时可能使用的状态码
+CONTEXT_OVERFLOW_STATUS_CODES = frozenset({400, 413, 422})
+
+# 上下文超长错误的识别关键字（OpenAI 兼容服务商的错误码 / 错误信息）
+CONTEXT_OVERFLOW_MARKERS = (
+    "context_length_exceeded",
+    "maximum context length",
+    "context window",
+    "context length",
+    "prompt is too long",
+    "input is too long",
+    "reduce the length of the messages",
+    "上下文长度",
+    "超长",
+)
+
+# 从错误信息中提取上限与实际请求 tokens：
+# "maximum context length is 8192 tokens. However, your messages resulted in 9000 tokens"
+# "prompt is too long: 210000 tokens > 200000 maximum"
+_CONTEXT_LIMIT_PATTERN = re.compile(r"maximum context length is (\d+)", re.IGNORECASE)
+_CONTEXT_REQUESTED_PATTERN = re.compile(r"(?:resulted in|requested) (\d+) tokens", re.IGNORECASE)
+_CONTEXT_COMPARISON_PATTERN = re.compile(r"(\d+) tokens? > (\d+)", re.IGNORECASE)
+
+# 上下文超长后最多自动缩减历史重试几次
+CONTEXT_OVERFLOW_MAX_RETRIES = 2
+
+# 按服务商报告的超出量缩减历史时的放大系数（本地估算本身偏低，多留余量）
+CONTEXT_OVERFLOW_SAFETY_RATIO = 1.2
+
+# 服务商没有报告超出量时，保留已发送历史的比例
+CONTEXT_OVERFLOW_SHRINK_FACTOR = 0.6
+
+# 输出格式不被支持时服务商错误信息中的关键字
+RESPONSE_FORMAT_ERROR_MARKERS = ("response_format", "json_schema", "json_object")
+
+# 回复因长度截断（finish_reason=length）时最多续写几轮
+CONTINUATION_MAX_ROUNDS = 2
+
+# 续写请求至少要有这么多输出预算，否则直接尝试本地修复
+CONTINUATION_MIN_OUTPUT_TOKENS = 256
+
+# 续写提示词
+CONTINUATION_PROMPT = (
+    "你的上一条回复因长度限制被截断。请从截断处继续输出剩余的 JSON，"
+    "不要重复已输出的内容，不要添加任何解释或代码块标记。"
+)
+
+# 出站请求优先级（数值越小越优先）：面向用户的咨询 / 后台摘要
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# 未指定会话时的排队标识
+DEFAULT_QUEUE_SESSION = "default"
+
+
+class StreamingFieldExtractor:
+    """
+    增量解析流式 JSON，提取顶层字符串字段的部分值。
+
+    每个字符只处理一次，不需要等完整 JSON 到达；
+    字段值跨分片、转义序列被切断都能正确拼接。
+    """
+
+    def __init__(self, fields: tuple[str, ...] = STREAM_PROGRESS_FIELDS):
+        self.fields = set(fields)
+        self._values: dict[str, list[str]] = {}
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode_digits: str | None = None
+        self._expect_key = False
+        self._string_is_key = False
+        self._key_chars: list[str] = []
+        self._last_key: str | None = None
+        self._capture: list[str] | None = None
+        self.captured_chars = 0
+
+    def feed(self, text: str):
+        """消费一段新到达的文本。"""
+        for ch in text:
+            if self._in_string:
+                self._feed_string_char(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_is_key = self._depth == 1 and self._expect_key
+                self._key_chars = []
+                self._capture = None
+                if self._depth == 1 and not self._expect_key and self._last_key in self.fields:
+                    self._capture = self._values.setdefault(self._last_key, [])
+                    self._capture.clear()
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "{" and self._depth == 1:
+                    self._expect_key = True
+            elif ch in "}]":
+                self._depth -= 1
+            elif ch == "," and self._depth == 1:
+                self._expect_key = True
+            elif ch == ":" and self._depth == 1:
+                self._expect_key = False
+
+    def _feed_string_char(self, ch: str):
+        if self._unicode_digits is not None:
+            self._unicode_digits += ch
+            if len(self._unicode_digits) == 4:
+                try:
+                    self._append(chr(int(self._unicode_digits, 16)))
+                except ValueError:
+                    pass
+                self._unicode_digits = None
+            return
+
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode_digits = ""
+            else:
+                self._append(_JSON_ESCAPES.get(ch, ch))
+            return
+
+        if ch == "\\":
+            self._escape = True
+        elif ch == '"':
+            self._in_string = False
+            if self._string_is_key:
+                self._last_key = "".join(self._key_chars)
+            self._capture = None
+        else:
+            self._append(ch)
+
+    def _append(self, ch: str):
+        if self._string_is_key:
+            self._key_chars.append(ch)
+        elif self._capture is not None:
+            self._capture.append(ch)
+            self.captured_chars += 1
+
+    def snapshot(self) -> dict[str, str]:
+        """返回当前已提取到的部分字段。"""
+        return {field: "".join(chars) for field, chars in self._values.items()}
+
+
+class HistoryGroupCache:
+    """
+    历史条目 → 消息分组的 LRU 缓存。
+
+    以 entry_id（服务端写入历史时分配）为键，没有 entry_id 的旧条目退回内容哈希。
+    缓存值包含已构建的消息及其 token 数，max_message_tokens 变化时自动失效。
+    """
+
+    def __init__(self, max_entries: int = HISTORY_GROUP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._groups: OrderedDict[str, tuple[int, dict[str, object]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_key(entry: dict) -> str:
+        """计算历史条目的缓存键。"""
+        entry_id = entry.get("entry_id")
+        if entry_id:
+            return f"id:{entry_id}"
+
+        payload = json.dumps(entry, ensure_ascii=False, sort_keys=True, default=str)
+        return "sha1:" + hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, max_message_tokens: int) -> dict[str, object] | None:
+        cached = self._groups.get(key)
+        if cached is None or cached[0] != max_message_tokens:
+            self.misses += 1
+            return None
+
+        self._groups.move_to_end(key)
+        self.hits += 1
+        return cached[1]
+
+    def put(self, key: str, max_message_tokens: int, group: dict[str, object]):
+        self._groups[key] = (max_message_tokens, group)
+        self._groups.move_to_end(key)
+        while len(self._groups) > self.max_entries:
+            self._groups.popitem(last=False)
+
+    def invalidate(self, entries: list[dict] | None = None):
+        """丢弃指定条目的缓存；entries 为 None 时清空全部。"""
+        if entries is None:
+            self._groups.clear()
+            return
+
+        for entry in entries:
+            self._groups.pop(self.entry_key(entry), None)
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+
+_history_group_cache = HistoryGroupCache()
+
+
+def invalidate_history_cache(entries: list[dict] | None = None):
+    """历史被清空或压缩后，释放对应条目的消息分组缓存。"""
+    _history_group_cache.invalidate(entries)
+
+
+class OutboundScheduler:
+    """
+    出站请求调度器：全局在途上限 + 按会话公平排队 + 优先级通道。
+
+    名额用满后新请求进入对应优先级的队列；释放名额时先服务优先级最高的通道，
+    通道内按会话轮转，每个会话每轮只放行一个请求，
+    一个会话连发的 report_progress 不会饿死其他会话。
+    只在单个事件循环内使用，调度过程中没有 await，不需要加锁。
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.in_flight = 0
+        # 优先级 → (会话 → 等待者队列)，OrderedDict 的顺序即轮转顺序
+        self._lanes: dict[int, OrderedDict[str, deque[asyncio.Future]]] = {}
+
+    def queued(self) -> int:
+        return sum(len(waiters) for lane in self._lanes.values() for waiters in lane.values())
+
+    async def acquire(self, session_id: str | None = None, priority: int = PRIORITY_INTERACTIVE) -> float:
         """
-        初始化AI客户端
+        占用一个在途名额，必要时排队。
+
+        Returns:
+            排队等待的秒数
         """
-        config = get_aurai_config()
-        self.config = config
-        self._init_client()
+        if self.in_flight < self.max_in_flight and not self.queued():
+            self.in_flight += 1
+            return 0.0
 
-    def _init_client(self):
-        """初始化 OpenAI 兼容客户端"""
-        if not self.config.api_key:
-            raise ValueError("未设置AURAI_API_KEY环境变量")
-        if not self.config.base_url:
-            raise ValueError("未设置AURAI_BASE_URL环境变量")
+        started_at = time.monotonic()
+        session_key = session_id or DEFAULT_QUEUE_SESSION
+        waiter = asyncio.get_running_loop().create_future()
+        lane = self._lanes.setdefault(priority, OrderedDict())
+        lane.setdefault(session_key, deque()).append(waiter)
 
-        from openai import OpenAI
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 名额已分配但调用方被取消：转交给下一位
+                self.release()
+            else:
+                self._remove_waiter(priority, session_key, waiter)
+            raise
+        return time.monotonic() - started_at
+
+    def release(self):
+        """归还名额并放行排队中的下一个请求。"""
+        self.in_flight = max(self.in_flight - 1, 0)
+        self._dispatch()
+
+    def _remove_waiter(self, priority: int, session_key: str, waiter: asyncio.Future):
+        lane = self._lanes.get(priority)
+        waiters = lane.get(session_key) if lane else None
+        if not waiters:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            return
+        if not waiters:
+            del lane[session_key]
+
+    def _next_waiter(self) -> asyncio.Future | None:
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            while lane:
+                session_key, waiters = next(iter(lane.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    lane.move_to_end(session_key)
+                else:
+                    del lane[session_key]
+                if not waiter.done():
+                    return waiter
+        return None
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queued": self.queued(),
+        }
+
+
+def _is_retryable_error(exc: BaseException) -> bool:
+    """
+    判断请求异常是否值得重试。
+
+    429、408/409、5xx、超时和连接失败是暂时性的；
+    其余状态码（401 密钥错误、400 请求格式错误等）重试也不会成功。
+    """
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+
+    status_code = getattr(exc, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+
+    try:
+        import openai
+
+        if isinstance(exc, openai.APIConnectionError):
+            return True
+    except ImportError:
+        pass
+
+    try:
         import httpx
 
-        # 创建带有超时配置的HTTP客户端
-        http_client = httpx.Client(
-            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=DEFAULT_TIMEOUT)
-        )
+        if isinstance(exc, httpx.TransportError):
+            return True
+    except ImportError:
+        pass
+
+    return False
 
-        self._client = OpenAI(
-            api_key=self.config.api_key,
-            base_url=self.config.base_url,
-            http_client=http_client
-        )
-        logger.info(f"OpenAI兼容客户端已初始化，Base URL: {self.config.base_url}，模型: {self.config.model}，超时: {HTTP_TIMEOUT}s")
 
-    def _split_file_content(self, file_path: str, content: str) -> list[str]:
+def _is_endpoint_failure(exc: BaseException) -> bool:
+    """判断异常是否应计入端点的健康检查（暂时性错误，或该端点的密钥/模型不可用）。"""
+    if _is_retryable_error(exc):
+        return True
+    return getattr(exc, "status_code", None) in ENDPOINT_FAILURE_STATUS_CODES
+
+
+def _error_text(exc: BaseException) -> str:
+    """拼接异常信息、错误码和响应体，用于按关键字识别错误类型。"""
+    body = getattr(exc, "body", None)
+    return " ".join(
+        str(part)
+        for part in (exc, getattr(exc, "code", None), json.dumps(body, ensure_ascii=False, default=str) if body else None)
+        if part
+    )
+
+
+def _is_response_format_rejection(exc: BaseException) -> bool:
+    """判断请求是否因 response_format 不被支持而被拒绝。"""
+    if getattr(exc, "status_code", None) not in CONTEXT_OVERFLOW_STATUS_CODES:
+        return False
+    lowered = _error_text(exc).lower()
+    return any(marker in lowered for marker in RESPONSE_FORMAT_ERROR_MARKERS)
+
+
+def _context_overflow_tokens(exc: BaseException) -> int | None:
+    """
+    判断异常是否为上下文超长错误。
+
+    Returns:
+        None 表示不是上下文超长；否则返回服务商报告的超出 tokens 数（无法解析时为 0）
+    """
+    if getattr(exc, "status_code", None) not in CONTEXT_OVERFLOW_STATUS_CODES:
+        return None
+
+    text = _error_text(exc)
+    lowered = text.lower()
+    if not any(marker in lowered for marker in CONTEXT_OVERFLOW_MARKERS):
+        return None
+
+    limit_match = _CONTEXT_LIMIT_PATTERN.search(text)
+    requested_match = _CONTEXT_REQUESTED_PATTERN.search(text)
+    if limit_match and requested_match:
+        return max(int(requested_match.group(1)) - int(limit_match.group(1)), 0)
+
+    comparison_match = _CONTEXT_COMPARISON_PATTERN.search(text)
+    if comparison_match:
+        return max(int(comparison_match.group(1)) - int(comparison_match.group(2)), 0)
+    return 0
+
+
+def _merge_continuation(content: str, continuation: str) -> str:
+    """拼接续写内容；模型从头重新输出了完整 JSON 时直接采用新的回复。"""
+    piece = continuation.lstrip()
+    if piece.startswith("```"):
+        piece = strip_code_fence(piece)
+        if piece.startswith("{"):
+            try:
+                json.loads(piece)
+                return piece
+            except json.JSONDecodeError:
+                pass
+        return content + piece
+    if piece.startswith("{"):
+        try:
+            json.loads(strip_code_fence(piece))
+            return piece
+        except json.JSONDecodeError:
+            pass
+    return content + continuation
+
+
+def _extract_usage(usage) -> dict[str, int | None] | None:
+    """
+    把服务商返回的 usage 对象整理为 prompt/completion/total tokens 字典。
+
+    cached_tokens 取自 usage.prompt_tokens_details（命中提示词前缀缓存的输入 tokens），
+    服务商不报告时为 None。
+    """
+    if usage is None:
+        return None
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    total_tokens = getattr(usage, "total_tokens", None)
+    if total_tokens is None and prompt_tokens is not None and completion_tokens is not None:
+        total_tokens = prompt_tokens + completion_tokens
+    if total_tokens is None:
+        return None
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        cached_tokens = details.get("cached_tokens")
+    else:
+        cached_tokens = getattr(details, "cached_tokens", None)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "cached_tokens": cached_tokens,
+    }
+
+
+def _retry_after_seconds(exc: BaseException) -> float | None:
+    """从异常携带的响应头中解析 Retry-After（支持秒数、HTTP 日期和 retry-after-ms）。"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(float(retry_after_ms) / 1000, 0.0)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def _compute_backoff(attempt: int, config) -> float:
+    """第 attempt 次失败后的退避时间：指数增长、封顶，再按 retry_jitter 随机缩短。"""
+    delay = min(config.retry_base_delay * (2 ** (attempt - 1)), config.retry_max_delay)
+    return delay * (1 - config.retry_jitter * random.random())
+
+
+def uses_single_source_history(config) -> bool:
+    """
+    对话历史是否只通过历史消息发送一次（当前问题的提示词中只保留引用）。
+
+    history_rendering=single 或开启前缀缓存友好布局时成立。
+    """
+    return (
+        getattr(config, "history_rendering", "inline") == "single"
+        or getattr(config, "prompt_cache_layout", False)
+    )
+
+
+class HistoryMessageBuilder:
+    """
+    历史消息构建与上下文预算计算。
+
+    只依赖模型配置、不持有网络连接，服务端也可以直接用它估算历史占用的 token，
+    AuraiClient 在此基础上负责实际请求。
+    """
+
+    # 为 None 时使用全局校准器（get_token_calibrator）
+    token_calibrator: TokenCalibrator | None = None
+
+    def __init__(self, config):
+        self.config = config
+
+    @property
+    def calibrator(self) -> TokenCalibrator:
+        return self.token_calibrator or get_token_calibrator()
+
+    @property
+    def tokenizer(self) -> Tokenizer:
+        """当前模型的分词器：配置了本地词表时精确计数，否则为字符数估算。"""
+        return get_tokenizer(getattr(self.config, "model", ""), getattr(self.config, "tokenizer_files", None))
+
+    def _calibration_key(self) -> tuple[str, str, int]:
+        """分组缓存中 token 数对应的计数方式（模型, 分词器, 校准版本）。"""
+        return getattr(self.config, "model", ""), self.tokenizer.name, self.calibrator.version
+
+    def count_text_tokens(self, text: str) -> int:
+        """按当前模型的分词器计算文本的 token 数。"""
+        return self.tokenizer.count(text)
+
+    def _split_file_content(self, file_path: str, content: str) -> list[FileChunk]:
         """
         拆分大文件内容为多个片段，确保每个片段不超过 max_message_tokens
 
+        切分点落在行边界上，并尽量落在代码结构（Python 顶层 def/class、
+        C 系语言的花括号块）的边界上；片段大小按当前分词器计数，每段带有起止行号。
+
         Args:
             file_path: 文件路径
             content: 文件内容
@@ -59,38 +599,235 @@ class AuraiClient:
         max_tokens = self.config.max_message_tokens
 
         # 估算内容 token 数
-        content_tokens = estimate_tokens(content)
+        content_tokens = self.count_text_tokens(content)
 
         # 如果内容不大，直接返回
         if content_tokens <= max_tokens:
-            return [content]
+            return [FileChunk(content, 1, max(len(content.splitlines()), 1))]
 
         # 需要拆分
         logger.info(f"文件 {file_path} 内容过大（约 {content_tokens} tokens），将拆分为多个片段")
-
-        chunks = []
-        # 按字符数大致拆分（粗略估算）
-        # 假设平均每个 token 约 3 字符
-        target_chars = max_tokens * 3
-
-        for i in range(0, len(content), target_chars):
-            chunk = content[i:i + target_chars]
-            chunks.append(chunk)
-            logger.debug(f"  片段 {len(chunks)}: 约 {estimate_tokens(chunk)} tokens")
-
+        chunks = split_into_chunks(file_path, content, max_tokens, self.count_text_tokens)
         logger.info(f"文件 {file_path} 已拆分为 {len(chunks)} 个片段")
         return chunks
 
+    def _message_features(self, message: dict[str, str]) -> tuple[TokenFeatures, int]:
+        """单条消息的估算特征：(内容的中文/英文/代码部分, 角色与协议开销)。"""
+        return text_features(message.get("content", "")), message_overhead(message)
+
     def _estimate_message_tokens(self, message: dict[str, str]) -> int:
-        """估算单条消息的 token 数量，额外计入角色与协议开销。"""
-        content = message.get("content", "")
-        role = message.get("role", "")
-        return estimate_tokens(content) + estimate_tokens(role) + 6
+        """
+        估算单条消息的 token 数量，额外计入角色与协议开销。
+
+        配置了本地词表时按词表精确计数，否则按模型的校准系数修正字符数估算。
+        """
+        tokenizer = self.tokenizer
+        if tokenizer.exact:
+            return tokenizer.count(message.get("content", "")) + message_overhead(message)
+        features, overhead = self._message_features(message)
+        return self.calibrator.estimate_message(features, overhead, getattr(self.config, "model", ""))
 
     def _estimate_messages_tokens(self, messages: list[dict[str, str]]) -> int:
         """估算多条消息的总 token 数量。"""
         return sum(self._estimate_message_tokens(message) for message in messages)
 
+    def _load_sync_file_contents(self, turn: dict) -> dict[str, str]:
+        """
+        读取 sync_context 记录中的文件内容。
+
+        新记录只保存 blob 引用（file_refs），在这里按需从 blob 存储读取；
+        旧记录的内联 file_contents 原样使用。
+        """
+        file_contents = dict(turn.get("file_contents") or {})
+        file_refs = turn.get("file_refs") or {}
+        if file_refs:
+            blob_store = get_blob_store()
+            for file_path, ref in file_refs.items():
+                content = blob_store.get(ref)
+                if content is None:
+                    logger.warning("文件 %s 的内容已不在 blob 存储中: %s", file_path, ref)
+                    content = f"[文件内容缺失: {ref}]"
+                file_contents[file_path] = content
+        return file_contents
+
+    def _build_outline_messages(
+        self,
+        file_path: str,
+        content: str,
+        mentions: SymbolMentions | None,
+    ) -> list[dict[str, str]] | None:
+        """
+        大纲模式：超过 outline_threshold_tokens 的代码文件只发送大纲，再附上顾问点名的符号的完整代码。
+
+        不支持的文件类型、未超过阈值或大纲节省不到一半时返回 None（照常发送全文）。
+        """
+        threshold = getattr(self.config, "outline_threshold_tokens", 0)
+        if not threshold:
+            return None
+        content_tokens = self.count_text_tokens(content)
+        if content_tokens <= threshold:
+            return None
+        outline = get_file_outline(file_path, content)
+        if outline is None or self.count_text_tokens(outline.text) * 2 > content_tokens:
+            return None
+
+        expanded = mentions.symbols_for(file_path, outline) if mentions else []
+        logger.info(
+            "文件 %s 约 %s tokens，发送大纲（%s 个符号，展开 %s 个）",
+            file_path,
+            content_tokens,
+            len(outline.symbols),
+            len(expanded),
+        )
+
+        messages = []
+        chunks = self._split_file_content(f"{file_path}.outline", outline.text)
+        for idx, chunk in enumerate(chunks):
+            total = len(chunks)
+            part = "" if total == 1 else f" ({idx + 1}/{total})"
+            messages.append({
+                "role": "system",
+                "content": (
+                    f"## 已上传文件（大纲）{part}\n\n"
+                    f"### 文件: {file_path}（共 {outline.line_count} 行，只发送了导入、类/函数签名和文档字符串，"
+                    f"左侧为原文件行号）\n"
+                    "需要某个函数或类的完整实现时，在 questions 或 code_changes 中写出它的名字，下一轮会附上完整代码。\n"
+                    f"```\n{chunk.text}\n```"
+                ),
+            })
+
+        for symbol in expanded:
+            kind = "类" if symbol.kind == "class" else "函数"
+            chunks = self._split_file_content(outline.source_path, outline.source(symbol))
+            for idx, chunk in enumerate(chunks):
+                start_line = symbol.start_line + chunk.start_line - 1
+                end_line = symbol.start_line + chunk.end_line - 1
+                part = "" if len(chunks) == 1 else f" (第 {idx + 1}/{len(chunks)} 部分)"
+                messages.append({
+                    "role": "system",
+                    "content": (
+                        f"### 文件: {file_path} 中的{kind} {symbol.name}{part}（第 {start_line}-{end_line} 行）\n"
+                        f"```\n{chunk.text}\n```"
+                    ),
+                })
+        return messages
+
+    def _build_sync_sections(
+        self,
+        turn: dict,
+        mentions: SymbolMentions | None = None,
+    ) -> list[tuple[str, list[dict[str, str]]]]:
+        """
+        将 sync_context 记录转换为按内容来源划分的消息段。
+
+        开启大纲模式时，大文件按 _build_outline_messages 发送，mentions 中点名的符号展开完整代码。
+
+        Returns:
+            [(段标识, 消息列表)]，项目背景的段标识为 PROJECT_INFO_SECTION，文件为其路径
+        """
+        sections: list[tuple[str, list[dict[str, str]]]] = []
+
+        project_info = turn.get("project_info", {})
+        if project_info:
+            project_info_text = json.dumps(project_info, ensure_ascii=False, indent=2, default=str)
+            chunks = self._split_file_content("project_info.json", project_info_text)
+
+            messages = []
+            for idx, chunk in enumerate(chunks):
+                total = len(chunks)
+                if total == 1:
+                    header = "## 已同步项目背景\n"
+                else:
+                    header = f"## 已同步项目背景 ({idx + 1}/{total})\n"
+
+                messages.append({
+                    "role": "system",
+                    "content": header + f"```json\n{chunk.text}\n```"
+                })
+            sections.append((PROJECT_INFO_SECTION, messages))
+
+        file_contents = self._load_sync_file_contents(turn)
+        for file_path, content in file_contents.items():
+            outline_messages = self._build_outline_messages(file_path, content, mentions)
+            if outline_messages is not None:
+                sections.append((file_path, outline_messages))
+                continue
+
+            chunks = self._split_file_content(file_path, content)
+
+            messages = []
+            for idx, chunk in enumerate(chunks):
+                total = len(chunks)
+                if total == 1:
+                    header = f"## 已上传文件\n\n### 文件: {file_path}\n"
+                else:
+                    header = (
+                        f"## 已上传文件 ({idx + 1}/{total})\n\n"
+                        f"### 文件: {file_path} (第 {idx + 1}/{total} 部分，"
+                        f"第 {chunk.start_line}-{chunk.end_line} 行)\n"
+                    )
+
+                messages.append({
+                    "role": "system",
+                    "content": header + f"```\n{chunk.text}\n```"
+                })
+            sections.append((file_path, messages))
+
+        return sections
+
+    def _build_turn_messages(self, turn: dict, single_source: bool = False) -> list[dict[str, str]]:
+        """
+        将单条历史记录转换为消息列表（不含缓存逻辑）。
+
+        single_source 为 True 时进度报告也转换为消息（否则它只出现在当前问题的提示词里）。
+        """
+        group_messages: list[dict[str, str]] = []
+
+        if turn.get("type") == "summary":
+            summary_text = turn.get("summary_text")
+            if summary_text:
+                group_messages.append({
+                    "role": "system",
+                    "content": "## 历史摘要\n" + summary_text,
+                })
+
+        elif turn.get("type") == "sync_context":
+            for _, section_messages in self._build_sync_sections(turn):
+                group_messages.extend(section_messages)
+
+        elif turn.get("type") == "progress":
+            if single_source:
+                user_lines = [
+                    "进度报告",
+                    f"执行操作: {turn.get('actions_taken', '')}",
+                    f"执行结果: {turn.get('result', '')}",
+                ]
+                if turn.get("new_error"):
+                    user_lines.append(f"新错误: {turn['new_error']}")
+                if turn.get("feedback"):
+                    user_lines.append(f"反馈: {turn['feedback']}")
+                group_messages.append({"role": "user", "content": "\n".join(user_lines)})
+
+                # 与提示词中的进度记录一致，只保留顾问的指导
+                guidance = turn.get("response", {}).get("guidance")
+                if guidance:
+                    group_messages.append({"role": "assistant", "content": f"指导: {guidance}"})
+
+        else:
+            if turn.get("type") == "consult":
+                user_content = f"问题类型: {turn.get('problem_type')}\n错误描述: {turn.get('error_message')}"
+            else:
+                user_content = "未知操作"
+
+            group_messages.append({"role": "user", "content": user_content})
+
+            response = turn.get("response", {})
+            if response.get("analysis") or response.get("guidance"):
+                assistant_content = f"分析: {response.get('analysis', '')}\n指导: {response.get('guidance', '')}"
+                group_messages.append({"role": "assistant", "content": assistant_content})
+
+        return group_messages
+
     def _build_message_groups_from_history(
         self,
         conversation_history: list[dict] | None,
@@ -98,118 +835,133 @@ class AuraiClient:
         """
         将对话历史转换为按轮次分组的消息列表。
 
+        每个分组连同其 token 数一起缓存在 _history_group_cache 中，
+        之后的轮次只需为新增条目构建消息、估算 token。
+
         Args:
             conversation_history: 对话历史列表
 
         Returns:
-            转换后的消息分组列表
+            转换后的消息分组列表，每组包含 type / messages / tokens / message_tokens；
+            sync_context 分组还包含 sections；
+            使用字符数估算时还包含用于按校准系数重算 token 数的 message_features
         """
         if not conversation_history:
             return []
 
         groups: list[dict[str, object]] = []
+        max_message_tokens = self.config.max_message_tokens
+        calibration_key = self._calibration_key()
+        single_source = uses_single_source_history(self.config)
+        outline_threshold = getattr(self.config, "outline_threshold_tokens", 0)
+        # 大纲模式下，顾问在历史回复中点名的符号需要展开
+        mentions = SymbolMentions.from_history(conversation_history) if outline_threshold else None
 
         for turn in conversation_history:
-            group_messages: list[dict[str, str]] = []
-
-            if turn.get("type") == "summary":
-                summary_text = turn.get("summary_text")
-                if summary_text:
-                    group_messages.append({
-                        "role": "system",
-                        "content": "## 历史摘要\n" + summary_text,
-                    })
-
-            elif turn.get("type") == "sync_context":
-                project_info = turn.get("project_info", {})
-                if project_info:
-                    project_info_text = json.dumps(project_info, ensure_ascii=False, indent=2, default=str)
-                    chunks = self._split_file_content("project_info.json", project_info_text)
-
-                    for idx, chunk in enumerate(chunks):
-                        total = len(chunks)
-                        if total == 1:
-                            header = "## 已同步项目背景\n"
-                        else:
-                            header = f"## 已同步项目背景 ({idx + 1}/{total})\n"
-
-                        group_messages.append({
-                            "role": "system",
-                            "content": header + f"```json\n{chunk}\n```"
-                        })
-
-                file_contents = turn.get("file_contents", {})
-                if file_contents:
-                    for file_path, content in file_contents.items():
-                        chunks = self._split_file_content(file_path, content)
-
-                        for idx, chunk in enumerate(chunks):
-                            total = len(chunks)
-                            if total == 1:
-                                header = f"## 已上传文件\n\n### 文件: {file_path}\n"
-                            else:
-                                header = f"## 已上传文件 ({idx + 1}/{total})\n\n### 文件: {file_path} (第 {idx + 1}/{total} 部分)\n"
-
-                            group_messages.append({
-                                "role": "system",
-                                "content": header + f"```\n{chunk}\n```"
-                            })
-
-            elif turn.get("type") == "progress":
-                continue
-
-            else:
-                if turn.get("type") == "consult":
-                    user_content = f"问题类型: {turn.get('problem_type')}\n错误描述: {turn.get('error_message')}"
+            cache_key = HistoryGroupCache.entry_key(turn)
+            if single_source and turn.get("type") == "progress":
+                # 进度报告在两种发送方式下的消息不同，分开缓存
+                cache_key += ":single"
+            if mentions is not None and turn.get("type") == "sync_context":
+                # 同步记录的消息取决于阈值和点名的符号
+                cache_key += f":outline:{outline_threshold}:{mentions.key()}"
+            group = _history_group_cache.get(cache_key, max_message_tokens)
+
+            if group is None:
+                sections = None
+                if turn.get("type") == "sync_context":
+                    sections = self._build_sync_sections(turn, mentions)
+                    group_messages = [message for _, messages in sections for message in messages]
                 else:
-                    user_content = "未知操作"
-
-                group_messages.append({"role": "user", "content": user_content})
-
-                response = turn.get("response", {})
-                if response.get("analysis") or response.get("guidance"):
-                    assistant_content = f"分析: {response.get('analysis', '')}\n指导: {response.get('guidance', '')}"
-                    group_messages.append({"role": "assistant", "content": assistant_content})
-
-            if group_messages:
-                groups.append({
+                    group_messages = self._build_turn_messages(turn, single_source)
+                group = {
                     "type": turn.get("type", "unknown"),
                     "messages": group_messages,
-                })
+                }
+                if sections is not None:
+                    # 各段（项目背景 / 单个文件）的标识与消息条数，供前缀缓存友好布局按文件重排
+                    group["sections"] = [(key, len(messages)) for key, messages in sections]
+                self._apply_calibration(group, calibration_key)
+                _history_group_cache.put(cache_key, max_message_tokens, group)
+            elif group.get("calibration") != calibration_key:
+                # 分词器或校准系数变化：只需重算 token 数，不必重建消息
+                self._apply_calibration(group, calibration_key)
+
+            if group["messages"]:
+                groups.append(group)
 
         return groups
 
+    def _apply_calibration(self, group: dict[str, object], calibration_key: tuple[str, str, int]):
+        """按当前分词器和校准系数计算分组的 token 数。"""
+        tokenizer = self.tokenizer
+        if tokenizer.exact:
+            message_tokens = [
+                tokenizer.count(message.get("content", "")) + message_overhead(message)
+                for message in group["messages"]
+            ]
+        else:
+            if "message_features" not in group:
+                group["message_features"] = [self._message_features(message) for message in group["messages"]]
+            model = calibration_key[0]
+            message_tokens = [
+                self.calibrator.estimate_message(features, overhead, model)
+                for features, overhead in group["message_features"]
+            ]
+        group["tokens"] = sum(message_tokens)
+        group["message_tokens"] = message_tokens
+        group["calibration"] = calibration_key
+
+    def estimate_entry_tokens(self, entry: dict) -> int:
+        """估算单条历史记录转换为消息后的 token 数（复用消息分组缓存）。"""
+        groups = self._build_message_groups_from_history([entry])
+        return sum(self._group_tokens(group) for group in groups)
+
+    def _group_tokens(self, group: dict[str, object]) -> int:
+        """获取消息分组的 token 数，优先使用缓存值。"""
+        tokens = group.get("tokens")
+        if tokens is None:
+            tokens = self._estimate_messages_tokens(group["messages"])
+        return tokens
+
     def _truncate_messages_to_budget(
         self,
         messages: list[dict[str, str]],
         budget: int,
-    ) -> list[dict[str, str]]:
+        message_tokens: list[int] | None = None,
+    ) -> tuple[list[dict[str, str]], int]:
         """
         在预算内尽量保留一组消息的前半部分。
 
         对于超大的文件同步记录，这比整组丢弃更实用，至少能保住项目背景和开头内容。
+
+        Returns:
+            (保留的消息, 保留部分的 token 数)
         """
         if budget <= 0:
-            return []
+            return [], 0
 
         selected: list[dict[str, str]] = []
         used_tokens = 0
 
-        for message in messages:
-            message_tokens = self._estimate_message_tokens(message)
-            if used_tokens + message_tokens > budget:
+        for index, message in enumerate(messages):
+            if message_tokens is not None:
+                tokens = message_tokens[index]
+            else:
+                tokens = self._estimate_message_tokens(message)
+            if used_tokens + tokens > budget:
                 break
 
             selected.append(message)
-            used_tokens += message_tokens
+            used_tokens += tokens
 
-        return selected
+        return selected, used_tokens
 
-    def _select_history_messages_within_budget(
+    def _select_history_within_budget(
         self,
         history_groups: list[dict[str, object]],
         budget: int,
-    ) -> tuple[list[dict[str, str]], bool]:
+    ) -> tuple[list[dict[str, str]], bool, int]:
         """
         在预算内挑选历史消息。
 
@@ -217,12 +969,16 @@ class AuraiClient:
         1. 优先保留最近一次 sync_context，避免文件上下文先被挤掉；
         2. 再按时间倒序保留其他完整轮次；
         3. 如果最近一次 sync_context 太大，允许保留其前半部分。
+
+        Returns:
+            (选中的消息, 是否发生裁剪, 选中消息的 token 数)
         """
         if budget <= 0 or not history_groups:
-            return [], bool(history_groups)
+            return [], bool(history_groups), 0
 
         selected_by_index: dict[int, list[dict[str, str]]] = {}
         trimmed = False
+        used_tokens = 0
 
         latest_sync_index = None
         for index in range(len(history_groups) - 1, -1, -1):
@@ -231,17 +987,24 @@ class AuraiClient:
                 break
 
         if latest_sync_index is not None:
-            latest_sync_messages = history_groups[latest_sync_index]["messages"]
-            latest_sync_tokens = self._estimate_messages_tokens(latest_sync_messages)
+            latest_sync_group = history_groups[latest_sync_index]
+            latest_sync_messages = latest_sync_group["messages"]
+            latest_sync_tokens = self._group_tokens(latest_sync_group)
 
             if latest_sync_tokens <= budget:
                 selected_by_index[latest_sync_index] = latest_sync_messages
                 budget -= latest_sync_tokens
+                used_tokens += latest_sync_tokens
             else:
-                truncated_messages = self._truncate_messages_to_budget(latest_sync_messages, budget)
+                truncated_messages, truncated_tokens = self._truncate_messages_to_budget(
+                    latest_sync_messages,
+                    budget,
+                    latest_sync_group.get("message_tokens"),
+                )
                 if truncated_messages:
                     selected_by_index[latest_sync_index] = truncated_messages
-                    budget -= self._estimate_messages_tokens(truncated_messages)
+                    budget -= truncated_tokens
+                    used_tokens += truncated_tokens
                 trimmed = True
 
         for index in range(len(history_groups) - 1, -1, -1):
@@ -249,11 +1012,12 @@ class AuraiClient:
                 continue
 
             group_messages = history_groups[index]["messages"]
-            group_tokens = self._estimate_messages_tokens(group_messages)
+            group_tokens = self._group_tokens(history_groups[index])
 
             if group_tokens <= budget:
                 selected_by_index[index] = group_messages
                 budget -= group_tokens
+                used_tokens += group_tokens
             else:
                 trimmed = True
 
@@ -263,52 +1027,323 @@ class AuraiClient:
             if group_messages:
                 selected_messages.extend(group_messages)
 
+        return selected_messages, trimmed, used_tokens
+
+    def _select_history_cache_friendly(
+        self,
+        history_groups: list[dict[str, object]],
+        budget: int,
+    ) -> tuple[list[dict[str, str]], bool, int]:
+        """
+        按前缀缓存友好的布局挑选历史消息。
+
+        布局：先是固定的已同步文件（同一文件只取最近一次同步的内容，项目背景在前，
+        其余按路径排序），再是按时间正序的滚动轮次（摘要、咨询）。
+        只要同步的文件不变，每次请求的前缀（系统提示词 + 固定文件）就逐字节一致，
+        服务商的提示词前缀缓存可以命中。
+
+        预算不足时先按规范顺序保留固定文件，再从最近的轮次往前保留连续的一段。
+
+        Returns:
+            (选中的消息, 是否发生裁剪, 选中消息的 token 数)
+        """
+        if budget <= 0 or not history_groups:
+            return [], bool(history_groups), 0
+
+        pinned: dict[str, tuple[list[dict[str, str]], list[int]]] = {}
+        rolling: list[dict[str, object]] = []
+        for group in history_groups:
+            sections = group.get("sections")
+            if sections is None:
+                rolling.append(group)
+                continue
+
+            messages = group["messages"]
+            message_tokens = group.get("message_tokens")
+            if message_tokens is None:
+                message_tokens = [self._estimate_message_tokens(message) for message in messages]
+            start = 0
+            for key, count in sections:
+                pinned[key] = (messages[start:start + count], message_tokens[start:start + count])
+                start += count
+
+        selected_messages: list[dict[str, str]] = []
+        trimmed = False
+        used_tokens = 0
+
+        for key in sorted(pinned, key=lambda section: (section != PROJECT_INFO_SECTION, section)):
+            messages, message_tokens = pinned[key]
+            kept, kept_tokens = self._truncate_messages_to_budget(messages, budget - used_tokens, message_tokens)
+            selected_messages.extend(kept)
+            used_tokens += kept_tokens
+            if len(kept) < len(messages):
+                trimmed = True
+                break
+
+        kept_groups: list[dict[str, object]] = []
+        for group in reversed(rolling):
+            group_tokens = self._group_tokens(group)
+            if used_tokens + group_tokens > budget:
+                trimmed = True
+                break
+            kept_groups.append(group)
+            used_tokens += group_tokens
+
+        for group in reversed(kept_groups):
+            selected_messages.extend(group["messages"])
+
+        return selected_messages, trimmed, used_tokens
+
+    def _update_relevance_index(self, history_groups: list[dict[str, object]], index: BM25Index):
+        """
+        让索引与历史中的已同步片段保持一致：只为新出现的片段分词，删除已不在历史中的片段。
+
+        每个片段（一条消息）以内容哈希为文档标识，哈希随分组一起缓存。
+        """
+        present: set[str] = set()
+        for group in history_groups:
+            if group.get("sections") is None:
+                continue
+            doc_ids = group.get("doc_ids")
+            if doc_ids is None:
+                doc_ids = [
+                    hashlib.sha1(message.get("content", "").encode("utf-8")).hexdigest()
+                    for message in group["messages"]
+                ]
+                group["doc_ids"] = doc_ids
+            for doc_id, message in zip(doc_ids, group["messages"]):
+                present.add(doc_id)
+                index.add(doc_id, message.get("content", ""))
+        index.retain(present)
+
+    def index_session_history(self, conversation_history: list[dict] | None, session_id: str) -> BM25Index:
+        """同步文件后更新会话的相关度索引（之后的请求只需处理新增片段）。"""
+        index = get_session_index(session_id)
+        self._update_relevance_index(self._build_message_groups_from_history(conversation_history), index)
+        return index
+
+    def _score_history_chunks(
+        self,
+        history_groups: list[dict[str, object]],
+        query: str,
+        session_id: str,
+    ) -> dict[int, list[float]]:
+        """
+        用 BM25 为已同步的各片段打分。
+
+        Returns:
+            {分组下标: 该分组各条消息的得分}，只包含 sync_context 分组
+        """
+        index = get_session_index(session_id)
+        self._update_relevance_index(history_groups, index)
+        scores = index.score(query)
+        return {
+            group_index: [scores.get(doc_id, 0.0) for doc_id in group["doc_ids"]]
+            for group_index, group in enumerate(history_groups)
+            if group.get("sections") is not None
+        }
+
+    def _select_history_by_relevance(
+        self,
+        history_groups: list[dict[str, object]],
+        budget: int,
+        chunk_scores: dict[int, list[float]],
+    ) -> tuple[list[dict[str, str]], bool, int]:
+        """
+        按与当前问题的相关度挑选历史消息。
+
+        相关度只调整文件片段之间的先后，不让旧轮次挤掉最近一次同步的文件。装填顺序：
+        1. 最近一次同步的项目背景；
+        2. 与当前问题相关（得分 > 0）的文件片段，得分高的优先；
+        3. 最近一次同步的其余片段；
+        4. 其他轮次（摘要、咨询、进度）和更早同步的片段，按时间倒序；
+        5. 已被重新同步覆盖的旧版本文件放在最后。
+
+        放不下的单元跳过，继续尝试更小的；选中的消息按原来的时间顺序输出。
+
+        Returns:
+            (选中的消息, 是否发生裁剪, 选中消息的 token 数)
+        """
+        if budget <= 0 or not history_groups:
+            return [], bool(history_groups), 0
+
+        latest_section_group: dict[str, int] = {}
+        latest_sync_index = None
+        for group_index, group in enumerate(history_groups):
+            for key, _ in group.get("sections") or []:
+                latest_section_group[key] = group_index
+            if group.get("sections") is not None:
+                latest_sync_index = group_index
+
+        # 装填单元：(优先级, 排序键, 分组下标, 消息下标或 None 表示整组, token 数)
+        units: list[tuple[int, tuple, int, int | None, int]] = []
+        for group_index, group in enumerate(history_groups):
+            sections = group.get("sections")
+            if sections is None:
+                units.append((3, (-group_index, 0), group_index, None, self._group_tokens(group)))
+                continue
+
+            message_tokens = group.get("message_tokens")
+            if message_tokens is None:
+                message_tokens = [self._estimate_message_tokens(message) for message in group["messages"]]
+            scores = chunk_scores.get(group_index) or [0.0] * len(message_tokens)
+            message_index = 0
+            for key, count in sections:
+                superseded = latest_section_group.get(key) != group_index
+                for offset in range(count):
+                    position = message_index + offset
+                    if key == PROJECT_INFO_SECTION and group_index == latest_sync_index:
+                        priority, order = 0, (position,)
+                    elif scores[position] > 0 and not superseded:
+                        priority, order = 1, (-scores[position], -group_index, position)
+                    elif superseded:
+                        priority, order = 4, (-group_index, position)
+                    elif group_index == latest_sync_index:
+                        priority, order = 2, (position,)
+                    else:
+                        priority, order = 3, (-group_index, position)
+                    units.append((priority, order, group_index, position, message_tokens[position]))
+                message_index += count
+
+        selected: dict[int, set[int] | None] = {}
+        used_tokens = 0
+        trimmed = False
+        for _, _, group_index, position, tokens in sorted(units, key=lambda unit: (unit[0], unit[1])):
+            if used_tokens + tokens > budget:
+                trimmed = True
+                continue
+            used_tokens += tokens
+            if position is None:
+                selected[group_index] = None
+            else:
+                selected.setdefault(group_index, set()).add(position)
+
+        selected_messages: list[dict[str, str]] = []
+        for group_index, group in enumerate(history_groups):
+            if group_index not in selected:
+                continue
+            positions = selected[group_index]
+            selected_messages.extend(
+                message for position, message in enumerate(group["messages"])
+                if positions is None or position in positions
+            )
+
+        return selected_messages, trimmed, used_tokens
+
+    def _select_history_messages_within_budget(
+        self,
+        history_groups: list[dict[str, object]],
+        budget: int,
+    ) -> tuple[list[dict[str, str]], bool]:
+        """在预算内挑选历史消息，返回 (选中的消息, 是否发生裁剪)。"""
+        selected_messages, trimmed, _ = self._select_history_within_budget(history_groups, budget)
         return selected_messages, trimmed
 
+    def _compute_context_budgets(self, required_prompt_tokens: int) -> tuple[int, int, int]:
+        """
+        计算上下文预算。
+
+        优先保证输出预算 (max_tokens)；仅当必需消息本身就超过窗口时才缩减输出。
+
+        Returns:
+            (输出上限, 输入预算, 可分配给历史消息的预算)
+        """
+        output_budget = self.config.max_tokens
+        input_budget = max(self.config.context_window - output_budget, 1)
+
+        if required_prompt_tokens > input_budget:
+            available_output = max(self.config.context_window - required_prompt_tokens, 1)
+            output_budget = min(self.config.max_tokens, available_output)
+            input_budget = max(self.config.context_window - output_budget, 1)
+
+        history_budget = max(input_budget - required_prompt_tokens, 0)
+        return output_budget, input_budget, history_budget
+
+    def history_token_budget(self, required_prompt_tokens: int) -> int:
+        """给定必需消息（系统提示词 + 当前问题）的 token 数，返回历史消息可用的预算。"""
+        return self._compute_context_budgets(required_prompt_tokens)[2]
+
+    def _render_history_references(
+        self,
+        current_user_message: dict[str, str],
+        history_groups: list[dict[str, object]],
+        selected_messages: list[dict[str, str]] | None = None,
+    ) -> dict[str, str]:
+        """
+        把当前问题中的历史引用占位符替换为实际发送的历史说明。
+
+        selected_messages 为裁剪后保留的历史消息，只要保留了某轮的一部分就计入；为 None 时视为全部保留。
+        """
+        content = current_user_message.get("content", "")
+        if HISTORY_REFERENCES_PLACEHOLDER not in content:
+            return current_user_message
+
+        if selected_messages is None:
+            sent_types = [group["type"] for group in history_groups]
+        else:
+            selected_ids = {id(message) for message in selected_messages}
+            sent_types = [
+                group["type"] for group in history_groups
+                if any(id(message) in selected_ids for message in group["messages"])
+            ]
+        references = format_history_references(sent_types, omitted=len(history_groups) - len(sent_types))
+        return {**current_user_message, "content": content.replace(HISTORY_REFERENCES_PLACEHOLDER, references)}
+
     def _fit_messages_to_context_window(
         self,
         base_messages: list[dict[str, str]],
         history_groups: list[dict[str, object]],
         current_user_message: dict[str, str],
+        history_token_limit: int | None = None,
+        chunk_scores: dict[int, list[float]] | None = None,
     ) -> tuple[list[dict[str, str]], int, int, bool]:
         """
         将请求消息压进上下文窗口。
 
         优先保证输出预算 (max_tokens)，输入超限时裁剪历史。
         超过高水位线时触发预警 + 主动压缩历史。
+        开启 prompt_cache_layout 时按前缀缓存友好的布局排列历史（见 _select_history_cache_friendly）；
+        否则有片段与当前问题相关（chunk_scores 中有得分 > 0）时按相关度裁剪（见 _select_history_by_relevance），
+        没有任何片段命中时沿用默认策略。
+        history_token_limit 进一步限制历史预算（服务商报告上下文超长后重试时使用）。
+        当前问题中的历史引用占位符在裁剪后按实际保留的历史替换（预算按全部保留时的说明估算）。
 
         Returns:
             (最终消息列表, 估算输入 tokens, 实际输出上限, 是否触发水位线预警)
         """
+        pending_user_message = current_user_message
+        current_user_message = self._render_history_references(pending_user_message, history_groups)
         required_messages = [*base_messages, current_user_message]
         required_prompt_tokens = self._estimate_messages_tokens(required_messages)
-        output_budget = self.config.max_tokens
-        input_budget = max(self.config.context_window - output_budget, 1)
-
-        if required_prompt_tokens > input_budget:
-            available_output = max(self.config.context_window - required_prompt_tokens, 1)
-            output_budget = min(self.config.max_tokens, available_output)
-            input_budget = max(self.config.context_window - output_budget, 1)
-
-        history_budget = max(input_budget - required_prompt_tokens, 0)
-        selected_history_messages, history_trimmed = self._select_history_messages_within_budget(
+        output_budget, input_budget, history_budget = self._compute_context_budgets(required_prompt_tokens)
+        if history_token_limit is not None:
+            history_budget = min(history_budget, max(history_token_limit, 0))
+
+        select_history = self._select_history_within_budget
+        if getattr(self.config, "prompt_cache_layout", False):
+            select_history = self._select_history_cache_friendly
+        elif chunk_scores and max((score for scores in chunk_scores.values() for score in scores), default=0) > 0:
+            def select_history(groups, budget):
+                return self._select_history_by_relevance(groups, budget, chunk_scores)
+
+        selected_history_messages, history_trimmed, history_tokens = select_history(
             history_groups,
             history_budget,
         )
 
         final_messages = [*base_messages, *selected_history_messages, current_user_message]
-        prompt_tokens = self._estimate_messages_tokens(final_messages)
+        prompt_tokens = required_prompt_tokens + history_tokens
         watermark_hit = prompt_tokens >= input_budget * self.config.context_high_watermark
 
         if watermark_hit:
             # 超过高水位线：再压一轮历史，给输出腾空间
             tighter_budget = max(int(history_budget * 0.5), 0)
-            selected_history_messages, _ = self._select_history_messages_within_budget(
+            selected_history_messages, _, history_tokens = select_history(
                 history_groups,
                 tighter_budget,
             )
             final_messages = [*base_messages, *selected_history_messages, current_user_message]
-            prompt_tokens = self._estimate_messages_tokens(final_messages)
+            prompt_tokens = required_prompt_tokens + history_tokens
             logger.warning(
                 "上下文使用率超过 %.0f%% 高水位线，已主动压缩历史。输入: %s tokens，输出上限: %s",
                 self.config.context_high_watermark * 100,
@@ -323,35 +1358,580 @@ class AuraiClient:
                 output_budget,
             )
 
+        if pending_user_message is not current_user_message:
+            final_user_message = self._render_history_references(
+                pending_user_message,
+                history_groups,
+                selected_history_messages,
+            )
+            final_messages[-1] = final_user_message
+            prompt_tokens += (
+                self._estimate_message_tokens(final_user_message)
+                - self._estimate_message_tokens(current_user_message)
+            )
+
         return final_messages, prompt_tokens, output_budget, watermark_hit
 
-    async def chat(
+class AuraiClient(HistoryMessageBuilder):
+    """上级AI客户端（OpenAI 兼容 API）"""
+
+    def __init__(self):
+        """
+        初始化AI客户端
+        """
+        super().__init__(get_aurai_config())
+        self._init_client()
+        self._scheduler = OutboundScheduler(self.config.max_concurrent_requests)
+        self._capabilities = get_capability_store(self.config.capability_ttl)
+        self._rate_limiter = RateLimiter(
+            rpm=self.config.rate_limit_rpm,
+            tpm=self.config.rate_limit_tpm,
+            max_wait_seconds=self.config.rate_limit_max_wait,
+        )
+        self._hedge = None
+        if self.config.hedge_enabled:
+            self._hedge = HedgePolicy(
+                percentile=self.config.hedge_percentile,
+                min_delay=self.config.hedge_min_delay,
+                max_per_minute=self.config.hedge_max_per_minute,
+            )
+
+    def _init_client(self):
+        """
+        初始化各端点的 OpenAI 兼容异步客户端
+
+        chat 运行在 FastMCP 的事件循环里，必须使用 AsyncOpenAI，
+        否则一次 30-60 秒的顾问请求会卡住所有会话的工具调用。
+        所有端点共用一个 httpx 连接池。
+        """
+        endpoint_configs = self.config.resolved_endpoints()
+        for endpoint_config in endpoint_configs:
+            if not endpoint_config.api_key:
+                raise ValueError(f"端点 {endpoint_config.name} 未设置 API 密钥（AURAI_API_KEY）")
+            if not endpoint_config.base_url:
+                raise ValueError(f"端点 {endpoint_config.name} 未设置 Base URL（AURAI_BASE_URL）")
+
+        from openai import AsyncOpenAI
+        import httpx
+
+        # 创建带有超时与连接池配置的异步HTTP客户端
+        self._http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=DEFAULT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+
+        endpoints = []
+        for endpoint_config in endpoint_configs:
+            # 重试由 _request_with_retry 统一负责（退避、Retry-After、总时限、换端点），关闭 SDK 自带的重试
+            client = AsyncOpenAI(
+                api_key=endpoint_config.api_key,
+                base_url=endpoint_config.base_url,
+                http_client=self._http_client,
+                max_retries=0,
+            )
+            endpoints.append(Endpoint(
+                name=endpoint_config.name,
+                model=endpoint_config.model,
+                client=client,
+                weight=endpoint_config.weight,
+                max_concurrency=endpoint_config.max_concurrency,
+                base_url=endpoint_config.base_url,
+            ))
+            logger.info(
+                "OpenAI兼容异步客户端已初始化，端点: %s，Base URL: %s，模型: %s，权重: %s",
+                endpoint_config.name,
+                endpoint_config.base_url,
+                endpoint_config.model,
+                endpoint_config.weight,
+            )
+
+        self._pool = EndpointPool(
+            endpoints,
+            failure_threshold=self.config.endpoint_failure_threshold,
+            cooldown_seconds=self.config.endpoint_cooldown_seconds,
+        )
+
+    async def aclose(self):
+        """关闭底层 HTTP 连接池。"""
+        await self._http_client.aclose()
+
+    def endpoint_stats(self) -> list[dict]:
+        """各端点的负载与健康状态。"""
+        return self._pool.stats()
+
+    def outbound_stats(self) -> dict[str, int]:
+        """全局出站调度器的在途与排队情况。"""
+        return self._scheduler.stats()
+
+    def rate_limit_stats(self) -> dict:
+        """本地 RPM / TPM 额度的剩余量与等待、拒绝次数。"""
+        return self._rate_limiter.stats()
+
+    def hedge_stats(self) -> dict | None:
+        """对冲请求的触发阈值、次数与剩余额度；未开启对冲时为 None。"""
+        return self._hedge.stats() if self._hedge is not None else None
+
+    async def _stream_completion(
         self,
-        user_message: str,
-        system_prompt: str | None = None,
-        conversation_history: list[dict] | None = None,
-    ) -> tuple[dict, dict]:
+        client,
+        request_kwargs: dict,
+        on_progress: ProgressCallback | None = None,
+        on_first_byte: Callable[[], None] | None = None,
+    ) -> tuple[str, dict[str, int] | None, str | None]:
         """
-        发送聊天请求。
+        以流式方式请求并拼接完整回复。
+
+        超时按分片计算：只要上游持续输出，长回复也不会因整体超时而丢失。
+        生成过程中增量提取 analysis/guidance，通过 on_progress 提前推送给调用方。
+        服务端在分片中附带 usage / finish_reason 时一并返回。
+        """
+        stream = await client.chat.completions.create(**request_kwargs, stream=True)
+        extractor = StreamingFieldExtractor()
+        parts: list[str] = []
+        reported_chars = 0
+        chunk_count = 0
+        usage = None
+        finish_reason = None
+
+        try:
+            iterator = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        iterator.__anext__(),
+                        timeout=self.config.stream_chunk_timeout,
+                    )
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise TimeoutError(
+                        f"流式响应超过 {self.config.stream_chunk_timeout}s 未收到新分片"
+                    ) from None
+
+                chunk_count += 1
+                if chunk_count == 1 and on_first_byte is not None:
+                    on_first_byte()
+                usage = _extract_usage(getattr(chunk, "usage", None)) or usage
+                if not chunk.choices:
+                    continue
+
+                finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+
+                parts.append(delta)
+                extractor.feed(delta)
+
+                if (
+                    on_progress is not None
+                    and extractor.captured_chars - reported_chars >= STREAM_PROGRESS_MIN_CHARS
+                ):
+                    reported_chars = extractor.captured_chars
+                    try:
+                        await on_progress(extractor.snapshot())
+                    except Exception:
+                        logger.debug("推送流式进度失败", exc_info=True)
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                await close()
+
+        logger.debug("流式响应结束，共 %s 个分片", chunk_count)
+        return "".join(parts), usage, finish_reason
+
+    async def _endpoint_capabilities(self, endpoint: Endpoint) -> EndpointCapabilities | None:
+        """获取端点能力：开启探测时缺失或过期会探测一次，否则只使用已记录的结果（不论是否过期）。"""
+        key = CapabilityStore.key(endpoint.base_url, endpoint.model)
+        if self.config.capability_probe:
+            capabilities = await self._capabilities.resolve(key, endpoint.client, endpoint.model)
+        else:
+            capabilities = self._capabilities.peek(key)
+        endpoint.capabilities = capabilities
+        return capabilities
+
+    async def _request_completion(
+        self,
+        endpoint: Endpoint,
+        request_kwargs: dict,
+        on_progress: ProgressCallback | None = None,
+        on_first_byte: Callable[[], None] | None = None,
+        probe: bool = True,
+    ) -> tuple[str, dict[str, int] | None, str | None]:
+        """
+        向指定端点发起一次请求，返回 (回复文本, 服务商报告的用量, finish_reason)。
+
+        按端点能力选择输出格式（json_schema → json_object → 不指定）和是否流式；
+        请求因输出格式被拒绝时记录下来，立即降级重发（一次调用最多降级两次）。
+        probe 为 False 时（对冲请求）不探测，只用已记录的能力，没有记录时用 json_object。
+        收到首个分片（非流式为完整响应）时调用 on_first_byte；
+        on_first_byte 为 FirstByteSignal 时在能力确定之后才开始计时。
+        """
+        endpoint_kwargs = {**request_kwargs, "model": endpoint.model}
+        if probe:
+            capabilities = await self._endpoint_capabilities(endpoint)
+        else:
+            capabilities = self._capabilities.peek(CapabilityStore.key(endpoint.base_url, endpoint.model))
+            if capabilities is None and "response_format" in endpoint_kwargs:
+                endpoint_kwargs["response_format"] = {"type": RESPONSE_FORMAT_JSON_OBJECT}
+        use_stream = self.config.stream_responses
+
+        if capabilities is not None:
+            if "response_format" in endpoint_kwargs:
+                mode = capabilities.response_format_mode()
+                if mode == RESPONSE_FORMAT_JSON_OBJECT:
+                    endpoint_kwargs["response_format"] = {"type": RESPONSE_FORMAT_JSON_OBJECT}
+                elif mode is None:
+                    del endpoint_kwargs["response_format"]
+            if capabilities.streaming is False:
+                use_stream = False
+            elif use_stream and capabilities.stream_usage:
+                endpoint_kwargs["stream_options"] = {"include_usage": True}
+
+        if isinstance(on_first_byte, FirstByteSignal):
+            on_first_byte.start()
+
+        while True:
+            try:
+                if use_stream:
+                    return await self._stream_completion(endpoint.client, endpoint_kwargs, on_progress, on_first_byte)
+                response = await endpoint.client.chat.completions.create(**endpoint_kwargs)
+                break
+            except Exception as exc:
+                response_format = endpoint_kwargs.get("response_format")
+                if response_format is None or not _is_response_format_rejection(exc):
+                    raise
+                field = response_format.get("type", RESPONSE_FORMAT_JSON_SCHEMA)
+                logger.warning("端点 %s 不支持 response_format=%s，降级后重发: %s", endpoint.name, field, exc)
+                self._capabilities.mark_unsupported(CapabilityStore.key(endpoint.base_url, endpoint.model), field)
+                # 按 json_schema → json_object → 不指定 逐级降级，不依赖能力记录是否生效
+                if field == RESPONSE_FORMAT_JSON_SCHEMA:
+                    endpoint_kwargs["response_format"] = {"type": RESPONSE_FORMAT_JSON_OBJECT}
+                else:
+                    del endpoint_kwargs["response_format"]
+
+        if on_first_byte is not None:
+            on_first_byte()
+        choice = response.choices[0]
+        return (
+            choice.message.content,
+            _extract_usage(getattr(response, "usage", None)),
+            getattr(choice, "finish_reason", None),
+        )
+
+    def _acquire_hedge_endpoint(self, primary: Endpoint, estimated_tokens: int) -> tuple[Endpoint | None, bool]:
+        """
+        为对冲请求预约额度并选择端点（不等待）。
+
+        每分钟对冲次数或本地 RPM/TPM 额度不足时不对冲。端点优先选主端点之外空闲、健康的端点；
+        没有时若配置了备用模型，在主端点上换模型对冲。
+        对冲请求被取消时上游多半已经处理了输入，预约的额度不再退还。
 
         Returns:
-            (解析后的 JSON 响应, token_usage 字典)
+            (对冲端点或 None, 该端点是否占用了端点池名额)
         """
-        from .prompts import SYSTEM_PROMPT, CONSULT_RESPONSE_SCHEMA
+        hedge = self._hedge
+        if not hedge.allow():
+            return None, False
+
+        charged_tokens = self._rate_limiter.try_acquire(estimated_tokens)
+        if charged_tokens is None:
+            hedge.budget_skipped += 1
+            return None, False
+
+        endpoint = self._pool.try_acquire(exclude={primary.name})
+        if endpoint is not None:
+            hedge.record()
+            return endpoint, True
+
+        hedge_model = self.config.hedge_model
+        if hedge_model and hedge_model != primary.model:
+            hedge.record()
+            return Endpoint(
+                name=f"{primary.name}:{hedge_model}",
+                model=hedge_model,
+                client=primary.client,
+                base_url=primary.base_url,
+            ), False
+
+        self._rate_limiter.release_unused(charged_tokens)
+        hedge.unavailable_skipped += 1
+        return None, False
+
+    async def _hedged_completion(
+        self,
+        endpoint: Endpoint,
+        request_kwargs: dict,
+        on_progress: ProgressCallback | None,
+        token_usage: dict,
+        estimated_tokens: int,
+    ) -> tuple[str, dict[str, int] | None, str | None, Endpoint, BaseException | None]:
+        """
+        带对冲的单次请求。
 
-        system_prompt = system_prompt or SYSTEM_PROMPT
+        主请求超过近期首字节延迟分位数仍没有输出时，向另一个端点（或备用模型）发出同样的请求，
+        取先成功返回的一方，另一方立即取消（流式连接随之关闭）。两者都失败时抛出主请求的异常。
 
-        base_messages = []
-        if system_prompt:
-            base_messages.append({"role": "system", "content": system_prompt})
+        Returns:
+            (回复文本, 用量, finish_reason, 实际应答的端点, 主请求的异常（对冲胜出且主请求失败时）)
+        """
+        hedge = self._hedge
+        primary_signal = FirstByteSignal()
+        primary = asyncio.create_task(
+            self._request_completion(endpoint, request_kwargs, on_progress, primary_signal)
+        )
+        tasks = {primary: (endpoint, primary_signal)}
+        secondary_endpoint = None
+        secondary_pooled = False
 
-        history_groups = self._build_message_groups_from_history(conversation_history)
-        current_user_message = {"role": "user", "content": user_message}
+        try:
+            delay = hedge.delay()
+            if delay is not None:
+                # 对冲延迟从主请求真正发出时算起，能力探测的时间不计入
+                starter = asyncio.create_task(primary_signal.started.wait())
+                try:
+                    await asyncio.wait({primary, starter}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    starter.cancel()
+
+                waiter = asyncio.create_task(primary_signal.event.wait())
+                try:
+                    await asyncio.wait({primary, waiter}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+
+                if not primary.done() and primary_signal.latency is None:
+                    secondary_endpoint, secondary_pooled = self._acquire_hedge_endpoint(endpoint, estimated_tokens)
+                    if secondary_endpoint is not None:
+                        logger.info(
+                            "端点 %s 超过 %.2fs 无首字节，向 %s 发出对冲请求",
+                            endpoint.name,
+                            delay,
+                            secondary_endpoint.name,
+                        )
+                        token_usage["hedged"] = True
+                        token_usage["hedge_endpoint"] = secondary_endpoint.name
+                        secondary_signal = FirstByteSignal()
+                        secondary = asyncio.create_task(
+                            self._request_completion(
+                                secondary_endpoint,
+                                request_kwargs,
+                                None,
+                                secondary_signal,
+                                probe=False,
+                            )
+                        )
+                        tasks[secondary] = (secondary_endpoint, secondary_signal)
+
+            pending = set(tasks)
+            errors: dict[asyncio.Task, BaseException] = {}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is not None:
+                        errors[task] = error
+                        continue
+                    winner, _ = tasks[task]
+                    if winner is not endpoint:
+                        hedge.hedge_wins += 1
+                        token_usage["hedge_won"] = True
+                    content, usage, finish_reason = task.result()
+                    return content, usage, finish_reason, winner, errors.get(primary)
+            raise errors[primary]
+        finally:
+            for task, (_, signal) in tasks.items():
+                if signal.latency is not None:
+                    hedge.latency.observe(signal.latency)
+                elif not task.done() and signal.started.is_set():
+                    # 被取消的慢请求按已等待的时间记一个下限，避免分位数只统计快请求而不断下移
+                    hedge.latency.observe(signal.elapsed())
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if secondary_endpoint is not None and secondary_pooled:
+                secondary_task = next(task for task in tasks if task is not primary)
+                secondary_error = None if secondary_task.cancelled() else secondary_task.exception()
+                await self._pool.release(
+                    secondary_endpoint,
+                    failed=secondary_error is not None and _is_endpoint_failure(secondary_error),
+                    retry_after=_retry_after_seconds(secondary_error) if secondary_error is not None else None,
+                )
+
+    async def _request_with_retry(
+        self,
+        request_kwargs: dict,
+        token_usage: dict,
+        on_progress: ProgressCallback | None = None,
+        session_id: str | None = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        pinned_endpoint: str | None = None,
+    ) -> str:
+        """
+        按重试策略发起请求。
+
+        每次尝试先按预估 tokens 预约本地 RPM/TPM 额度（不足时等待或直接拒绝），
+        再在全局调度器排队拿到在途名额，退避等待期间不占用名额。
+        开启对冲时每次尝试都可能向另一个端点发出对冲请求（见 _hedged_completion）。
+        可重试错误按指数退避 + 抖动重试，服务端给出 Retry-After 时以其为准；
+        还有其他健康端点时立即换端点重试，不再退避（401/403/404 也会换端点）。
+        指定 pinned_endpoint 时固定使用该端点、不对冲，只有它被摘除后才回到端点池选择。
+        超过 retry_max_attempts 或等待会越过 retry_deadline 时抛出最后一次的异常。
+        尝试次数、累计退避/排队/限流等待时间、最终使用的端点、finish_reason 和实际用量
+        （含命中提示词前缀缓存的 cached_prompt_tokens）写入 token_usage；
+        有实际用量时同时用于校准 token 估算。
+
+        Raises:
+            RateLimitExceeded: 本地额度不足且预计等待超过 rate_limit_max_wait
+        """
+        deadline = time.monotonic() + self.config.retry_deadline
+        token_usage["attempts"] = 0
+        token_usage["retry_backoff_seconds"] = 0.0
+        token_usage["queue_wait_seconds"] = 0.0
+        token_usage["rate_limit_wait_seconds"] = 0.0
+        tried: set[str] = set()
+        estimated_request_tokens = token_usage["estimated_input_tokens"] + token_usage["output_limit_tokens"]
+
+        while True:
+            token_usage["attempts"] += 1
+            attempt = token_usage["attempts"]
+            rate_wait, charged_tokens = await self._rate_limiter.acquire(estimated_request_tokens)
+            token_usage["rate_limit_wait_seconds"] = round(
+                token_usage["rate_limit_wait_seconds"] + rate_wait, 3
+            )
+            try:
+                queue_wait = await self._scheduler.acquire(session_id, priority)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                # 排队时被取消或超时：请求没有发出，退还预约的额度
+                self._rate_limiter.release_unused(charged_tokens)
+                raise
+            token_usage["queue_wait_seconds"] = round(token_usage["queue_wait_seconds"] + queue_wait, 3)
+            try:
+                try:
+                    endpoint = await self._pool.acquire(exclude=tried, prefer=pinned_endpoint)
+                except (asyncio.CancelledError, asyncio.TimeoutError):
+                    self._rate_limiter.release_unused(charged_tokens)
+                    raise
+                token_usage["endpoint"] = endpoint.name
+                request_started_at = time.monotonic()
+                try:
+                    if self._hedge is None or pinned_endpoint is not None:
+                        content, usage, finish_reason = await self._request_completion(
+                            endpoint,
+                            request_kwargs,
+                            on_progress,
+                        )
+                        responder, primary_error = endpoint, None
+                    else:
+                        content, usage, finish_reason, responder, primary_error = await self._hedged_completion(
+                            endpoint,
+                            request_kwargs,
+                            on_progress,
+                            token_usage,
+                            estimated_request_tokens,
+                        )
+                except Exception as exc:
+                    error = exc
+                    endpoint_failed = _is_endpoint_failure(exc)
+                    retry_after = _retry_after_seconds(exc)
+                    await self._pool.release(endpoint, failed=endpoint_failed, retry_after=retry_after)
+                    if getattr(exc, "status_code", None) is not None:
+                        # 服务端直接拒绝（429/4xx/5xx）的请求不消耗 tokens
+                        self._rate_limiter.reconcile(charged_tokens, 0)
+                except BaseException:
+                    # 取消等情况也要归还端点名额
+                    await self._pool.release(endpoint)
+                    raise
+                else:
+                    # 对冲胜出时主请求可能已经失败，同样计入主端点的健康检查
+                    await self._pool.release(
+                        endpoint,
+                        failed=primary_error is not None and _is_endpoint_failure(primary_error),
+                    )
+                    token_usage["endpoint"] = responder.name
+                    token_usage["finish_reason"] = finish_reason
+                    if usage is not None:
+                        self._rate_limiter.reconcile(charged_tokens, usage["total_tokens"])
+                        token_usage["actual_prompt_tokens"] = usage["prompt_tokens"]
+                        token_usage["actual_completion_tokens"] = usage["completion_tokens"]
+                        if usage["cached_tokens"] is not None:
+                            token_usage["cached_prompt_tokens"] = usage["cached_tokens"]
+                        _record_prompt_cache(usage, time.monotonic() - request_started_at)
+                        # 用服务商报告的实际输入 tokens 校准该模型的估算系数
+                        self.calibrator.observe(
+                            responder.model,
+                            prompt_features(request_kwargs["messages"]),
+                            usage["prompt_tokens"],
+                        )
+                    return content
+            finally:
+                self._scheduler.release()
+
+            tried.add(endpoint.name)
+            # 固定的端点未被摘除时仍然重试它，按常规退避
+            pinned = endpoint.name == pinned_endpoint and not endpoint.is_ejected(time.monotonic())
+            can_failover = endpoint_failed and not pinned and self._pool.has_alternative(tried)
+            if not _is_retryable_error(error) and not can_failover:
+                raise error
+            if attempt >= self.config.retry_max_attempts:
+                logger.warning("请求失败且已达到最大尝试次数 (%s): %s", attempt, error)
+                raise error
+
+            if can_failover:
+                logger.warning("端点 %s 请求失败，切换端点重试: %s", endpoint.name, error)
+                continue
+
+            delay = _compute_backoff(attempt, self.config)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+
+            remaining = deadline - time.monotonic()
+            if delay >= remaining:
+                logger.warning(
+                    "请求失败，重试等待 %.1fs 将超过总时限（剩余 %.1fs），放弃重试: %s",
+                    delay,
+                    max(remaining, 0.0),
+                    error,
+                )
+                raise error
+
+            logger.warning(
+                "请求失败（第 %s/%s 次），%.2fs 后重试: %s",
+                attempt,
+                self.config.retry_max_attempts,
+                delay,
+                error,
+            )
+            await asyncio.sleep(delay)
+            token_usage["retry_backoff_seconds"] = round(
+                token_usage["retry_backoff_seconds"] + delay, 3
+            )
+
+    def _prepare_request(
+        self,
+        base_messages: list[dict[str, str]],
+        history_groups: list[dict[str, object]],
+        current_user_message: dict[str, str],
+        response_format: dict,
+        history_token_limit: int | None = None,
+        chunk_scores: dict[int, list[float]] | None = None,
+    ) -> tuple[dict, dict]:
+        """
+        把消息压进上下文窗口并组装请求参数。
+
+        Returns:
+            (请求参数, token_usage 字典)
+        """
         messages, prompt_tokens, response_max_tokens, watermark_warning = (
             self._fit_messages_to_context_window(
                 base_messages,
                 history_groups,
                 current_user_message,
+                history_token_limit=history_token_limit,
+                chunk_scores=chunk_scores,
             )
         )
 
@@ -375,52 +1955,330 @@ class AuraiClient:
             token_usage["warning_message"] = None
 
         logger.info(
-            "发送请求到 %s，消息数: %s，输入: %s tokens，输出上限: %s，使用率: %s%%",
-            self.config.base_url,
+            "发送请求，消息数: %s，输入: %s tokens，输出上限: %s，使用率: %s%%",
             len(messages),
             prompt_tokens,
             response_max_tokens,
             usage_pct,
         )
 
+        request_kwargs = {
+            "model": self.config.model,
+            "messages": messages,
+            "temperature": self.config.temperature,
+            "max_tokens": response_max_tokens,
+            "response_format": response_format,
+        }
+        return request_kwargs, token_usage
+
+    async def _continue_truncated_response(
+        self,
+        request_kwargs: dict,
+        content: str,
+        token_usage: dict,
+        session_id: str | None = None,
+        priority: int = PRIORITY_INTERACTIVE,
+    ) -> str:
+        """
+        回复因 max_tokens 被截断时发起续写请求，拼接出完整回复。
+
+        把已生成的部分作为 assistant 消息带上，要求模型从截断处继续输出，
+        最多 CONTINUATION_MAX_ROUNDS 轮；剩余上下文不够或续写失败时返回已有内容，
+        交给本地 JSON 修复。续写轮数和续写消耗的 tokens 记入 token_usage。
+        续写固定发往生成前文的端点（同一模型、可复用前缀缓存），该端点被摘除时才换端点。
+        """
+        rounds = 0
+        endpoint_name = token_usage.get("endpoint")
+        while token_usage.get("finish_reason") == "length" and rounds < CONTINUATION_MAX_ROUNDS:
+            try:
+                json.loads(strip_code_fence(content))
+                # 恰好在 JSON 结束时达到上限，无需续写
+                break
+            except json.JSONDecodeError:
+                pass
+
+            extra_messages = [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": CONTINUATION_PROMPT},
+            ]
+            prompt_tokens = token_usage["estimated_input_tokens"] + self._estimate_messages_tokens(extra_messages)
+            output_budget = min(self.config.max_tokens, self.config.context_window - prompt_tokens)
+            if output_budget < CONTINUATION_MIN_OUTPUT_TOKENS:
+                logger.warning("回复被截断，但剩余上下文不足以续写（输出预算 %s tokens）", output_budget)
+                break
+
+            continuation_kwargs = {
+                key: value for key, value in request_kwargs.items() if key != "response_format"
+            }
+            continuation_kwargs["messages"] = [*request_kwargs["messages"], *extra_messages]
+            continuation_kwargs["max_tokens"] = output_budget
+            continuation_usage = {
+                "estimated_input_tokens": prompt_tokens,
+                "output_limit_tokens": output_budget,
+            }
+
+            rounds += 1
+            logger.info("回复被截断（%s 字符），发起第 %s 轮续写", len(content), rounds)
+            try:
+                continuation = await self._request_with_retry(
+                    continuation_kwargs,
+                    continuation_usage,
+                    session_id=session_id,
+                    priority=priority,
+                    pinned_endpoint=endpoint_name,
+                )
+            except Exception:
+                logger.warning("续写请求失败，使用已生成的部分", exc_info=True)
+                break
+
+            content = _merge_continuation(content, continuation)
+            endpoint_name = continuation_usage.get("endpoint", endpoint_name)
+            token_usage["finish_reason"] = continuation_usage.get("finish_reason")
+            token_usage["continuation_completion_tokens"] = (
+                token_usage.get("continuation_completion_tokens", 0)
+                + (continuation_usage.get("actual_completion_tokens") or 0)
+            )
+
+        token_usage["continuations"] = rounds
+        return content
+
+    async def chat(
+        self,
+        user_message: str,
+        system_prompt: str | None = None,
+        conversation_history: list[dict] | None = None,
+        on_progress: ProgressCallback | None = None,
+        session_id: str | None = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        deadline_seconds: float | None = None,
+        relevance_query: str | None = None,
+    ) -> tuple[dict, dict]:
+        """
+        发送聊天请求。
+
+        调用方取消（MCP 客户端取消工具调用）时 CancelledError 原样向上传播：
+        进行中的 HTTP 请求 / 流被中止，排队名额和端点名额随之归还，
+        调用方也不会拿到结果去写历史。超过时限时同样中止上游请求，返回超时结果。
+
+        Args:
+            deadline_seconds: 本次调用的硬性时限（秒），默认取 AURAI_CALL_TIMEOUT（0 表示不限）
+            其余参数见 _chat
+
+        Returns:
+            (解析后的 JSON 响应, token_usage 字典)
+        """
+        timeout = deadline_seconds if deadline_seconds is not None else getattr(self.config, "call_timeout", 0)
+        state: dict = {}
+        _call_stats["started"] += 1
         try:
-            response = self._client.chat.completions.create(
-                model=self.config.model,
-                messages=messages,
-                temperature=self.config.temperature,
-                max_tokens=response_max_tokens,
-                response_format=CONSULT_RESPONSE_SCHEMA,
+            if not timeout:
+                result = await self._chat(
+                    user_message, system_prompt, conversation_history, on_progress, session_id, priority, state,
+                    relevance_query,
+                )
+            else:
+                result = await asyncio.wait_for(
+                    self._chat(
+                        user_message, system_prompt, conversation_history, on_progress, session_id, priority, state,
+                        relevance_query,
+                    ),
+                    timeout=timeout,
+                )
+        except asyncio.CancelledError:
+            _call_stats["cancelled"] += 1
+            logger.info("调用已取消（会话 %s），已中止上游请求", session_id or DEFAULT_QUEUE_SESSION)
+            raise
+        except asyncio.TimeoutError:
+            _call_stats["timed_out"] += 1
+            logger.warning("调用超过 %.1fs 时限（会话 %s），已中止上游请求", timeout, session_id or DEFAULT_QUEUE_SESSION)
+            token_usage = state.get("token_usage", {})
+            token_usage["timed_out"] = True
+            return {
+                "analysis": "请求超时",
+                "guidance": f"上级顾问在 {timeout:.0f} 秒内没有完成回复，请求已中止。可以稍后重试或精简问题描述",
+                "action_items": [],
+                "needs_another_iteration": True,
+                "resolved": False,
+                "requires_human_intervention": False,
+            }, token_usage
+
+        _call_stats["completed"] += 1
+        return result
+
+    async def _chat(
+        self,
+        user_message: str,
+        system_prompt: str | None,
+        conversation_history: list[dict] | None,
+        on_progress: ProgressCallback | None,
+        session_id: str | None,
+        priority: int,
+        state: dict,
+        relevance_query: str | None = None,
+    ) -> tuple[dict, dict]:
+        """
+        发送聊天请求（不含时限控制）。
+
+        Args:
+            user_message: 当前用户消息
+            system_prompt: 系统提示词，默认使用 SYSTEM_PROMPT
+            conversation_history: 对话历史
+            on_progress: 流式模式下的进度回调，参数为已生成的部分 analysis/guidance
+            session_id: 会话标识，用于全局调度器按会话公平排队
+            priority: 出站优先级，PRIORITY_INTERACTIVE 优先于 PRIORITY_BACKGROUND
+            relevance_query: 当前问题的错误信息、代码片段、终端输出等；
+                给出时历史超出预算后按与它的相关度（BM25）裁剪已同步的文件片段
+
+        服务商报告上下文超长时（本地估算偏低），按其报告的超出量缩减历史预算后
+        自动重试，最多 CONTEXT_OVERFLOW_MAX_RETRIES 次，并在 token_usage 中记录
+        context_overflow_retries / context_shrink_tokens。
+        回复因长度截断（finish_reason=length）时自动续写；回复不是严格的 JSON 时在本地修复，
+        并按 CONSULT_RESPONSE_SCHEMA 补全缺失字段（见 response_parser）。
+
+        Returns:
+            (解析后的 JSON 响应, token_usage 字典)
+        """
+        from .prompts import SYSTEM_PROMPT, CONSULT_RESPONSE_SCHEMA
+
+        system_prompt = system_prompt or SYSTEM_PROMPT
+
+        base_messages = []
+        if system_prompt:
+            base_messages.append({"role": "system", "content": system_prompt})
+
+        history_groups = self._build_message_groups_from_history(conversation_history)
+        chunk_scores = None
+        if relevance_query and getattr(self.config, "relevance_selection", True):
+            chunk_scores = self._score_history_chunks(
+                history_groups,
+                relevance_query,
+                session_id or DEFAULT_QUEUE_SESSION,
             )
+        current_user_message = {"role": "user", "content": user_message}
+        request_kwargs, token_usage = self._prepare_request(
+            base_messages,
+            history_groups,
+            current_user_message,
+            CONSULT_RESPONSE_SCHEMA,
+            chunk_scores=chunk_scores,
+        )
+        state["token_usage"] = token_usage
+        overflow_retries = 0
+        shrink_tokens = 0
+
+        try:
+            while True:
+                try:
+                    content = await self._request_with_retry(
+                        request_kwargs,
+                        token_usage,
+                        on_progress,
+                        session_id=session_id,
+                        priority=priority,
+                    )
+                    break
+                except Exception as exc:
+                    overshoot = _context_overflow_tokens(exc)
+                    if overshoot is None or overflow_retries >= CONTEXT_OVERFLOW_MAX_RETRIES:
+                        raise
+                    required_tokens = self._estimate_messages_tokens([*base_messages, current_user_message])
+                    history_tokens = token_usage["estimated_input_tokens"] - required_tokens
+                    if history_tokens <= 0:
+                        # 没有历史可以再裁剪，只能如实失败
+                        raise
+
+                    # 本地估算偏低：按服务商报告的超出量（或固定比例）缩减历史后重试
+                    if overshoot > 0:
+                        reduction = int(overshoot * CONTEXT_OVERFLOW_SAFETY_RATIO) + 1
+                    else:
+                        reduction = int(history_tokens * (1 - CONTEXT_OVERFLOW_SHRINK_FACTOR)) + 1
+                    reduction = min(reduction, history_tokens)
+                    overflow_retries += 1
+                    shrink_tokens += reduction
+                    logger.warning(
+                        "服务商报告上下文超长（超出约 %s tokens），历史预算缩减 %s tokens 后重试（第 %s/%s 次）",
+                        overshoot or "未知",
+                        reduction,
+                        overflow_retries,
+                        CONTEXT_OVERFLOW_MAX_RETRIES,
+                    )
+                    request_kwargs, token_usage = self._prepare_request(
+                        base_messages,
+                        history_groups,
+                        current_user_message,
+                        CONSULT_RESPONSE_SCHEMA,
+                        history_token_limit=history_tokens - reduction,
+                        chunk_scores=chunk_scores,
+                    )
+                    token_usage["context_overflow_retries"] = overflow_retries
+                    token_usage["context_shrink_tokens"] = shrink_tokens
+                    state["token_usage"] = token_usage
+
+            if token_usage.get("finish_reason") == "length":
+                content = await self._continue_truncated_response(
+                    request_kwargs,
+                    content,
+                    token_usage,
+                    session_id=session_id,
+                    priority=priority,
+                )
 
-            content = response.choices[0].message.content
             token_usage["response_length_chars"] = len(content)
             logger.info("收到响应，长度: %s", len(content))
 
-            try:
-                content_clean = content.strip()
-                if content_clean.startswith("```json"):
-                    content_clean = content_clean[7:]
-                if content_clean.startswith("```"):
-                    content_clean = content_clean[3:]
-                if content_clean.endswith("```"):
-                    content_clean = content_clean[:-3]
-                content_clean = content_clean.strip()
-
-                result = json.loads(content_clean)
+            result, repair = parse_advisor_response(
+                content,
+                truncated=token_usage.get("finish_reason") == "length",
+            )
+            if result is not None:
+                if repair is not None:
+                    token_usage["json_repaired"] = True
+                    token_usage["json_repair"] = repair
                 return result, token_usage
-            except json.JSONDecodeError:
-                logger.warning("JSON解析失败，返回原始文本")
+
+            logger.warning("JSON解析失败，返回原始文本")
+            return {
+                "analysis": "解析失败",
+                "guidance": content,
+                "action_items": [],
+                "needs_another_iteration": False,
+                "resolved": False,
+                "requires_human_intervention": True,
+            }, token_usage
+
+        except RateLimitExceeded as exc:
+            logger.warning("本地限流拒绝请求: %s", exc)
+            token_usage["rate_limited"] = True
+            return {
+                "analysis": "请求被本地限流拒绝",
+                "guidance": (
+                    f"{exc.reason}，预计需要等待约 {exc.wait_seconds:.0f} 秒才有额度"
+                    f"（本地最多等待 {exc.max_wait_seconds:.0f} 秒）。请稍后再调用，"
+                    "或减少上传文件以降低单次请求的 tokens"
+                ),
+                "action_items": [],
+                "needs_another_iteration": True,
+                "resolved": False,
+                "requires_human_intervention": False,
+                "retry_after_seconds": round(exc.wait_seconds, 1),
+            }, token_usage
+
+        except Exception as exc:
+            logger.exception("API请求失败")
+            if _context_overflow_tokens(exc) is not None:
+                token_usage["context_overflow"] = True
                 return {
-                    "analysis": "解析失败",
-                    "guidance": content,
+                    "analysis": "请求失败：上下文超长",
+                    "guidance": (
+                        "服务商拒绝了请求：输入超过模型的上下文长度，自动缩减历史后仍未成功。"
+                        "请用 sync_context(operation='clear') 清空历史、减少上传文件，"
+                        "或调小 AURAI_CONTEXT_WINDOW"
+                    ),
                     "action_items": [],
                     "needs_another_iteration": False,
                     "resolved": False,
                     "requires_human_intervention": True,
                 }, token_usage
-
-        except Exception:
-            logger.exception("API请求失败")
             return {
                 "analysis": "请求失败",
                 "guidance": "请检查API密钥、Base URL和网络连接",
@@ -434,6 +2292,32 @@ class AuraiClient:
 # 全局客户端实例
 _client: AuraiClient | None = None
 
+# 调用计数：开始 / 完成 / 被调用方取消 / 超时
+_call_stats = {"started": 0, "completed": 0, "cancelled": 0, "timed_out": 0}
+
+# 提示词前缀缓存统计（只统计服务商返回了 usage 的请求）
+_prompt_cache_stats = {
+    "requests": 0,
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "hit_requests": 0,
+    "hit_latency_seconds": 0.0,
+    "miss_latency_seconds": 0.0,
+}
+
+
+def _record_prompt_cache(usage: dict, latency_seconds: float):
+    """记录一次请求的输入 tokens、缓存命中 tokens 与耗时（命中与未命中分开累计）。"""
+    cached_tokens = usage.get("cached_tokens") or 0
+    _prompt_cache_stats["requests"] += 1
+    _prompt_cache_stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+    _prompt_cache_stats["cached_tokens"] += cached_tokens
+    if cached_tokens > 0:
+        _prompt_cache_stats["hit_requests"] += 1
+        _prompt_cache_stats["hit_latency_seconds"] += latency_seconds
+    else:
+        _prompt_cache_stats["miss_latency_seconds"] += latency_seconds
+
 
 def get_aurai_client() -> AuraiClient:
     """获取AI客户端实例"""
@@ -443,6 +2327,58 @@ def get_aurai_client() -> AuraiClient:
     return _client
 
 
+def get_endpoint_stats() -> list[dict]:
+    """客户端已初始化时返回各端点状态，否则返回空列表。"""
+    if _client is None:
+        return []
+    return _client.endpoint_stats()
+
+
+def get_rate_limit_stats() -> dict | None:
+    """客户端已初始化时返回本地限流状态，否则返回 None。"""
+    if _client is None:
+        return None
+    return _client.rate_limit_stats()
+
+
+def get_outbound_stats() -> dict[str, int] | None:
+    """客户端已初始化时返回全局出站调度器状态，否则返回 None。"""
+    if _client is None:
+        return None
+    return _client.outbound_stats()
+
+
+def get_hedge_stats() -> dict | None:
+    """获取对冲请求统计；客户端尚未初始化或未开启对冲时返回 None。"""
+    if _client is None:
+        return None
+    return _client.hedge_stats()
+
+
+def get_prompt_cache_stats() -> dict[str, float | int | None]:
+    """提示词前缀缓存的命中率与命中 / 未命中请求的平均耗时。"""
+    stats = _prompt_cache_stats
+    miss_requests = stats["requests"] - stats["hit_requests"]
+    return {
+        "requests": stats["requests"],
+        "hit_requests": stats["hit_requests"],
+        "prompt_tokens": stats["prompt_tokens"],
+        "cached_tokens": stats["cached_tokens"],
+        "cached_pct": round(stats["cached_tokens"] / stats["prompt_tokens"] * 100, 1) if stats["prompt_tokens"] else None,
+        "avg_hit_latency_seconds": (
+            round(stats["hit_latency_seconds"] / stats["hit_requests"], 3) if stats["hit_requests"] else None
+        ),
+        "avg_miss_latency_seconds": (
+            round(stats["miss_latency_seconds"] / miss_requests, 3) if miss_requests else None
+        ),
+    }
+
+
+def get_call_stats() -> dict[str, int]:
+    """返回 chat 调用计数（started / completed / cancelled / timed_out）。"""
+    return dict(_call_stats)
+
+
 def reset_client():
     """重置客户端（主要用于测试）"""
     global _client
@@ -0,0 +1,426 @@
+"""大文件大纲（骨架）模块
+
+几千行的模块整体同步给顾问，大部分 token 花在与问题无关的函数体上。
+开启大纲模式后，超过阈值的文件只发送骨架：导入、类/函数签名、文档字符串，每行带原文件行号，
+省略的函数体用一行占位标出行号范围。完整内容仍保存在 blob 存储中，
+顾问在 questions 或 code_changes 中点名的符号，下一轮会附上完整代码。
+
+- Python：用 ast 解析（语法错误时退回启发式规则）；
+- C 系语言：按声明关键字和缩进的启发式规则；
+- 其他文件不生成大纲，照常发送全文。
+"""
+
+import ast
+import hashlib
+import re
+from collections import OrderedDict
+from pathlib import PurePath
+
+from .chunking import C_LIKE_SUFFIXES, PYTHON_SUFFIXES, source_file_info
+
+# 每个文档字符串在大纲中最多保留的行数（保留到第一行有内容的文字为止）
+OUTLINE_DOCSTRING_LINES = 3
+
+# 声明前紧邻的注释（JSDoc、# 说明等）最多保留的行数
+OUTLINE_COMMENT_LINES = 3
+
+# 不超过该行数的省略区间直接输出原文（占位行并不更短）
+OUTLINE_INLINE_GAP_LINES = 2
+
+# 大纲缓存的条目数（按文件内容哈希缓存，避免每轮重新解析）
+OUTLINE_CACHE_SIZE = 64
+
+# 从顾问回复中提取符号名时忽略过短的词（os、id 之类）
+MIN_MENTION_LENGTH = 3
+
+_IDENTIFIER = re.compile(r"[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*")
+
+_COMMENT_LINE = re.compile(r"\s*(?:#|//|/\*|\*)")
+
+_IMPORT_LINE = re.compile(
+    r"\s*(?:import\b|from\s+\S+\s+import\b|export\s+(?:\*|\{[^}]*\})\s+from\b|#\s*(?:include|import)\b"
+    r"|using\s+[\w.:]+\s*;|package\s+[\w.]+|use\s+[\w:{}, *]+;|(?:const|let|var)\s+\w+\s*=\s*require\()"
+)
+
+# 按顺序尝试：带声明关键字的定义、JS 箭头函数、带返回类型的 C/Java 函数、以 { 结尾的方法
+_DECLARATION_PATTERNS = (
+    re.compile(
+        r"\s*(?:(?:export|default|public|private|protected|internal|static|final|abstract|sealed|async|virtual"
+        r"|override|inline|extern|unsafe|open|data|suspend|pub(?:\([^)]*\))?)\s+)*"
+        r"(?P<kind>class|interface|struct|enum|trait|impl|type|function\*?|func|fn|def|fun|module|namespace"
+        r"|object|record|protocol|extension)\s+(?:\([^)]*\)\s*)?(?P<name>[A-Za-z_$][\w$]*)"
+    ),
+    re.compile(
+        r"\s*(?:export\s+)?(?:const|let|var)\s+(?P<name>[A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?"
+        r"(?:function\b|\([^)]*\)\s*=>|[A-Za-z_$][\w$]*\s*=>)"
+    ),
+    re.compile(
+        r"\s*(?!(?:if|for|while|switch|catch|return|else|do|try|using|lock|foreach|sizeof|new|throw|await"
+        r"|yield|case|delete|goto)\b)(?:[\w$<>\[\],.*&:~]+\s+)+[*&]*(?P<name>[A-Za-z_$~][\w$]*)\s*\([^;]*$"
+    ),
+    re.compile(
+        r"\s*(?:(?:static|async|get|set|public|private|protected)\s+)*"
+        r"(?!(?:if|for|while|switch|catch|function)\b)(?P<name>[A-Za-z_$][\w$]*)\s*\([^;]*\)\s*\{\s*$"
+    ),
+)
+
+_TYPE_KINDS = frozenset({
+    "class", "interface", "struct", "enum", "trait", "impl", "type", "module", "namespace",
+    "object", "record", "protocol", "extension",
+})
+
+
+class OutlineSymbol:
+    """大纲中的一个类或函数；name 为限定名（如 Class.method），行号相对原文件（从 1 开始，含两端）。"""
+
+    __slots__ = ("name", "kind", "start_line", "end_line")
+
+    def __init__(self, name: str, kind: str, start_line: int, end_line: int):
+        self.name = name
+        self.kind = kind
+        self.start_line = start_line
+        self.end_line = end_line
+
+    @property
+    def short_name(self) -> str:
+        return self.name.rsplit(".", 1)[-1]
+
+    def __repr__(self) -> str:
+        return f"OutlineSymbol({self.kind} {self.name}, lines={self.start_line}-{self.end_line})"
+
+
+class FileOutline:
+    """一个文件的大纲：骨架文本、符号表，以及用于展开符号的原文件各行。"""
+
+    def __init__(self, source_path: str, text: str, symbols: list[OutlineSymbol], lines: list[str]):
+        self.source_path = source_path
+        self.text = text
+        self.symbols = symbols
+        self.lines = lines
+
+    @property
+    def line_count(self) -> int:
+        return len(self.lines)
+
+    def source(self, symbol: OutlineSymbol) -> str:
+        """符号的完整源代码。"""
+        return "".join(self.lines[symbol.start_line - 1:symbol.end_line])
+
+
+def _keep_range(kept: set[int], start: int, end: int):
+    kept.update(range(start, end + 1))
+
+
+def _keep_leading_comments(lines: list[str], start: int, kept: set[int]):
+    """保留声明上方紧邻的注释行（最多 OUTLINE_COMMENT_LINES 行）。"""
+    number = start - 1
+    while number >= 1 and start - number <= OUTLINE_COMMENT_LINES and _COMMENT_LINE.match(lines[number - 1]):
+        kept.add(number)
+        number -= 1
+
+
+def _python_docstring(body: list[ast.stmt]) -> ast.stmt | None:
+    if (
+        body
+        and isinstance(body[0], ast.Expr)
+        and isinstance(body[0].value, ast.Constant)
+        and isinstance(body[0].value.value, str)
+    ):
+        return body[0]
+    return None
+
+
+def _keep_python_docstring(body: list[ast.stmt], lines: list[str], kept: set[int]):
+    """保留文档字符串开头，直到第一行有实际内容的文字（最多 OUTLINE_DOCSTRING_LINES 行）。"""
+    docstring = _python_docstring(body)
+    if docstring is None:
+        return
+    last = min(docstring.end_lineno, docstring.lineno + OUTLINE_DOCSTRING_LINES - 1)
+    for number in range(docstring.lineno, last + 1):
+        kept.add(number)
+        if lines[number - 1].strip().lstrip("rRbBuU").strip("\"'"):
+            break
+
+
+def _visit_python_body(
+    body: list[ast.stmt],
+    prefix: str,
+    lines: list[str],
+    kept: set[int],
+    symbols: list[OutlineSymbol],
+):
+    """收集模块或类体中的导入、定义、赋值；函数体内部不再展开。"""
+    for node in body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            _keep_range(kept, node.lineno, node.end_lineno)
+
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            name = prefix + node.name
+            start = min([decorator.lineno for decorator in node.decorator_list] + [node.lineno])
+            # 签名可能跨多行：一直保留到函数体（或文档字符串）开始之前
+            header_end = max(node.body[0].lineno - 1, node.lineno)
+            _keep_leading_comments(lines, start, kept)
+            _keep_range(kept, start, header_end)
+            _keep_python_docstring(node.body, lines, kept)
+            kind = "class" if isinstance(node, ast.ClassDef) else "function"
+            symbols.append(OutlineSymbol(name, kind, start, node.end_lineno))
+            if kind == "class":
+                _visit_python_body(node.body, name + ".", lines, kept, symbols)
+
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            # 常量、类属性只保留说明注释和首行
+            _keep_leading_comments(lines, node.lineno, kept)
+            kept.add(node.lineno)
+
+        elif isinstance(node, (ast.If, ast.Try)) and not prefix:
+            # 模块级的 if TYPE_CHECKING / try: import ... 中的导入和定义
+            kept.add(node.lineno)
+            for child_body in (node.body, node.orelse, getattr(node, "finalbody", [])):
+                _visit_python_body(child_body, prefix, lines, kept, symbols)
+            for handler in getattr(node, "handlers", []):
+                kept.add(handler.lineno)
+                _visit_python_body(handler.body, prefix, lines, kept, symbols)
+
+
+def _python_outline(lines: list[str]) -> tuple[set[int], list[OutlineSymbol]] | None:
+    try:
+        tree = ast.parse("".join(lines))
+    except (SyntaxError, ValueError):
+        return None
+
+    kept: set[int] = set()
+    symbols: list[OutlineSymbol] = []
+    _keep_python_docstring(tree.body, lines, kept)
+    _visit_python_body(tree.body, "", lines, kept, symbols)
+    return kept, symbols
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def _heuristic_block_end(lines: list[str], index: int) -> int:
+    """
+    声明所在块的最后一行下标：之后第一个缩进不深于声明的非空行之前；
+    该行是右括号（或 end）时计入块内，Allman 风格独占一行的 { 视为声明的一部分。
+    """
+    if lines[index].rstrip().endswith(";"):
+        return index
+
+    indent = _indent(lines[index])
+    end = index
+    for next_index in range(index + 1, len(lines)):
+        stripped = lines[next_index].strip()
+        if not stripped:
+            continue
+        if _indent(lines[next_index]) <= indent:
+            if stripped.startswith("{") and end == index:
+                end = next_index
+                continue
+            if stripped[0] in "}])" or stripped == "end":
+                end = next_index
+            break
+        end = next_index
+    return end
+
+
+def _heuristic_outline(lines: list[str]) -> tuple[set[int], list[OutlineSymbol]]:
+    kept: set[int] = set()
+    symbols: list[OutlineSymbol] = []
+    # 外层类型的 (限定名, 结束行下标)，用于生成 Class.method 形式的限定名
+    scopes: list[tuple[str, int]] = []
+
+    for index, line in enumerate(lines):
+        if not line.strip() or _COMMENT_LINE.match(line):
+            continue
+        if _IMPORT_LINE.match(line):
+            kept.add(index + 1)
+            continue
+
+        for pattern in _DECLARATION_PATTERNS:
+            match = pattern.match(line)
+            if match is not None:
+                break
+        else:
+            continue
+
+        while scopes and scopes[-1][1] < index:
+            scopes.pop()
+        end = _heuristic_block_end(lines, index)
+        kind = "class" if match.groupdict().get("kind") in _TYPE_KINDS else "function"
+        name = f"{scopes[-1][0]}.{match.group('name')}" if scopes else match.group("name")
+
+        _keep_leading_comments(lines, index + 1, kept)
+        kept.add(index + 1)
+        symbols.append(OutlineSymbol(name, kind, index + 1, end + 1))
+        if kind == "class" and end > index:
+            scopes.append((name, end))
+
+    return kept, symbols
+
+
+def _render_outline(lines: list[str], kept: set[int]) -> str:
+    """按行号输出保留的行，省略的区间用一行占位标出行号范围（只含空行的区间跳过）。"""
+    width = len(str(len(lines)))
+    rendered: list[str] = []
+
+    def elide(start: int, end: int):
+        if end - start < OUTLINE_INLINE_GAP_LINES:
+            # 很短的区间占位行并不比原文短，直接输出
+            for number in range(start, end + 1):
+                rendered.append(f"{number:>{width}}| {lines[number - 1].rstrip()}")
+            return
+        body = [line for line in lines[start - 1:end] if line.strip()]
+        if body:
+            indent = body[0][:_indent(body[0])]
+            rendered.append(f"{'':>{width}}| {indent}...（第 {start}-{end} 行已省略）")
+
+    previous = 0
+    for number in sorted(kept):
+        if number - previous > 1:
+            elide(previous + 1, number - 1)
+        rendered.append(f"{number:>{width}}| {lines[number - 1].rstrip()}")
+        previous = number
+    if previous < len(lines):
+        elide(previous + 1, len(lines))
+    return "\n".join(rendered)
+
+
+def build_outline(file_path: str, content: str) -> FileOutline | None:
+    """
+    生成文件大纲；不支持的文件类型或找不到任何类/函数时返回 None（照常发送全文）。
+
+    自动转换的文件（sync_context 加了说明行）按原文件的语言和行号生成。
+    """
+    source_path, line_offset = source_file_info(file_path, content)
+    lines = content.splitlines(keepends=True)[line_offset:]
+    suffix = PurePath(source_path).suffix.lower()
+
+    result = None
+    if suffix in PYTHON_SUFFIXES:
+        result = _python_outline(lines)
+    if result is None and (suffix in PYTHON_SUFFIXES or suffix in C_LIKE_SUFFIXES):
+        result = _heuristic_outline(lines)
+    if result is None:
+        return None
+
+    kept, symbols = result
+    if not symbols:
+        return None
+    return FileOutline(source_path, _render_outline(lines, kept), symbols, lines)
+
+
+_outline_cache: OrderedDict[str, FileOutline | None] = OrderedDict()
+
+
+def get_file_outline(file_path: str, content: str) -> FileOutline | None:
+    """获取文件大纲（按路径和内容哈希缓存）。"""
+    key = hashlib.sha1(f"{file_path}\0{content}".encode("utf-8")).hexdigest()
+    if key in _outline_cache:
+        _outline_cache.move_to_end(key)
+        return _outline_cache[key]
+
+    outline = build_outline(file_path, content)
+    _outline_cache[key] = outline
+    while len(_outline_cache) > OUTLINE_CACHE_SIZE:
+        _outline_cache.popitem(last=False)
+    return outline
+
+
+def _normalize_path(path: str) -> str:
+    return path.replace("\\", "/").removeprefix("./")
+
+
+class SymbolMentions:
+    """
+    顾问在 questions / code_changes 中点名的符号与代码位置。
+
+    names 为出现过的标识符（含 Class.method 形式的限定名），
+    locations 为 code_changes 中的 (文件, 行号)，该行所在的函数或类同样展开。
+    """
+
+    def __init__(self):
+        self.names: set[str] = set()
+        self.locations: set[tuple[str, int]] = set()
+
+    def _add_names(self, text: object):
+        if not isinstance(text, str):
+            return
+        for identifier in _IDENTIFIER.findall(text):
+            if len(identifier) >= MIN_MENTION_LENGTH:
+                self.names.add(identifier)
+            for part in identifier.split("."):
+                if len(part) >= MIN_MENTION_LENGTH:
+                    self.names.add(part)
+
+    @classmethod
+    def from_history(cls, conversation_history: list[dict] | None) -> "SymbolMentions":
+        mentions = cls()
+        for entry in conversation_history or []:
+            response = entry.get("response")
+            if not isinstance(response, dict):
+                continue
+            for question in response.get("questions") or []:
+                mentions._add_names(question)
+            for change in response.get("code_changes") or []:
+                if not isinstance(change, dict):
+                    continue
+                mentions._add_names(change.get("old"))
+                file_path, line = change.get("file"), change.get("line")
+                if isinstance(file_path, str) and isinstance(line, (int, float)) and not isinstance(line, bool):
+                    mentions.locations.add((_normalize_path(file_path), int(line)))
+        return mentions
+
+    def __bool__(self) -> bool:
+        return bool(self.names or self.locations)
+
+    def key(self) -> str:
+        """用于消息分组缓存键的摘要；点名内容变化时对应的同步记录需要重建。"""
+        if not self:
+            return ""
+        payload = "\n".join(sorted(self.names)) + "\0" + "\n".join(
+            f"{path}:{line}" for path, line in sorted(self.locations)
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+    def _lines_in(self, outline: FileOutline, file_path: str) -> set[int]:
+        candidates = {_normalize_path(file_path), _normalize_path(outline.source_path)}
+        lines = set()
+        for path, line in self.locations:
+            if any(
+                candidate == path or candidate.endswith("/" + path) or path.endswith("/" + candidate)
+                for candidate in candidates
+            ):
+                lines.add(line)
+        return lines
+
+    def symbols_for(self, file_path: str, outline: FileOutline) -> list[OutlineSymbol]:
+        """需要展开的符号（按行号排序；已被外层符号包含的不再重复）。"""
+        lines = self._lines_in(outline, file_path)
+        matched = [
+            symbol for symbol in outline.symbols
+            if symbol.name in self.names
+            or symbol.short_name in self.names
+            or any(symbol.start_line <= line <= symbol.end_line for line in lines)
+        ]
+        if lines:
+            # 按行号定位时只取包含该行的最内层符号，避免为一行改动展开整个类
+            innermost = []
+            for symbol in matched:
+                named = symbol.name in self.names or symbol.short_name in self.names
+                nested = any(
+                    other is not symbol
+                    and symbol.start_line <= other.start_line
+                    and other.end_line <= symbol.end_line
+                    for other in matched
+                )
+                if named or not nested:
+                    innermost.append(symbol)
+            matched = innermost
+
+        selected: list[OutlineSymbol] = []
+        for symbol in sorted(matched, key=lambda item: (item.start_line, -item.end_line)):
+            if selected and symbol.end_line <= selected[-1].end_line:
+                continue
+            selected.append(symbol)
+        return selected
@@ -1,8 +1,19 @@
 """提示词模板模块"""
 
 import json
+from collections import Counter
 from typing import Any
 
+# 单一来源模式下提示词中对话历史引用的占位符，发送前按实际保留的历史替换（见 format_history_references）
+HISTORY_REFERENCES_PLACEHOLDER = "<<aurai:history_references>>"
+
+# 对话历史引用中各类记录的名称
+HISTORY_TURN_LABELS = {
+    "consult": "咨询",
+    "progress": "进度报告",
+    "sync_context": "上下文同步",
+}
+
 
 def _serialize_context(value: Any) -> str:
     """将上下文值序列化为适合放入提示词的文本。"""
@@ -97,6 +108,34 @@ def _format_history_for_prompt(conversation_history: list[dict[str, Any]] | None
     return "".join(parts)
 
 
+def format_history_references(turn_types: list[str], omitted: int = 0) -> str:
+    """单一来源模式下的对话历史引用。
+
+    完整内容已经作为历史消息逐轮发送，这里只说明实际发送了哪些记录，不再重复正文。
+    turn_types 为发送的各轮记录类型（时间顺序），omitted 为因上下文窗口限制未发送的轮数。
+    """
+    counts = Counter(turn_type for turn_type in turn_types if turn_type != "summary")
+    has_summary = "summary" in turn_types
+    if not counts and not has_summary and not omitted:
+        return ""
+
+    breakdown = "、".join(
+        f"{HISTORY_TURN_LABELS.get(turn_type, '其他')} {count} 轮" for turn_type, count in counts.items()
+    )
+    parts = ["## 对话历史\n"]
+    if counts:
+        parts.append(f"前面的历史消息按时间顺序包含 {sum(counts.values())} 轮记录（{breakdown}）")
+        if has_summary:
+            parts.append("，以及更早对话的摘要")
+        parts.append("，此处不再重复。")
+    elif has_summary:
+        parts.append("前面的历史消息包含更早对话的摘要，此处不再重复。")
+    if omitted:
+        parts.append(f"另有 {omitted} 轮记录因上下文窗口限制未发送。")
+    parts.append("\n\n")
+    return "".join(parts)
+
+
 def build_consult_prompt(
     problem_type: str,
     error_message: str,
@@ -106,8 +145,13 @@ def build_consult_prompt(
     iteration: int = 0,
     conversation_history: list[dict[str, str]] | None = None,
     history_turns: int = 10,
+    history_references: bool = False,
 ) -> str:
-    """构建请求上级AI指导的提示词。格式说明由 SYSTEM_PROMPT 统一提供。"""
+    """构建请求上级AI指导的提示词。格式说明由 SYSTEM_PROMPT 统一提供。
+
+    history_references 为 True 时对话历史已作为独立消息发送，提示词中只保留引用占位符，
+    发送前按上下文窗口实际保留的历史替换。
+    """
     context = context or {}
 
     context_desc = []
@@ -136,7 +180,10 @@ def build_consult_prompt(
             f"```json\n{_serialize_context(extra_context)}\n```"
         )
 
-    history_desc = _format_history_for_prompt(conversation_history, max_turns=history_turns)
+    if history_references:
+        history_desc = HISTORY_REFERENCES_PLACEHOLDER if conversation_history else ""
+    else:
+        history_desc = _format_history_for_prompt(conversation_history, max_turns=history_turns)
 
     prompt = f"""# 问题信息
 
@@ -166,9 +213,17 @@ def build_progress_prompt(
     feedback: str | None = None,
     conversation_history: list[dict[str, str]] | None = None,
     history_turns: int = 10,
+    history_references: bool = False,
 ) -> str:
-    """构建报告进度的提示词。格式说明由 SYSTEM_PROMPT 统一提供。"""
-    history_desc = _format_history_for_prompt(conversation_history, max_turns=history_turns)
+    """构建报告进度的提示词。格式说明由 SYSTEM_PROMPT 统一提供。
+
+    history_references 为 True 时对话历史已作为独立消息发送，提示词中只保留引用占位符，
+    发送前按上下文窗口实际保留的历史替换。
+    """
+    if history_references:
+        history_desc = HISTORY_REFERENCES_PLACEHOLDER if conversation_history else ""
+    else:
+        history_desc = _format_history_for_prompt(conversation_history, max_turns=history_turns)
 
     prompt = f"""# 进度报告
 
@@ -0,0 +1,185 @@
+"""上级 AI 请求的本地限流模块（TPM / RPM 令牌桶）
+
+服务商按每分钟请求数（RPM）和每分钟 tokens（TPM）限额，超出后才返回 429，
+此时请求的延迟已经白白付出。这里在本地按同样的额度预先扣减：
+额度不足时在本地等待，预计等待超过上限时直接拒绝；
+请求完成后再按服务商返回的实际用量多退少补。
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    """本地额度不足且预计等待超过上限时抛出。"""
+
+    def __init__(self, wait_seconds: float, max_wait_seconds: float, reason: str):
+        self.wait_seconds = wait_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.reason = reason
+        super().__init__(
+            f"{reason}：预计需等待 {wait_seconds:.1f}s，超过上限 {max_wait_seconds:.1f}s"
+        )
+
+
+class TokenBucket:
+    """
+    每分钟额度的令牌桶。
+
+    余额允许为负（预约制）：先到的请求扣减后排在前面，
+    后来的请求需要等余额回到非负才能放行，天然按到达顺序排队。
+    """
+
+    def __init__(self, per_minute: int, now: float | None = None):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._updated_at = now if now is not None else time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = max(now - self._updated_at, 0.0)
+        self.level = min(self.capacity, self.level + elapsed * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """扣减 amount 后需要等待多久余额才回到非负。"""
+        self._refill(now)
+        shortfall = amount - self.level
+        return max(shortfall / self.rate, 0.0)
+
+    def charge(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= amount
+
+    def refund(self, amount: float, now: float):
+        """退还（amount 为负时追加扣减）。"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.level
+
+
+class RateLimiter:
+    """
+    RPM / TPM 双令牌桶。
+
+    acquire 按预估 tokens 预约额度并在必要时等待，返回 (等待秒数, 预约的 tokens)；
+    请求结束后用 reconcile 按实际用量修正 TPM 余额。
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, max_wait_seconds: float = 60.0):
+        now = time.monotonic()
+        self.request_bucket = TokenBucket(rpm, now) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm, now) if tpm > 0 else None
+        self.max_wait_seconds = max_wait_seconds
+        self.total_wait_seconds = 0.0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.request_bucket is not None or self.token_bucket is not None
+
+    async def acquire(self, tokens: int) -> tuple[float, int]:
+        """
+        预约一次请求和 tokens 的额度。
+
+        Returns:
+            (本地等待秒数, 实际预约的 tokens)
+
+        Raises:
+            RateLimitExceeded: 预计等待超过 max_wait_seconds
+        """
+        if not self.enabled:
+            return 0.0, 0
+
+        now = time.monotonic()
+        wait_seconds = 0.0
+        reason = ""
+        if self.request_bucket is not None:
+            request_wait = self.request_bucket.wait_time(1, now)
+            if request_wait > wait_seconds:
+                wait_seconds, reason = request_wait, "RPM 额度不足"
+        charged_tokens = 0
+        if self.token_bucket is not None:
+            charged_tokens = tokens
+            token_wait = self.token_bucket.wait_time(tokens, now)
+            if token_wait > wait_seconds:
+                wait_seconds, reason = token_wait, "TPM 额度不足"
+
+        if wait_seconds > self.max_wait_seconds:
+            self.rejected += 1
+            raise RateLimitExceeded(wait_seconds, self.max_wait_seconds, reason)
+
+        if self.request_bucket is not None:
+            self.request_bucket.charge(1, now)
+        if self.token_bucket is not None:
+            self.token_bucket.charge(charged_tokens, now)
+
+        if wait_seconds > 0:
+            logger.info("%s，本地等待 %.2fs 后再发送", reason, wait_seconds)
+            try:
+                await asyncio.sleep(wait_seconds)
+            except asyncio.CancelledError:
+                # 调用方放弃了请求，退还预约的额度
+                self.release_unused(charged_tokens)
+                raise
+            self.total_wait_seconds += wait_seconds
+
+        return wait_seconds, charged_tokens
+
+    def try_acquire(self, tokens: int) -> int | None:
+        """
+        不等待地预约一次请求和 tokens 的额度（用于对冲等可选请求）。
+
+        Returns:
+            预约的 tokens；需要等待才能放行时不扣减并返回 None
+        """
+        if not self.enabled:
+            return 0
+
+        now = time.monotonic()
+        if self.request_bucket is not None and self.request_bucket.wait_time(1, now) > 0:
+            return None
+        if self.token_bucket is not None and self.token_bucket.wait_time(tokens, now) > 0:
+            return None
+
+        if self.request_bucket is not None:
+            self.request_bucket.charge(1, now)
+        charged_tokens = 0
+        if self.token_bucket is not None:
+            charged_tokens = tokens
+            self.token_bucket.charge(charged_tokens, now)
+        return charged_tokens
+
+    def reconcile(self, charged_tokens: int, actual_tokens: int | None):
+        """按服务商返回的实际用量修正 TPM 余额；没有用量信息时保留预估扣减。"""
+        if self.token_bucket is None or actual_tokens is None:
+            return
+        self.token_bucket.refund(charged_tokens - actual_tokens, time.monotonic())
+
+    def release_unused(self, charged_tokens: int):
+        """请求没有真正发出时退还预约的请求数和 tokens。"""
+        now = time.monotonic()
+        if self.token_bucket is not None:
+            self.token_bucket.refund(charged_tokens, now)
+        if self.request_bucket is not None:
+            self.request_bucket.refund(1, now)
+
+    def stats(self) -> dict[str, float | int | None]:
+        now = time.monotonic()
+        stats: dict[str, float | int | None] = {
+            "rpm_available": None,
+            "tpm_available": None,
+            "total_wait_seconds": round(self.total_wait_seconds, 3),
+            "rejected": self.rejected,
+        }
+        if self.request_bucket is not None:
+            stats["rpm_available"] = round(self.request_bucket.available(now), 2)
+        if self.token_bucket is not None:
+            stats["tpm_available"] = int(self.token_bucket.available(now))
+        return stats
@@ -0,0 +1,481 @@
+"""上级顾问回复的容错解析模块
+
+模型并不总是输出严格的 JSON：前后夹带说明文字、单引号、尾随逗号、
+Python 风格的 True/None、少了结尾括号……以前这些都会变成一次失败的回合，
+本地 AI 只能再问一遍。这里按由宽到严的顺序逐级尝试：
+
+1. 去掉代码块标记后直接解析；
+2. 按括号配对从文本中提取第一个完整的 JSON 对象；
+3. 修正常见格式问题（引号、尾随逗号、注释、非法转义、未闭合的括号）；
+4. 回复被截断时，丢弃不完整的最后一个字段。
+
+解析结果再按 CONSULT_RESPONSE_SCHEMA 校验（校验器只编译一次），
+缺失的必填字段按类型补默认值。各阶段的计数通过 get_response_parse_stats 查看。
+"""
+
+import json
+import logging
+import threading
+from collections.abc import Callable
+from typing import Any
+
+from .prompts import CONSULT_RESPONSE_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+# 修复方式
+REPAIR_EXTRACTED = "extracted"
+REPAIR_NORMALIZED = "normalized"
+REPAIR_TRUNCATED = "truncated"
+
+# JSON 字符串中合法的转义字符
+_VALID_ESCAPES = frozenset('"\\/bfnrtu')
+
+# 模型常用的 Python 风格字面量
+_LITERAL_REPLACEMENTS = {"True": "true", "False": "false", "None": "null"}
+
+# JSON Schema 类型到 Python 类型的映射
+_SCHEMA_TYPES: dict[str, tuple[type, ...]] = {
+    "string": (str,),
+    "number": (int, float),
+    "integer": (int,),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+    "null": (type(None),),
+}
+
+
+def strip_code_fence(content: str) -> str:
+    """去掉回复外层的 ```json / ``` 代码块标记。"""
+    content_clean = content.strip()
+    if content_clean.startswith("```json"):
+        content_clean = content_clean[7:]
+    if content_clean.startswith("```"):
+        content_clean = content_clean[3:]
+    if content_clean.endswith("```"):
+        content_clean = content_clean[:-3]
+    return content_clean.strip()
+
+
+def extract_json_object(text: str) -> str | None:
+    """按括号配对提取第一个 JSON 对象（忽略字符串内的括号）；未闭合时返回到文本末尾。"""
+    start = text.find("{")
+    if start < 0:
+        return None
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        ch = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return text[start:]
+
+
+def _drop_trailing_comma(out: list[str]):
+    """删除输出末尾（忽略空白）的逗号。"""
+    index = len(out) - 1
+    while index >= 0 and out[index].isspace():
+        index -= 1
+    if index >= 0 and out[index] == ",":
+        del out[index]
+
+
+def normalize_json_text(text: str) -> str:
+    """
+    修正常见的 JSON 格式问题。
+
+    - 单引号字符串改为双引号，字符串中的换行等控制字符转义；
+    - 非法转义（如正则里的 \\d）改为字面反斜杠；
+    - 去掉 // 和 /* */ 注释、对象和数组末尾的逗号；
+    - True/False/None 改为 true/false/null，未加引号的键补上引号；
+    - 补全未闭合的字符串和括号。
+    """
+    out: list[str] = []
+    stack: list[str] = []
+    index = 0
+    length = len(text)
+
+    while index < length:
+        ch = text[index]
+
+        if ch in "\"'":
+            quote = ch
+            index += 1
+            buffer = ['"']
+            while index < length:
+                current = text[index]
+                if current == "\\" and index + 1 < length:
+                    following = text[index + 1]
+                    if quote == "'" and following == "'":
+                        buffer.append("'")
+                    elif following in _VALID_ESCAPES:
+                        buffer.append(current + following)
+                    else:
+                        buffer.append("\\\\" + following)
+                    index += 2
+                    continue
+                if current == quote:
+                    index += 1
+                    break
+                if current == '"':
+                    buffer.append('\\"')
+                elif current == "\n":
+                    buffer.append("\\n")
+                elif current == "\r":
+                    buffer.append("\\r")
+                elif current == "\t":
+                    buffer.append("\\t")
+                else:
+                    buffer.append(current)
+                index += 1
+            buffer.append('"')
+            out.append("".join(buffer))
+            continue
+
+        if ch == "/" and text.startswith("//", index):
+            newline = text.find("\n", index)
+            index = length if newline < 0 else newline
+            continue
+        if ch == "/" and text.startswith("/*", index):
+            end = text.find("*/", index + 2)
+            index = length if end < 0 else end + 2
+            continue
+
+        if ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            _drop_trailing_comma(out)
+            if stack and stack[-1] == ch:
+                stack.pop()
+            out.append(ch)
+        elif ch.isalpha() or ch == "_":
+            end = index
+            while end < length and (text[end].isalnum() or text[end] == "_"):
+                end += 1
+            word = text[index:end]
+            rest = text[end:].lstrip()
+            if word in _LITERAL_REPLACEMENTS:
+                out.append(_LITERAL_REPLACEMENTS[word])
+            elif rest.startswith(":") and word not in ("true", "false", "null"):
+                out.append(f'"{word}"')
+            else:
+                out.append(word)
+            index = end
+            continue
+        else:
+            out.append(ch)
+        index += 1
+
+    _drop_trailing_comma(out)
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def repair_truncated_json(text: str) -> dict | None:
+    """
+    修复被截断的 JSON 对象。
+
+    先补全未闭合的字符串和括号；仍无法解析时回退到最近一个逗号处截断再补全，
+    丢弃不完整的最后一个字段。无法修复时返回 None。
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    text = text[start:]
+
+    stack: list[str] = []
+    cut_points: list[tuple[int, str]] = []
+    in_string = False
+    escaped = False
+    for index, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                text = text[:index + 1]
+                break
+        elif ch == ",":
+            cut_points.append((index, "".join(reversed(stack))))
+
+    candidates = []
+    tail = text[:-1] if escaped else text
+    if in_string:
+        tail += '"'
+    candidates.append(tail.rstrip().rstrip(",") + "".join(reversed(stack)))
+    for index, closers in reversed(cut_points):
+        candidates.append(text[:index] + closers)
+
+    for candidate in candidates:
+        try:
+            result = json.loads(candidate, strict=False)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(result, dict):
+            return result
+    return None
+
+
+def _loads_object(text: str | None) -> dict | None:
+    if not text:
+        return None
+    try:
+        result = json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+class SchemaValidator:
+    """
+    JSON Schema 子集的校验器（type / enum / properties / required / items / additionalProperties）。
+
+    构造时把 schema 编译为嵌套的校验函数，之后每次校验不再解释 schema。
+    """
+
+    def __init__(self, schema: dict):
+        self.schema = schema
+        self._check = self._compile(schema)
+
+    def _compile(self, schema: dict) -> Callable[[Any, str, list[str]], None]:
+        checks: list[Callable[[Any, str, list[str]], None]] = []
+
+        types = schema.get("type")
+        if types is not None:
+            type_names = [types] if isinstance(types, str) else list(types)
+            allowed = tuple(python_type for name in type_names for python_type in _SCHEMA_TYPES[name])
+            allows_bool = "boolean" in type_names
+
+            def check_type(value, path, errors):
+                # bool 是 int 的子类，需要单独排除
+                if not isinstance(value, allowed) or (isinstance(value, bool) and not allows_bool):
+                    errors.append(f"{path}: 类型应为 {'/'.join(type_names)}")
+
+            checks.append(check_type)
+
+        if "enum" in schema:
+            choices = tuple(schema["enum"])
+
+            def check_enum(value, path, errors):
+                if value not in choices:
+                    errors.append(f"{path}: 取值应为 {'/'.join(map(str, choices))}")
+
+            checks.append(check_enum)
+
+        properties = {
+            name: self._compile(subschema) for name, subschema in schema.get("properties", {}).items()
+        }
+        required = tuple(schema.get("required", ()))
+        closed = schema.get("additionalProperties") is False
+        if properties or required or closed:
+
+            def check_object(value, path, errors):
+                if not isinstance(value, dict):
+                    return
+                for name in required:
+                    if name not in value:
+                        errors.append(f"{path}.{name}: 缺少必填字段")
+                for name, item in value.items():
+                    check = properties.get(name)
+                    if check is not None:
+                        check(item, f"{path}.{name}", errors)
+                    elif closed:
+                        errors.append(f"{path}.{name}: 不允许的字段")
+
+            checks.append(check_object)
+
+        if "items" in schema:
+            check_item = self._compile(schema["items"])
+
+            def check_items(value, path, errors):
+                if not isinstance(value, list):
+                    return
+                for index, item in enumerate(value):
+                    check_item(item, f"{path}[{index}]", errors)
+
+            checks.append(check_items)
+
+        def check(value, path, errors):
+            for item_check in checks:
+                item_check(value, path, errors)
+
+        return check
+
+    def validate(self, value: Any) -> list[str]:
+        """返回校验错误列表，为空表示通过。"""
+        errors: list[str] = []
+        self._check(value, "$", errors)
+        return errors
+
+
+CONSULT_SCHEMA = CONSULT_RESPONSE_SCHEMA["json_schema"]["schema"]
+CONSULT_RESPONSE_VALIDATOR = SchemaValidator(CONSULT_SCHEMA)
+
+
+def _schema_default(schema: dict) -> Any:
+    """按字段类型给出缺省值。"""
+    types = schema.get("type")
+    type_names = [types] if isinstance(types, str) else list(types or [])
+    if "null" in type_names:
+        return None
+    if "array" in type_names:
+        return []
+    if "boolean" in type_names:
+        return False
+    if "object" in type_names:
+        return {}
+    return ""
+
+
+def _coerce_field(value: Any, schema: dict) -> Any:
+    """修正模型常见的类型偏差：字符串写成的布尔值、单个字符串代替列表、数字代替字符串。"""
+    types = schema.get("type")
+    type_names = [types] if isinstance(types, str) else list(types or [])
+    if "boolean" in type_names and isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    if "array" in type_names and isinstance(value, str):
+        return [value] if value.strip() else []
+    if "string" in type_names and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def normalize_consult_response(result: dict) -> tuple[dict, list[str], list[str]]:
+    """
+    按 CONSULT_RESPONSE_SCHEMA 补全并校验顾问回复。
+
+    Returns:
+        (补全后的回复, 补上的字段名, 补全后仍存在的校验错误)
+    """
+    properties = CONSULT_SCHEMA["properties"]
+    for name, value in list(result.items()):
+        if name in properties:
+            result[name] = _coerce_field(value, properties[name])
+
+    filled: list[str] = []
+    for name in CONSULT_SCHEMA["required"]:
+        if name in result:
+            continue
+        if name == "status":
+            # 只有反问、没有指导时视为信息对齐阶段
+            has_guidance = bool(result.get("guidance") or result.get("analysis") or result.get("action_items"))
+            result[name] = "aligning" if result.get("questions") and not has_guidance else "guiding"
+        else:
+            result[name] = _schema_default(properties[name])
+        filled.append(name)
+
+    return result, filled, CONSULT_RESPONSE_VALIDATOR.validate(result)
+
+
+class ResponseParseStats:
+    """解析各阶段的计数。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "parsed": 0,
+            REPAIR_EXTRACTED: 0,
+            REPAIR_NORMALIZED: 0,
+            REPAIR_TRUNCATED: 0,
+            "failed": 0,
+            "fields_filled": 0,
+            "schema_errors": 0,
+        }
+
+    def record(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["recovered"] = stats[REPAIR_EXTRACTED] + stats[REPAIR_NORMALIZED] + stats[REPAIR_TRUNCATED]
+        return stats
+
+
+_parse_stats = ResponseParseStats()
+
+
+def parse_advisor_response(content: str, truncated: bool = False) -> tuple[dict | None, str | None]:
+    """
+    容错解析顾问回复，并按 schema 补全缺失字段。
+
+    Args:
+        content: 模型回复原文
+        truncated: 回复是否因长度被截断（允许丢弃不完整的最后一个字段）
+
+    Returns:
+        (解析结果, 使用的修复方式)；无法解析时结果为 None，未修复时修复方式为 None
+    """
+    content_clean = strip_code_fence(content)
+    repair = None
+    result = _loads_object(content_clean)
+
+    if result is None:
+        extracted = extract_json_object(content_clean)
+        result = _loads_object(extracted)
+        repair = REPAIR_EXTRACTED
+        if result is None and extracted is not None:
+            normalized = normalize_json_text(extracted)
+            result = _loads_object(normalized)
+            repair = REPAIR_NORMALIZED
+            if result is None and truncated:
+                result = repair_truncated_json(normalized)
+                repair = REPAIR_TRUNCATED
+
+    if result is None:
+        _parse_stats.record("failed")
+        return None, None
+
+    _parse_stats.record("parsed")
+    if repair is not None:
+        _parse_stats.record(repair)
+        logger.info("顾问回复不是严格的 JSON，已在本地修复（%s）", repair)
+
+    result, filled, errors = normalize_consult_response(result)
+    if filled:
+        _parse_stats.record("fields_filled", len(filled))
+        logger.debug("顾问回复缺少字段，已补默认值: %s", filled)
+    if errors:
+        _parse_stats.record("schema_errors")
+        logger.debug("顾问回复不符合 schema: %s", errors)
+    return result, repair
+
+
+def get_response_parse_stats() -> dict[str, int]:
+    """返回解析计数：parsed / recovered（及各修复方式）/ failed / fields_filled / schema_errors。"""
+    return _parse_stats.snapshot()
+
+
+def reset_response_parse_stats():
+    """重置解析计数（主要用于测试）"""
+    global _parse_stats
+    _parse_stats = ResponseParseStats()
@@ -0,0 +1,165 @@
+"""已同步文件片段的相关度检索（BM25）
+
+上下文预算不够时，默认策略保留最近一次 sync_context、其余按时间倒序补齐，
+真正包含出错代码的文件可能恰好被挤掉。这里为每个会话维护一个内存倒排索引，
+以已同步文件的每个片段（一条消息）为文档，用当前问题的错误信息、代码片段和终端输出
+做 BM25 打分，预算裁剪时优先保留得分高的片段。
+
+索引按片段内容哈希增量维护：每次同步或请求时只为新出现的片段分词，
+已从历史中移除的片段随之删除，不会每次调用都重建。
+"""
+
+import math
+import re
+from collections import Counter, OrderedDict
+
+# BM25 参数：词频饱和度与文档长度归一化强度
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 最多同时保留多少个会话的索引（LRU）
+MAX_INDEXED_SESSIONS = 64
+
+# 标识符、数字和连续的中文字符（CJK 统一表意文字 U+4E00–U+9FFF）
+_TERM_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[\u4e00-\u9fff]+")
+
+# 驼峰命名的拆分点（HTTPServerError → HTTP / Server / Error）
+_CAMEL_BOUNDARY = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def index_terms(text: str) -> list[str]:
+    """
+    把文本切分为检索词。
+
+    标识符统一小写，同时加入按下划线和驼峰拆出的各部分（load_orders → load_orders / load / orders）；
+    中文按相邻两字切分，单字词单独保留。
+    """
+    terms: list[str] = []
+    for token in _TERM_PATTERN.findall(text):
+        if "\u4e00" <= token[0] <= "\u9fff":
+            if len(token) == 1:
+                terms.append(token)
+            else:
+                terms.extend(token[index:index + 2] for index in range(len(token) - 1))
+            continue
+
+        lowered = token.lower()
+        if len(lowered) < 2:
+            continue
+        terms.append(lowered)
+        parts = [part.lower() for piece in token.split("_") for part in _CAMEL_BOUNDARY.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) >= 2)
+    return terms
+
+
+class BM25Index:
+    """
+    可增量更新的 BM25 倒排索引。
+
+    文档以调用方给定的 doc_id（片段内容哈希）标识，重复添加同一文档是空操作。
+    """
+
+    def __init__(self):
+        self._term_counts: dict[str, Counter] = {}
+        self._lengths: dict[str, int] = {}
+        self._postings: dict[str, set[str]] = {}
+        self._total_length = 0
+        self.added = 0
+        self.removed = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._lengths
+
+    def add(self, doc_id: str, text: str) -> bool:
+        """添加文档；已存在时返回 False。"""
+        if doc_id in self._lengths:
+            return False
+        counts = Counter(index_terms(text))
+        self._term_counts[doc_id] = counts
+        self._lengths[doc_id] = sum(counts.values())
+        self._total_length += self._lengths[doc_id]
+        for term in counts:
+            self._postings.setdefault(term, set()).add(doc_id)
+        self.added += 1
+        return True
+
+    def remove(self, doc_id: str):
+        counts = self._term_counts.pop(doc_id, None)
+        if counts is None:
+            return
+        self._total_length -= self._lengths.pop(doc_id)
+        for term in counts:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del self._postings[term]
+        self.removed += 1
+
+    def retain(self, doc_ids: set[str]) -> int:
+        """只保留给定的文档（删除已不在历史中的片段），返回删除的数量。"""
+        stale = [doc_id for doc_id in self._lengths if doc_id not in doc_ids]
+        for doc_id in stale:
+            self.remove(doc_id)
+        return len(stale)
+
+    def score(self, query: str) -> dict[str, float]:
+        """按 BM25 为包含查询词的文档打分；不含任何查询词的文档不出现在结果中。"""
+        if not self._lengths:
+            return {}
+        document_count = len(self._lengths)
+        average_length = self._total_length / document_count or 1.0
+
+        scores: dict[str, float] = {}
+        for term in set(index_terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id in postings:
+                frequency = self._term_counts[doc_id][term]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return scores
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "documents": len(self._lengths),
+            "terms": len(self._postings),
+            "added": self.added,
+            "removed": self.removed,
+        }
+
+
+def build_relevance_query(*parts: object) -> str:
+    """把错误信息、代码片段、终端输出等拼成检索查询（忽略空值）。"""
+    return "\n".join(str(part) for part in parts if part)
+
+
+_session_indexes: OrderedDict[str, BM25Index] = OrderedDict()
+
+
+def get_session_index(session_id: str) -> BM25Index:
+    """获取会话的索引，不存在时创建。"""
+    index = _session_indexes.get(session_id)
+    if index is None:
+        index = _session_indexes[session_id] = BM25Index()
+    _session_indexes.move_to_end(session_id)
+    while len(_session_indexes) > MAX_INDEXED_SESSIONS:
+        _session_indexes.popitem(last=False)
+    return index
+
+
+def drop_session_index(session_id: str):
+    """会话历史清空时丢弃其索引。"""
+    _session_indexes.pop(session_id, None)
+
+
+def get_relevance_index_stats(session_id: str) -> dict[str, int] | None:
+    """会话索引的统计信息；尚未建立索引时返回 None。"""
+    index = _session_indexes.get(session_id)
+    return index.stats() if index is not None else None
@@ -1,5 +1,7 @@
 """MCP服务器主文件 - 上级顾问"""
 
+import asyncio
+import atexit
 from contextlib import contextmanager
 import ctypes
 from ctypes import wintypes
@@ -12,15 +14,33 @@ import sys
 import tempfile
 import threading
 import time
+import uuid
 from pathlib import Path
 from typing import Any
 
-from fastmcp import FastMCP
+from fastmcp import Context, FastMCP
 from pydantic import Field
 
+from .blob_store import get_blob_store, is_blob_ref
+from .calibration import flush_token_calibrator, get_token_calibrator
 from .config import get_aurai_config, get_server_config
-from .llm import get_aurai_client
-from .prompts import build_consult_prompt, build_progress_prompt
+from .llm import (
+    PRIORITY_BACKGROUND,
+    HistoryMessageBuilder,
+    get_aurai_client,
+    get_call_stats,
+    get_endpoint_stats,
+    get_hedge_stats,
+    get_outbound_stats,
+    get_prompt_cache_stats,
+    get_rate_limit_stats,
+    invalidate_history_cache,
+    uses_single_source_history,
+)
+from .prompts import SYSTEM_PROMPT, build_consult_prompt, build_progress_prompt
+from .response_parser import get_response_parse_stats
+from .retrieval import build_relevance_query, drop_session_index, get_relevance_index_stats
+from .tokenizer import get_tokenizer
 from .utils import optimize_context_for_sync, prepare_file_for_sync
 
 # 配置日志
@@ -51,9 +71,56 @@ HISTORY_LOCK_RETRY_INTERVAL = 0.05
 # 历史摘要条目的类型
 SUMMARY_ENTRY_TYPE = "summary"
 
+# 历史日志（JSONL）的记录类型：检查点 / 追加条目 / 移除条目
+JOURNAL_CHECKPOINT_OP = "checkpoint"
+JOURNAL_APPEND_OP = "append"
+JOURNAL_REMOVE_OP = "remove"
+
+# 检查点之后累计多少条日志记录就重写一次检查点，控制回放成本与文件体积
+HISTORY_JOURNAL_CHECKPOINT_INTERVAL = 32
+
+# 各会话历史日志自上次检查点以来的记录数
+_journal_record_counts: dict[str, int] = {}
+
+# 正在后台运行的历史压缩任务（每个会话最多一个）
+_compaction_tasks: dict[str, asyncio.Task] = {}
+
+# 会话历史代次：每次清空 +1，后台压缩据此丢弃过期结果
+_history_generations: dict[str, int] = {}
+
+# blob 回收的最短间隔（秒）：回收在后台线程执行，间隔内的多次触发合并为一次
+BLOB_GC_MIN_INTERVAL_SECONDS = 60.0
+
+# 后台 blob 回收任务、是否有待处理的触发、上次回收完成的时间
+_blob_gc_task: asyncio.Task | None = None
+_blob_gc_requested = False
+_blob_gc_last_run: float | None = None
+
+# 各历史文件引用的 blob：{文件路径: ((mtime_ns, 大小), 引用集合)}，文件未变化时不必重新解析
+_history_file_blob_refs: dict[str, tuple[tuple[int, int], frozenset[str]]] = {}
+
 # 单条摘要信息的最大显示长度
 SUMMARY_FIELD_LIMIT = 160
 
+# 交给 LLM 压缩时，每个字段 / 既有摘要的最大长度，保证摘要输入有界
+SUMMARY_INPUT_FIELD_LIMIT = 800
+SUMMARY_INPUT_PREVIOUS_LIMIT = 2500
+
+# 估算历史预算时为当前问题预留的 tokens（系统提示词另计）
+COMPACTION_PROMPT_RESERVE_TOKENS = 2000
+
+# 压缩后保留的原始记录最多占历史预算的比例
+HISTORY_SUMMARY_KEEP_TOKEN_RATIO = 0.35
+
+# 仅由 token 触发时，可回收的 tokens 至少占历史预算的比例，避免为少量内容反复摘要
+HISTORY_SUMMARY_MIN_RECLAIM_RATIO = 0.1
+
+# 流式进度通知中每个字段最多展示的字符数（取最新生成的尾部）
+STREAM_PROGRESS_PREVIEW_CHARS = 500
+
+# 流式进度通知中的字段显示名
+STREAM_PROGRESS_LABELS = {"analysis": "分析", "guidance": "指导"}
+
 
 def _is_parent_process_alive() -> bool:
     """检测父进程（Claude Code）是否仍在运行。
@@ -167,6 +234,8 @@ def _start_stdio_idle_watchdog():
                             "stdio 服务已空闲 %.1f 秒且父进程已退出，进程将自动结束",
                             idle_seconds,
                         )
+                        # os._exit 不会执行 atexit，先补写节流中的校准数据
+                        flush_token_calibrator()
                         os._exit(0)
             except Exception:
                 logger.exception("watchdog 检查周期异常，将在下一周期重试")
@@ -179,6 +248,53 @@ def _start_stdio_idle_watchdog():
     thread.start()
 
 
+def _timed_out_result(response: dict, token_usage: dict) -> dict:
+    """调用超过时限时返回给下级 AI 的结果（本轮不计入历史，可直接重试）。"""
+    return {
+        "status": "error",
+        "stop_reason": "timed_out",
+        "analysis": response.get("analysis", ""),
+        "guidance": response.get("guidance", ""),
+        "action_items": [],
+        "needs_another_iteration": True,
+        "resolved": False,
+        "requires_human_intervention": False,
+        "token_usage": token_usage,
+    }
+
+
+def _build_stream_progress_reporter(ctx: Context | None):
+    """
+    将流式生成的部分 analysis/guidance 转成 MCP 进度通知。
+
+    客户端没有传入 progressToken 时 Context.report_progress 会自动忽略，
+    这里只负责把最新内容整理成简短预览。
+    """
+    if ctx is None:
+        return None
+
+    notification_count = 0
+
+    async def report(partial: dict[str, str]):
+        nonlocal notification_count
+        if not partial:
+            return
+
+        notification_count += 1
+        field, text = list(partial.items())[-1]
+        label = STREAM_PROGRESS_LABELS.get(field, field)
+        preview = text[-STREAM_PROGRESS_PREVIEW_CHARS:]
+        if len(text) > len(preview):
+            preview = "…" + preview
+        await ctx.report_progress(
+            progress=notification_count,
+            total=None,
+            message=f"[{label}] {preview}",
+        )
+
+    return report
+
+
 def _parse_json_param(value: Any, expect_type: type = dict) -> dict[str, Any] | list:
     """将参数统一解析为期望类型 -- 支持 JSON 字符串。"""
     if value is None:
@@ -286,13 +402,17 @@ def _history_file_lock(session_id: str | None):
 
 def _write_history_file_atomic(history_file: Path, history: list[dict[str, Any]]):
     """
-    原子写入历史文件。
+    原子写入历史检查点。
 
+    检查点是只有一行的 JSONL 日志（op=checkpoint），记录完整历史；
     先写入同目录临时文件，再用 replace 一次性替换正式文件，
     这样即便中途崩掉，也不容易留下半截 JSON。
     """
     history_file.parent.mkdir(parents=True, exist_ok=True)
-    payload = json.dumps(history, ensure_ascii=False, indent=2)
+    payload = json.dumps(
+        {"op": JOURNAL_CHECKPOINT_OP, "entries": history},
+        ensure_ascii=False,
+    ) + "\n"
 
     temp_path: Path | None = None
     try:
@@ -318,6 +438,263 @@ def _write_history_file_atomic(history_file: Path, history: list[dict[str, Any]]
                 logger.warning("清理历史临时文件失败: %s", temp_path, exc_info=True)
 
 
+def _append_history_journal(history_file: Path, records: list[dict[str, Any]]):
+    """
+    向历史日志末尾追加记录，每条记录一行。
+
+    追加只写入新增部分，代价与历史总量无关；
+    崩溃时最多留下半行，回放时会被跳过。
+    """
+    history_file.parent.mkdir(parents=True, exist_ok=True)
+    payload = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    # 上次写入被打断留下半行时，先换行，避免新记录和残行粘在一起
+    try:
+        with open(history_file, "rb") as existing:
+            existing.seek(0, os.SEEK_END)
+            if existing.tell() > 0:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    payload = "\n" + payload
+    except FileNotFoundError:
+        pass
+
+    with open(history_file, "a", encoding="utf-8") as journal:
+        journal.write(payload)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def _replay_history_journal(content: str) -> tuple[list[dict[str, Any]], int]:
+    """
+    回放 JSONL 历史日志。
+
+    Returns:
+        (回放得到的历史列表, 最后一个检查点之后的记录数)
+    """
+    history: list[dict[str, Any]] = []
+    records_since_checkpoint = 0
+
+    for line_number, line in enumerate(content.splitlines(), 1):
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning("历史日志第 %s 行损坏，已跳过", line_number)
+            continue
+
+        op = record.get("op") if isinstance(record, dict) else None
+        if op == JOURNAL_CHECKPOINT_OP:
+            entries = record.get("entries")
+            history = list(entries) if isinstance(entries, list) else []
+            records_since_checkpoint = 0
+        elif op == JOURNAL_APPEND_OP:
+            history.append(record.get("entry"))
+            records_since_checkpoint += 1
+        elif op == JOURNAL_REMOVE_OP:
+            removed_ids = set(record.get("entry_ids") or [])
+            history = [
+                entry for entry in history
+                if not (isinstance(entry, dict) and entry.get("entry_id") in removed_ids)
+            ]
+            records_since_checkpoint += 1
+        else:
+            logger.warning("历史日志第 %s 行的记录类型未知: %r，已跳过", line_number, op)
+
+    return history, records_since_checkpoint
+
+
+def _extract_legacy_history(document: Any, normalized: str) -> list[dict[str, Any]] | None:
+    """从旧版整文件 JSON（列表或按会话分组的字典）中提取某个会话的历史。"""
+    if isinstance(document, list):
+        return document
+
+    # 兼容旧版本或其他格式：如果内容是字典，尽量提取对应会话。
+    if isinstance(document, dict):
+        if normalized == DEFAULT_SESSION_ID and isinstance(document.get(DEFAULT_SESSION_ID), list):
+            return document[DEFAULT_SESSION_ID]
+        if isinstance(document.get(normalized), list):
+            return document[normalized]
+        if (
+            isinstance(document.get("sessions"), dict)
+            and isinstance(document["sessions"].get(normalized), list)
+        ):
+            return document["sessions"][normalized]
+
+        logger.warning(f"历史文件格式错误,无法识别会话 {normalized!r} 的历史结构")
+        return None
+
+    logger.warning(f"历史文件格式错误,期望list,实际{type(document)}")
+    return None
+
+
+def _parse_history_content(
+    content: str,
+    session_id: str | None,
+) -> tuple[list[dict[str, Any]] | None, int, bool]:
+    """
+    解析历史文件内容，兼容 JSONL 日志和旧版整文件 JSON。
+
+    Returns:
+        (历史列表, 检查点之后的日志记录数, 是否为旧版格式)；无法识别时历史列表为 None
+    """
+    normalized = _normalize_session_id(session_id)
+    stripped = content.strip()
+    if not stripped:
+        return [], 0, False
+
+    try:
+        document = json.loads(stripped)
+    except json.JSONDecodeError:
+        # 多行 JSONL 日志无法整体解析，走回放
+        document = None
+
+    if document is not None and not (isinstance(document, dict) and "op" in document):
+        return _extract_legacy_history(document, normalized), 0, True
+
+    history, records_since_checkpoint = _replay_history_journal(stripped)
+    return history, records_since_checkpoint, False
+
+
+def _iter_history_files() -> list[Path]:
+    """列出历史目录下所有会话的历史文件（含默认会话）。"""
+    history_file = Path(server_config.history_path)
+    if not history_file.parent.exists():
+        return []
+
+    history_files = [history_file] if history_file.exists() else []
+    for candidate in sorted(history_file.parent.glob(f"{history_file.stem}.*{history_file.suffix}")):
+        if candidate != history_file:
+            history_files.append(candidate)
+    return history_files
+
+
+def _entry_blob_refs(entries: list[dict[str, Any]]) -> set[str]:
+    """收集历史记录中引用到的 blob。"""
+    refs: set[str] = set()
+    for entry in entries:
+        if isinstance(entry, dict):
+            refs.update(
+                ref for ref in (entry.get("file_refs") or {}).values()
+                if is_blob_ref(ref)
+            )
+    return refs
+
+
+def _history_file_refs(history_file: Path) -> frozenset[str] | None:
+    """某个历史文件引用的 blob；文件未变化时直接使用上次解析的结果，无法读取或解析时返回 None。"""
+    cache_key = str(history_file)
+    try:
+        stat = history_file.stat()
+    except FileNotFoundError:
+        _history_file_blob_refs.pop(cache_key, None)
+        return frozenset()
+    except OSError:
+        logger.warning("blob 回收时读取历史文件失败，跳过本次回收: %s", history_file, exc_info=True)
+        return None
+
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _history_file_blob_refs.get(cache_key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    try:
+        content = history_file.read_text(encoding="utf-8")
+    except OSError:
+        logger.warning("blob 回收时读取历史文件失败，跳过本次回收: %s", history_file, exc_info=True)
+        return None
+    history, _, _ = _parse_history_content(content, DEFAULT_SESSION_ID)
+    if history is None:
+        logger.warning("blob 回收时无法解析历史文件，跳过本次回收: %s", history_file)
+        return None
+
+    refs = frozenset(_entry_blob_refs(history))
+    _history_file_blob_refs[cache_key] = (signature, refs)
+    return refs
+
+
+def _memory_blob_refs() -> set[str]:
+    """内存中所有会话引用的 blob。"""
+    live_refs: set[str] = set()
+    for history in list(_conversation_history.values()):
+        live_refs |= _entry_blob_refs(history)
+    return live_refs
+
+
+def _collect_blob_garbage(live_refs: set[str] | None = None):
+    """
+    回收不再被任何会话引用的文件内容。
+
+    blob 在会话间共享，因此除了内存中的会话（live_refs，缺省时现取），还要扫描磁盘上所有会话的历史文件；
+    未变化的文件使用缓存的引用集合。任一历史文件无法解析时放弃本次回收，宁可多留也不误删。
+    """
+    live_refs = set(live_refs) if live_refs is not None else _memory_blob_refs()
+
+    if server_config.enable_persistence:
+        for history_file in _iter_history_files():
+            refs = _history_file_refs(history_file)
+            if refs is None:
+                return
+            live_refs |= refs
+
+    try:
+        get_blob_store().collect_garbage(live_refs)
+    except OSError:
+        logger.exception("blob 垃圾回收失败")
+
+
+def _schedule_blob_gc():
+    """
+    请求一次 blob 回收。
+
+    有事件循环时在后台任务中执行（扫描和删除放进线程），与上次回收至少间隔 BLOB_GC_MIN_INTERVAL_SECONDS，
+    进行中或等待中的回收会合并新的请求；没有事件循环时直接回收。
+    刚写入的 blob 受 BLOB_GC_GRACE_SECONDS 保护，推迟回收不会误删。
+    """
+    global _blob_gc_task, _blob_gc_requested
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _collect_blob_garbage()
+        return
+
+    _blob_gc_requested = True
+    if _blob_gc_task is None or _blob_gc_task.done():
+        _blob_gc_task = loop.create_task(_run_blob_gc(), name="aurai-blob-gc")
+
+
+async def _run_blob_gc():
+    global _blob_gc_requested, _blob_gc_last_run
+    while _blob_gc_requested:
+        if _blob_gc_last_run is not None:
+            delay = _blob_gc_last_run + BLOB_GC_MIN_INTERVAL_SECONDS - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        _blob_gc_requested = False
+        # 内存中的历史只在事件循环线程中读取
+        live_refs = _memory_blob_refs()
+        try:
+            await asyncio.to_thread(_collect_blob_garbage, live_refs)
+        except Exception:
+            logger.exception("后台 blob 回收失败")
+        _blob_gc_last_run = time.monotonic()
+
+
+async def _wait_for_blob_gc():
+    """等待后台 blob 回收完成（主要用于测试）。"""
+    while _blob_gc_task is not None and not _blob_gc_task.done():
+        await asyncio.gather(_blob_gc_task, return_exceptions=True)
+
+
+def _ensure_entry_id(entry: dict[str, Any]) -> dict[str, Any]:
+    """为历史条目分配稳定 ID，供 llm 模块的消息分组缓存识别同一条目。"""
+    if not entry.get("entry_id"):
+        entry["entry_id"] = uuid.uuid4().hex[:16]
+    return entry
+
+
 def _truncate_summary_text(value: Any, limit: int = SUMMARY_FIELD_LIMIT) -> str:
     """将任意值裁剪为适合放进历史摘要的短文本。"""
     if value is None:
@@ -339,34 +716,47 @@ def _truncate_summary_text(value: Any, limit: int = SUMMARY_FIELD_LIMIT) -> str:
 
 def _format_history_entries_for_llm(entries: list[dict[str, Any]]) -> str:
     """将一批历史记录格式化为适合 LLM 阅读的文本。"""
+    def bounded(value: Any) -> str:
+        return _truncate_summary_text(value, SUMMARY_INPUT_FIELD_LIMIT)
+
     lines: list[str] = []
     for i, entry in enumerate(entries, 1):
         entry_type = entry.get("type", "unknown")
 
-        if entry_type == "consult":
+        if entry_type == SUMMARY_ENTRY_TYPE:
+            # 既有摘要折叠进新摘要（滚动摘要），否则更早的信息会在下一次压缩时丢失
+            covered = entry.get("covered_entry_count", 0)
+            summary_text = str(entry.get("summary_text", "")).strip()
+            if len(summary_text) > SUMMARY_INPUT_PREVIOUS_LIMIT:
+                summary_text = summary_text[:SUMMARY_INPUT_PREVIOUS_LIMIT - 1] + "…"
+            lines.append(f"### 既有摘要（覆盖更早的 {covered} 条记录）")
+            lines.append(summary_text)
+            lines.append("")
+
+        elif entry_type == "consult":
             lines.append(f"### 第{i}轮 · 咨询")
             lines.append(f"- 问题类型: {entry.get('problem_type', 'unknown')}")
-            lines.append(f"- 错误描述: {entry.get('error_message', '')}")
+            lines.append(f"- 错误描述: {bounded(entry.get('error_message', ''))}")
             if entry.get("had_answers"):
                 lines.append("- 本地 AI 已补充回答")
             resp = entry.get("response", {})
             if resp.get("questions"):
-                lines.append(f"- 顾问反问: {resp['questions']}")
+                lines.append(f"- 顾问反问: {bounded(resp['questions'])}")
             if resp.get("analysis"):
-                lines.append(f"- 顾问分析: {resp['analysis']}")
+                lines.append(f"- 顾问分析: {bounded(resp['analysis'])}")
             if resp.get("guidance"):
-                lines.append(f"- 顾问建议: {resp['guidance']}")
+                lines.append(f"- 顾问建议: {bounded(resp['guidance'])}")
             lines.append("")
 
         elif entry_type == "progress":
             lines.append(f"### 第{i}轮 · 进度报告")
-            lines.append(f"- 执行操作: {entry.get('actions_taken', '')}")
+            lines.append(f"- 执行操作: {bounded(entry.get('actions_taken', ''))}")
             lines.append(f"- 执行结果: {entry.get('result', '')}")
             if entry.get("new_error"):
-                lines.append(f"- 新错误: {entry['new_error']}")
+                lines.append(f"- 新错误: {bounded(entry['new_error'])}")
             resp = entry.get("response", {})
             if resp.get("guidance"):
-                lines.append(f"- 顾问后续建议: {resp['guidance']}")
+                lines.append(f"- 顾问后续建议: {bounded(resp['guidance'])}")
             lines.append("")
 
         elif entry_type == "sync_context":
@@ -382,12 +772,19 @@ def _format_history_entries_for_llm(entries: list[dict[str, Any]]) -> str:
     return "\n".join(lines)
 
 
-async def _generate_llm_summary(entries: list[dict[str, Any]]) -> dict[str, Any] | None:
-    """调用上级 AI 将多条早期历史总结为结构化复盘报告。"""
+async def _generate_llm_summary(
+    entries: list[dict[str, Any]],
+    session_id: str | None = None,
+) -> dict[str, Any] | None:
+    """调用上级 AI 将多条早期历史总结为结构化复盘报告（走后台优先级，不抢占咨询请求）。"""
     if not entries:
         return None
 
     history_text = _format_history_entries_for_llm(entries)
+    covered_entry_count = sum(
+        entry.get("covered_entry_count", 0) if entry.get("type") == SUMMARY_ENTRY_TYPE else 1
+        for entry in entries
+    )
 
     prompt = f"""你是远程技术顾问，正在协助本地 AI 排查编程问题。现在需要你对当前会话的早期对话进行复盘总结，以便之后的轮次能快速恢复上下文。
 
@@ -419,6 +816,7 @@ async def _generate_llm_summary(entries: list[dict[str, Any]]) -> dict[str, Any]
 ## 输出要求
 - 总长度控制在 2000 字以内
 - 优先保留能指导后续排查的关键信息
+- 如果输入中包含「既有摘要」，把其中仍然有效的结论合并进新报告，不要丢弃更早的信息
 - 用中文输出，技术术语保留原文
 - 不需要问候语或"我已理解"之类的过渡句，直接输出报告内容"""
 
@@ -427,6 +825,8 @@ async def _generate_llm_summary(entries: list[dict[str, Any]]) -> dict[str, Any]
         response, _ = await client.chat(
             user_message=prompt,
             system_prompt="你是经验丰富的技术顾问。请按照用户要求的格式输出，只输出报告内容本身。",
+            session_id=session_id,
+            priority=PRIORITY_BACKGROUND,
         )
         summary_text = response.get("guidance", "") or response.get("analysis", "") or str(response)
         if not summary_text.strip() or summary_text == str(response):
@@ -436,42 +836,97 @@ async def _generate_llm_summary(entries: list[dict[str, Any]]) -> dict[str, Any]
                 for entry in entries[:10]
             )
 
-        return {
+        return _ensure_entry_id({
             "type": SUMMARY_ENTRY_TYPE,
             "summary_text": summary_text[:2500],  # 防止过长，允许略超 2000
-            "covered_entry_count": len(entries),
-        }
+            "covered_entry_count": covered_entry_count,
+        })
     except Exception:
         logger.exception("LLM 摘要生成失败，回退到截断拼接")
         # 回退：用格式化文本截断
         fallback = _format_history_entries_for_llm(entries[:10])
-        return {
+        return _ensure_entry_id({
             "type": SUMMARY_ENTRY_TYPE,
             "summary_text": fallback[:2000],
-            "covered_entry_count": len(entries),
-        }
+            "covered_entry_count": covered_entry_count,
+        })
 
 
-async def _maybe_compact_history(session_id: str | None):
-    """接近 max_history 上限时，由 LLM 将早期对话总结为结构化复盘报告。"""
-    if not server_config.enable_history_summary:
+def _history_token_profile(history: list[dict[str, Any]]) -> tuple[list[int], int] | None:
+    """
+    估算每条历史记录的 tokens，以及发送时可分配给历史消息的预算。
+
+    预算与 AuraiClient._fit_messages_to_context_window 的计算方式一致
+    （上下文窗口扣除输出预算、系统提示词和预留的当前问题）。
+    上级 AI 配置不可用时返回 None，此时只按条数触发。
+    """
+    try:
+        builder = HistoryMessageBuilder(get_aurai_config())
+        entry_tokens = [builder.estimate_entry_tokens(entry) for entry in history]
+        budget = builder.history_token_budget(
+            builder.count_text_tokens(SYSTEM_PROMPT) + COMPACTION_PROMPT_RESERVE_TOKENS
+        )
+    except Exception:
+        logger.debug("无法估算历史 tokens，历史压缩仅按条数触发", exc_info=True)
+        return None
+    return entry_tokens, budget
+
+
+def _index_synced_files(session_id: str):
+    """同步文件后增量更新会话的相关度索引，之后的调用只需处理新增片段。"""
+    try:
+        builder = HistoryMessageBuilder(get_aurai_config())
+        if not getattr(builder.config, "relevance_selection", True):
+            return
+        index = builder.index_session_history(_get_session_history(session_id), session_id)
+    except Exception:
+        logger.debug("更新相关度索引失败，将在下次调用时补建", exc_info=True)
         return
+    logger.debug("会话 %r 的相关度索引: %s", session_id, index.stats())
 
-    normalized = _normalize_session_id(session_id)
-    history = _get_session_history(normalized)
+
+def _select_entries_to_compact(history: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    挑选需要交给 LLM 压缩的早期记录。
+
+    触发条件（满足其一）：
+    - 历史估算 tokens 达到历史预算的 history_summary_token_ratio
+    - 原始记录条数接近 max_history（80%），避免硬上限直接丢弃未摘要的记录
+
+    从最新记录往前保留原始记录，直到条数达到 max_history 的 60%
+    或 tokens 达到历史预算的 HISTORY_SUMMARY_KEEP_TOKEN_RATIO；
+    最近一次 sync_context 总是保留。既有摘要总会被选中，折叠进新摘要。
+    未达到阈值时返回空列表。
+    """
     raw_indexes = [
         index for index, entry in enumerate(history)
         if entry.get("type") != SUMMARY_ENTRY_TYPE
     ]
+    if not raw_indexes:
+        return []
 
-    # 仅在接近上限时触发
-    trigger_at = int(server_config.max_history * 0.8)
-    if len(raw_indexes) < trigger_at:
-        return
+    profile = _history_token_profile(history)
+    count_triggered = len(raw_indexes) >= int(server_config.max_history * 0.8)
+    token_triggered = False
+    if profile is not None:
+        entry_tokens, budget = profile
+        token_triggered = sum(entry_tokens) >= budget * server_config.history_summary_token_ratio
+    if not count_triggered and not token_triggered:
+        return []
 
-    # 保留最近 60% 的原始记录，其余交给 LLM 压缩
+    # 从最新往前保留原始记录，其余交给 LLM 压缩
     keep_count = int(server_config.max_history * 0.6)
-    keep_indexes = set(raw_indexes[-keep_count:])
+    keep_token_budget = budget * HISTORY_SUMMARY_KEEP_TOKEN_RATIO if profile is not None else None
+    keep_indexes: set[int] = set()
+    kept_tokens = 0
+    for index in reversed(raw_indexes):
+        if len(keep_indexes) >= keep_count:
+            break
+        if keep_token_budget is not None:
+            if keep_indexes and kept_tokens + entry_tokens[index] > keep_token_budget:
+                break
+            kept_tokens += entry_tokens[index]
+        keep_indexes.add(index)
 
     # 确保最近一次 sync_context 不被压掉
     latest_sync_index = None
@@ -482,32 +937,119 @@ async def _maybe_compact_history(session_id: str | None):
     if latest_sync_index is not None and latest_sync_index not in keep_indexes:
         keep_indexes.add(latest_sync_index)
 
-    summary_source_indexes = [
-        index for index in range(len(history))
-        if index not in keep_indexes
-    ]
-    if not summary_source_indexes:
-        return
+    compact_indexes = [index for index in range(len(history)) if index not in keep_indexes]
 
-    entries_to_summarize = [history[index] for index in summary_source_indexes]
-    logger.info("会话 %r: 触发 LLM 摘要压缩 (%s 条 → 1 条报告)", normalized, len(entries_to_summarize))
+    # 只剩旧摘要可压时没有新信息，避免反复为同一份摘要再生成摘要
+    raw_to_compact = [index for index in compact_indexes if history[index].get("type") != SUMMARY_ENTRY_TYPE]
+    if not raw_to_compact:
+        return []
 
-    summary_entry = await _generate_llm_summary(entries_to_summarize)
-    if not summary_entry:
-        return
+    # 仅由 token 触发时（例如最新的大文件同步本身就占满预算），可回收的量太少就不值得再摘要
+    if not count_triggered:
+        reclaimable = sum(entry_tokens[index] for index in raw_to_compact)
+        if reclaimable < budget * HISTORY_SUMMARY_MIN_RECLAIM_RATIO:
+            return []
 
-    new_history = [summary_entry]
-    for index, entry in enumerate(history):
-        if index in keep_indexes:
-            new_history.append(entry)
+    return [history[index] for index in compact_indexes]
 
-    history[:] = new_history
-    logger.info(
-        "会话 %r: LLM 摘要完成，压缩 %s 条，保留 %s 条原始记录",
-        normalized,
-        len(entries_to_summarize),
-        len(new_history) - 1,
+
+def _maybe_compact_history(session_id: str | None) -> bool:
+    """
+    历史 tokens 接近历史预算或条数接近 max_history 时，在后台启动 LLM 摘要压缩。
+
+    当前请求不再等待摘要的额外 LLM 往返；同一会话同时只运行一个压缩任务，
+    任务完成前由 _add_to_history 的硬上限裁剪兜底。
+
+    Returns:
+        是否启动了新的后台压缩任务
+    """
+    if not server_config.enable_history_summary:
+        return False
+
+    normalized = _normalize_session_id(session_id)
+    running = _compaction_tasks.get(normalized)
+    if running is not None and not running.done():
+        return False
+
+    history = _get_session_history(normalized)
+    entries_to_summarize = _select_entries_to_compact(history)
+    if not entries_to_summarize:
+        return False
+
+    logger.info("会话 %r: 后台启动 LLM 摘要压缩 (%s 条 → 1 条报告)", normalized, len(entries_to_summarize))
+    task = asyncio.get_running_loop().create_task(
+        _run_history_compaction(
+            normalized,
+            list(entries_to_summarize),
+            _history_generations.get(normalized, 0),
+        ),
+        name=f"aurai-compact-{normalized}",
     )
+    _compaction_tasks[normalized] = task
+    return True
+
+
+async def _run_history_compaction(
+    normalized: str,
+    entries_to_summarize: list[dict[str, Any]],
+    generation: int,
+):
+    """
+    后台压缩任务：为快照生成摘要，再原子地替换回当前历史。
+
+    替换时只移除快照中的记录，期间新追加的记录全部保留；
+    如果会话在此期间被清空（代次变化），丢弃本次摘要。
+    """
+    current_task = asyncio.current_task()
+    try:
+        summary_entry = await _generate_llm_summary(entries_to_summarize, normalized)
+        if not summary_entry:
+            return
+
+        if _history_generations.get(normalized, 0) != generation:
+            logger.info("会话 %r: 摘要期间历史已被清空，丢弃本次压缩结果", normalized)
+            return
+
+        history = _get_session_history(normalized)
+        covered_ids = {entry.get("entry_id") for entry in entries_to_summarize}
+        remaining = [entry for entry in history if entry.get("entry_id") not in covered_ids]
+        history[:] = [summary_entry, *remaining]
+        invalidate_history_cache(entries_to_summarize)
+        logger.info(
+            "会话 %r: LLM 摘要完成，压缩 %s 条，保留 %s 条原始记录",
+            normalized,
+            len(entries_to_summarize),
+            len(remaining),
+        )
+
+        _save_history_to_file(normalized)
+        _schedule_blob_gc()
+    except asyncio.CancelledError:
+        logger.info("会话 %r: 后台压缩已取消", normalized)
+        raise
+    except Exception:
+        logger.exception("会话 %r: 后台压缩失败", normalized)
+    finally:
+        if _compaction_tasks.get(normalized) is current_task:
+            del _compaction_tasks[normalized]
+
+    # 压缩期间追加的记录可能再次逼近上限，顺延下一轮
+    _maybe_compact_history(normalized)
+
+
+async def _wait_for_history_compaction(session_id: str | None = None):
+    """等待某个会话（或全部会话）的后台压缩完成，包括完成后顺延的后续压缩。"""
+    while True:
+        if session_id is None:
+            tasks = list(_compaction_tasks.values())
+        else:
+            task = _compaction_tasks.get(_normalize_session_id(session_id))
+            tasks = [task] if task is not None else []
+
+        pending = [task for task in tasks if not task.done()]
+        if not pending:
+            return
+        await asyncio.gather(*pending, return_exceptions=True)
 
 
 def _ensure_session_loaded(session_id: str | None):
@@ -565,12 +1107,22 @@ def _clear_history(
         try:
             with _history_file_lock(normalized):
                 _write_history_file_atomic(history_file, [])
+            _journal_record_counts[normalized] = 0
         except Exception:
             logger.exception("清空历史文件失败: %s，内存历史仍然清空", history_file)
         else:
             logger.debug("已写入空历史文件: %s", history_file)
 
+    # 让进行中的后台压缩作废，避免旧摘要在清空后被写回
+    _history_generations[normalized] = _history_generations.get(normalized, 0) + 1
+    compaction_task = _compaction_tasks.pop(normalized, None)
+    if compaction_task is not None and not compaction_task.done():
+        compaction_task.cancel()
+
+    invalidate_history_cache(history)
     history.clear()
+    drop_session_index(normalized)
+    _schedule_blob_gc()
 
     logger.info(f"{log_prefix} 会话 {normalized!r} 的对话历史已清空（清除 {history_count} 条记录）")
     if reason:
@@ -580,29 +1132,36 @@ def _clear_history(
 
 
 async def _add_to_history(entry: dict[str, Any], session_id: str | None = None):
-    """添加到某个会话的对话历史，必要时触发 LLM 摘要压缩。"""
+    """添加到某个会话的对话历史，必要时在后台触发 LLM 摘要压缩。"""
     normalized = _normalize_session_id(session_id)
     history = _get_session_history(normalized)
-    history.append(entry)
+    history.append(_ensure_entry_id(entry))
 
-    await _maybe_compact_history(normalized)
+    _maybe_compact_history(normalized)
 
-    # 最终兜底，避免极端配置下历史条数仍超限
+    # 硬上限兜底：后台压缩完成之前，或极端配置下，历史条数仍不能超限
+    removed_ids: list[str] = []
     while len(history) > server_config.max_history:
         if history[0].get("type") == SUMMARY_ENTRY_TYPE:
-            history.pop(1)
+            removed = history.pop(1)
         else:
-            history.pop(0)
+            removed = history.pop(0)
+        removed_ids.append(removed.get("entry_id"))
 
-    # 保存到文件(如果启用持久化)
-    if server_config.enable_persistence:
-        _save_history_to_file(normalized)
+    # 保存到文件(如果启用持久化)：只追加本轮变更，压缩结果由后台任务写检查点
+    records = [{"op": JOURNAL_APPEND_OP, "entry": entry}]
+    if removed_ids:
+        records.append({"op": JOURNAL_REMOVE_OP, "entry_ids": removed_ids})
+    _append_history_records(normalized, records)
 
 
 def _load_history_from_file(session_id: str | None = None) -> list[dict[str, Any]]:
     """
     从文件加载某个会话的对话历史
 
+    支持 JSONL 日志（回放检查点与后续记录）以及旧版整文件 JSON。
+    旧版格式或缺少 entry_id 的记录会在加载后立即改写为检查点。
+
     Returns:
         对话历史列表,如果加载失败返回空列表
     """
@@ -618,37 +1177,29 @@ def _load_history_from_file(session_id: str | None = None) -> list[dict[str, Any
             if not history_file.exists():
                 logger.info(f"历史文件不存在: {history_file}")
                 _write_history_file_atomic(history_file, [])
+                _journal_record_counts[normalized] = 0
                 return []
 
-            # 读取并解析JSON
             content = history_file.read_text(encoding="utf-8")
-            history = json.loads(content)
-
-            if not isinstance(history, list):
-                # 兼容旧版本或其他格式：如果内容是字典，尽量提取对应会话。
-                if isinstance(history, dict):
-                    if normalized == DEFAULT_SESSION_ID and isinstance(history.get(DEFAULT_SESSION_ID), list):
-                        history = history[DEFAULT_SESSION_ID]
-                    elif isinstance(history.get(normalized), list):
-                        history = history[normalized]
-                    elif (
-                        isinstance(history.get("sessions"), dict)
-                        and isinstance(history["sessions"].get(normalized), list)
-                    ):
-                        history = history["sessions"][normalized]
-                    else:
-                        logger.warning(f"历史文件格式错误,无法识别会话 {normalized!r} 的历史结构")
-                        return []
-                else:
-                    logger.warning(f"历史文件格式错误,期望list,实际{type(history)}")
-                    return []
+            history, records_since_checkpoint, is_legacy = _parse_history_content(content, normalized)
+            if history is None:
+                return []
+
+            history = [entry for entry in history if isinstance(entry, dict)]
+            missing_ids = any(not entry.get("entry_id") for entry in history)
+            for entry in history:
+                _ensure_entry_id(entry)
+
+            if is_legacy or missing_ids:
+                _write_history_file_atomic(history_file, history)
+                records_since_checkpoint = 0
+                logger.info("已将会话 %r 的历史文件迁移为日志格式: %s", normalized, history_file)
+
+            _journal_record_counts[normalized] = records_since_checkpoint
 
         logger.info(f"从文件加载了 {len(history)} 条历史记录，会话: {normalized!r}")
         return history
 
-    except json.JSONDecodeError:
-        logger.exception("历史文件 JSON 解析失败: %s", history_file)
-        return []
     except TimeoutError:
         logger.error("获取历史文件锁超时: %s", history_file)
         return []
@@ -659,9 +1210,9 @@ def _load_history_from_file(session_id: str | None = None) -> list[dict[str, Any
 
 def _save_history_to_file(session_id: str | None = None):
     """
-    保存某个会话的对话历史到文件
+    将某个会话的完整对话历史写为检查点
 
-    注意: 此函数应该在每次添加历史后调用
+    历史被压缩或需要整体重写时调用；普通新增走 _append_history_records。
     如果保存失败,仅记录警告,不中断服务
     """
     if not server_config.enable_persistence:
@@ -674,6 +1225,7 @@ def _save_history_to_file(session_id: str | None = None):
     try:
         with _history_file_lock(normalized):
             _write_history_file_atomic(history_file, history)
+        _journal_record_counts[normalized] = 0
 
         logger.debug(f"已保存会话 {normalized!r} 的 {len(history)} 条历史记录到文件")
 
@@ -683,6 +1235,36 @@ def _save_history_to_file(session_id: str | None = None):
         logger.exception("保存历史文件 I/O 错误: %s", history_file)
 
 
+def _append_history_records(session_id: str | None, records: list[dict[str, Any]]):
+    """
+    向某个会话的历史日志追加记录
+
+    检查点之后累计的记录超过 HISTORY_JOURNAL_CHECKPOINT_INTERVAL 时，
+    改为写入完整检查点，避免日志无限增长、回放变慢。
+    """
+    if not server_config.enable_persistence or not records:
+        return
+
+    normalized = _normalize_session_id(session_id)
+    pending = _journal_record_counts.get(normalized, 0) + len(records)
+    if pending > HISTORY_JOURNAL_CHECKPOINT_INTERVAL:
+        _save_history_to_file(normalized)
+        return
+
+    history_file = _get_history_file_for_session(normalized)
+    try:
+        with _history_file_lock(normalized):
+            _append_history_journal(history_file, records)
+        _journal_record_counts[normalized] = pending
+
+        logger.debug(f"已向会话 {normalized!r} 的历史日志追加 {len(records)} 条记录")
+
+    except TimeoutError:
+        logger.error("追加历史日志时获取锁超时: %s", history_file)
+    except OSError:
+        logger.exception("追加历史日志 I/O 错误: %s", history_file)
+
+
 @mcp.tool()
 async def consult_aurai(
     problem_type: str = Field(
@@ -710,6 +1292,7 @@ async def consult_aurai(
         default=None,
         description="会话隔离标识。不同任务用不同 ID 避免上下文串扰",
     ),
+    ctx: Context | None = None,
 ) -> dict[str, Any]:
     """向远程技术顾问咨询编程问题。支持多轮对话：顾问反问 → 你搜集信息 → 再次调用。
 
@@ -723,6 +1306,7 @@ async def consult_aurai(
     - "resolved" → 问题已解决，历史已自动清空，可开始新问题
     - "advisor_gave_up" → 顾问认为无法解决，需人工介入
     - "max_iterations" → 达到轮数上限（默认 50 轮），历史已自动清空
+    - "timed_out" → 超过调用时限（AURAI_CALL_TIMEOUT），本轮未计入历史，可直接重试
     - null → 对话尚未结束，继续迭代
 
     is_new_question=true 会清空当前会话的全部历史。
@@ -785,14 +1369,31 @@ async def consult_aurai(
         iteration=len(session_history),
         conversation_history=_get_history(normalized_session_id),
         history_turns=server_config.prompt_history_turns,
+        history_references=uses_single_source_history(config),
     )
 
-    # 调用上级AI，传递对话历史
+    # 调用上级AI，传递对话历史；历史超出预算时按与本次错误的相关度保留已同步的文件片段
     client = get_aurai_client()
-    response, token_usage = await client.chat(
-        user_message=prompt,
-        conversation_history=_get_history(normalized_session_id)
-    )
+    try:
+        response, token_usage = await client.chat(
+            user_message=prompt,
+            conversation_history=_get_history(normalized_session_id),
+            on_progress=_build_stream_progress_reporter(ctx),
+            session_id=normalized_session_id,
+            relevance_query=build_relevance_query(
+                error_message,
+                code_snippet,
+                current_context.get("terminal_output"),
+            ),
+        )
+    except asyncio.CancelledError:
+        # 客户端取消了本次调用：上游请求已中止，本轮不写入历史
+        logger.info(f"会话 {normalized_session_id} 的调用已取消，本轮不写入历史")
+        raise
+
+    if token_usage.get("timed_out"):
+        # 超过调用时限：没有上级顾问的回复，本轮不写入历史
+        return _timed_out_result(response, token_usage)
 
     # 记录到历史
     await _add_to_history({
@@ -923,6 +1524,7 @@ async def sync_context(
         all_files = parsed_files + temp_files
 
         # 读取文件内容（文本文件会自动转成 .txt/.md 的发送名）
+        # 内容写入 blob 存储，历史记录中只保存引用
         file_contents: dict[str, str] = {}
         uploaded_files: list[dict[str, Any]] = []
 
@@ -971,17 +1573,22 @@ async def sync_context(
         if skipped_files:
             logger.warning(f"[跳过] 共跳过 {len(skipped_files)} 个文件: {skipped_files}")
 
-        # 记录上下文信息（包含所有文件内容，供上级AI读取）
+        # 记录上下文信息（文件内容以 blob 引用保存，发送时再按需读取）
+        blob_store = get_blob_store()
         entry = {
             "type": "sync_context",
             "operation": operation,
             "files": parsed_files,
             "uploaded_files": uploaded_files,
             "temp_files": temp_files,  # 记录临时文件
-            "file_contents": file_contents,  # 所有文件内容
+            "file_refs": {
+                path: blob_store.put(content)
+                for path, content in file_contents.items()
+            },
             "project_info": optimized_project_info or {},
         }
         await _add_to_history(entry, normalized_session_id)
+        _index_synced_files(normalized_session_id)
 
         auto_converted_count = sum(1 for item in uploaded_files if item["auto_converted"])
         logger.info(
@@ -1043,6 +1650,7 @@ async def report_progress(
         default=None,
         description="会话隔离标识。需与 consult_aurai 使用相同的 session_id",
     ),
+    ctx: Context | None = None,
 ) -> dict[str, Any]:
     """按顾问指导执行操作后，汇报结果并获取下一步指示。
 
@@ -1082,14 +1690,27 @@ async def report_progress(
         feedback=feedback,
         conversation_history=_get_history(normalized_session_id),
         history_turns=server_config.prompt_history_turns,
+        history_references=uses_single_source_history(config),
     )
 
     # 调用上级AI，传递对话历史
     client = get_aurai_client()
-    response, token_usage = await client.chat(
-        user_message=prompt,
-        conversation_history=_get_history(normalized_session_id)
-    )
+    try:
+        response, token_usage = await client.chat(
+            user_message=prompt,
+            conversation_history=_get_history(normalized_session_id),
+            on_progress=_build_stream_progress_reporter(ctx),
+            session_id=normalized_session_id,
+            relevance_query=build_relevance_query(new_error, feedback),
+        )
+    except asyncio.CancelledError:
+        # 客户端取消了本次调用：上游请求已中止，本轮不写入历史
+        logger.info(f"会话 {normalized_session_id} 的调用已取消，本轮不写入历史")
+        raise
+
+    if token_usage.get("timed_out"):
+        # 超过调用时限：没有上级顾问的回复，本轮不写入历史
+        return _timed_out_result(response, token_usage)
 
     # 记录到历史 — 存副本避免后续修改污染持久化数据
     await _add_to_history({
@@ -1127,7 +1748,7 @@ async def get_status(
         description="会话标识。留空查默认会话",
     ),
 ) -> dict[str, Any]:
-    """查看当前会话状态：历史条数、迭代次数、模型、进程空闲时间等。用于排查或确认会话配置。"""
+    """查看当前会话状态：历史条数、迭代次数、模型、端点健康状况、token 估算误差、进程空闲时间等。用于排查或确认会话配置。"""
     _mark_process_activity("get_status")
     normalized_session_id = _normalize_session_id(session_id)
     aurai_config = get_aurai_config()
@@ -1150,6 +1771,22 @@ async def get_status(
             "high_watermark_pct": int(aurai_config.context_high_watermark * 100),
             "temperature": aurai_config.temperature,
         },
+        "endpoints": get_endpoint_stats(),
+        "outbound_queue": get_outbound_stats(),
+        "rate_limit": get_rate_limit_stats(),
+        "hedging": get_hedge_stats(),
+        "prompt_cache": {
+            "cache_friendly_layout": aurai_config.prompt_cache_layout,
+            **get_prompt_cache_stats(),
+        },
+        "tokenizer": get_tokenizer(aurai_config.model, aurai_config.tokenizer_files).stats(),
+        "token_calibration": get_token_calibrator().stats(),
+        "response_parsing": get_response_parse_stats(),
+        "calls": get_call_stats(),
+        "relevance_index": {
+            "enabled": aurai_config.relevance_selection,
+            **(get_relevance_index_stats(normalized_session_id) or {}),
+        },
     }
 
 
@@ -1164,6 +1801,7 @@ def main():
     # 初始化对话历史持久化
     _conversation_history = {}
     _loaded_sessions = set()
+    _journal_record_counts.clear()
     _stdio_watchdog_started = False
     _mark_process_activity("server_start")
     if server_config.enable_persistence:
@@ -1172,6 +1810,7 @@ def main():
     else:
         logger.info("持久化未启用,使用内存模式")
 
+    atexit.register(flush_token_calibrator)
     _start_stdio_idle_watchdog()
     mcp.run()
 
@@ -0,0 +1,331 @@
+"""精确分词计数模块
+
+对能在本地提供词表文件的模型，用 BPE 分词得到精确的 token 数，
+代替 estimate_tokens 的字符数估算；未配置词表时仍使用估算（默认行为）。
+
+支持的离线词表格式：
+- tiktoken 格式（*.tiktoken，每行 "base64 编码的 token 排名"），如 cl100k_base / o200k_base；
+- GPT-2 格式（vocab.json + merges.txt，可传目录或 vocab.json 路径）。
+
+tiktoken 格式词表按文件名选择预分词正则（o200k_* 用 o200k 的规则，r50k_* / p50k_* 用 GPT-2 的规则，
+其余按 cl100k 处理）。
+
+全程不访问网络。安装了 tiktoken 时用它的原生实现加速 tiktoken 格式词表，
+否则使用纯 Python 实现；两者计数一致。纯 Python 实现的预分词依赖 regex 模块，
+缺少时用标准库正则近似，此时计数不再视为精确，仍交给自校准修正。
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+from .utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+try:
+    import regex as _regex
+except ImportError:  # pragma: no cover - 取决于运行环境
+    _regex = None
+
+try:
+    import tiktoken as _tiktoken
+except ImportError:  # pragma: no cover - 取决于运行环境
+    _tiktoken = None
+
+# 文本 token 数的 LRU 缓存条目数（按文本哈希缓存，重复的历史内容不会重复分词）
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+# 短于该长度的文本直接分词，不进入缓存（哈希与分词的开销相当）
+TOKEN_COUNT_CACHE_MIN_CHARS = 64
+
+# 预分词片段的 BPE 结果缓存条目数（常见单词在同一文本中反复出现）
+PIECE_CACHE_SIZE = 65536
+
+# 预分词正则（\p{L} / \p{N} 需要 regex 模块）
+CL100K_PATTERN = (
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}"
+    r"| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+O200K_PATTERN = (
+    r"[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?"
+    r"|[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?"
+    r"|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+GPT2_PATTERN = r"'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"
+
+# tiktoken 格式词表：文件名前缀 → 预分词正则（未列出的按 cl100k 处理）
+_TIKTOKEN_PATTERNS = (
+    ("o200k", O200K_PATTERN),
+    ("cl100k", CL100K_PATTERN),
+    ("p50k", GPT2_PATTERN),
+    ("r50k", GPT2_PATTERN),
+)
+
+# 没有 regex 模块时的标准库近似：[^\W\d_] 近似 \p{L}，\d 近似 \p{N}
+_STDLIB_PATTERNS = {
+    CL100K_PATTERN: (
+        r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}"
+        r"| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+    ),
+    # 大小写只区分 ASCII 大写字母
+    O200K_PATTERN: (
+        r"(?:[^\r\n\w]|_)?[A-Z]*[^\W\d_A-Z]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?"
+        r"|(?:[^\r\n\w]|_)?[A-Z]+[^\W\d_A-Z]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?"
+        r"|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n/]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+    ),
+    GPT2_PATTERN: r"'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+",
+}
+
+
+def _compile_pattern(pattern: str):
+    if _regex is not None:
+        return _regex.compile(pattern)
+    return re.compile(_STDLIB_PATTERNS[pattern])
+
+
+def tiktoken_pattern(path: Path) -> str:
+    """按词表文件名选择 tiktoken 格式词表的预分词正则。"""
+    name = path.name.lower()
+    for prefix, pattern in _TIKTOKEN_PATTERNS:
+        if name.startswith(prefix):
+            return pattern
+    logger.debug("未识别的 tiktoken 词表名，按 cl100k 规则预分词: %s", path)
+    return CL100K_PATTERN
+
+
+def _gpt2_byte_decoder() -> dict[str, int]:
+    """GPT-2 词表中可见字符到原始字节的映射（bytes_to_unicode 的逆映射）。"""
+    printable = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    byte_values = printable[:]
+    code_points = printable[:]
+    extra = 0
+    for value in range(256):
+        if value not in byte_values:
+            byte_values.append(value)
+            code_points.append(256 + extra)
+            extra += 1
+    return {chr(code_point): value for code_point, value in zip(code_points, byte_values)}
+
+
+def load_tiktoken_ranks(path: Path) -> dict[bytes, int]:
+    """读取 tiktoken 格式词表：每行 "base64(token) rank"。"""
+    ranks: dict[bytes, int] = {}
+    for line in path.read_bytes().splitlines():
+        if not line.strip():
+            continue
+        token, rank = line.split()
+        ranks[base64.b64decode(token)] = int(rank)
+    return ranks
+
+
+def load_gpt2_ranks(vocab_path: Path, merges_path: Path) -> dict[bytes, int]:
+    """
+    读取 GPT-2 格式词表并转换为按合并顺序排名的 {token 字节: rank}。
+
+    单字节排在最前，之后第 n 条合并规则产生的 token 排名为 256 + n，
+    与按合并顺序逐步合并的结果一致。
+    """
+    byte_decoder = _gpt2_byte_decoder()
+
+    def to_bytes(symbol: str) -> bytes:
+        return bytes(byte_decoder[ch] for ch in symbol)
+
+    vocab = json.loads(vocab_path.read_text(encoding="utf-8"))
+    ranks = {bytes([value]): value for value in range(256)}
+    for line in merges_path.read_text(encoding="utf-8").splitlines():
+        if not line or line.startswith("#version"):
+            continue
+        first, second = line.split()
+        merged = to_bytes(first) + to_bytes(second)
+        if merged not in ranks:
+            ranks[merged] = len(ranks)
+
+    # 词表里存在、却无法由合并规则得到的 token 对计数没有影响，这里只做一致性提示
+    missing = sum(1 for symbol in vocab if to_bytes(symbol) not in ranks)
+    if missing:
+        logger.debug("GPT-2 词表中有 %s 个 token 无对应合并规则: %s", missing, vocab_path)
+    return ranks
+
+
+def bpe_token_count(piece: bytes, ranks: dict[bytes, int]) -> int:
+    """对单个预分词片段做字节级 BPE，返回 token 数。"""
+    if piece in ranks:
+        return 1
+
+    parts = [piece[i:i + 1] for i in range(len(piece))]
+    while len(parts) > 1:
+        best_rank = None
+        best_index = -1
+        for index in range(len(parts) - 1):
+            rank = ranks.get(parts[index] + parts[index + 1])
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best_rank = rank
+                best_index = index
+        if best_rank is None:
+            break
+        parts[best_index:best_index + 2] = [parts[best_index] + parts[best_index + 1]]
+    return len(parts)
+
+
+class Tokenizer:
+    """分词计数接口。exact 为 True 时计数与服务商一致，不再需要校准。"""
+
+    name = "heuristic"
+    exact = False
+
+    def count(self, text: str) -> int:
+        return estimate_tokens(text)
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "exact": self.exact}
+
+
+class BPETokenizer(Tokenizer):
+    """
+    基于本地词表的 BPE 分词计数。
+
+    整段文本的计数按内容哈希放在 LRU 缓存中；预分词片段的 BPE 结果另有缓存。
+    只有用 tiktoken 或 regex 预分词时计数才是精确的（exact 为 True）。
+    """
+
+    def __init__(self, path: str | Path, cache_size: int = TOKEN_COUNT_CACHE_SIZE):
+        self.path = Path(path).expanduser()
+        if self.path.is_dir() or self.path.suffix == ".json":
+            vocab_path = self.path / "vocab.json" if self.path.is_dir() else self.path
+            ranks = load_gpt2_ranks(vocab_path, vocab_path.with_name("merges.txt"))
+            pattern = GPT2_PATTERN
+            tiktoken_format = False
+        else:
+            ranks = load_tiktoken_ranks(self.path)
+            pattern = tiktoken_pattern(self.path)
+            tiktoken_format = True
+
+        self.name = f"bpe:{self.path.name}"
+        self._ranks = ranks
+        self._pattern = _compile_pattern(pattern)
+        self._encoding = None
+        if _tiktoken is not None and tiktoken_format:
+            self._encoding = _tiktoken.Encoding(
+                name=self.path.stem,
+                pat_str=pattern,
+                mergeable_ranks=ranks,
+                special_tokens={},
+            )
+        self.exact = self._encoding is not None or _regex is not None
+
+        self._cache_size = cache_size
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+        self._pieces: dict[bytes, int] = {}
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _tokenize_count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode_ordinary(text))
+
+        total = 0
+        pieces = self._pieces
+        for match in self._pattern.finditer(text):
+            piece = match.group().encode("utf-8")
+            count = pieces.get(piece)
+            if count is None:
+                count = bpe_token_count(piece, self._ranks)
+                if len(pieces) >= PIECE_CACHE_SIZE:
+                    pieces.clear()
+                pieces[piece] = count
+            total += count
+        return total
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if len(text) < TOKEN_COUNT_CACHE_MIN_CHARS:
+            return self._tokenize_count(text)
+
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                self.cache_hits += 1
+                return count
+
+        count = self._tokenize_count(text)
+        with self._lock:
+            self.cache_misses += 1
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            while len(self._counts) > self._cache_size:
+                self._counts.popitem(last=False)
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "exact": self.exact,
+            "engine": "tiktoken" if self._encoding is not None else "python",
+            "vocab_size": len(self._ranks),
+            "cache_entries": len(self._counts),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+
+HEURISTIC_TOKENIZER = Tokenizer()
+
+# 已加载的词表（按文件路径），加载失败的路径记为估算分词器，避免反复重试
+_loaded_tokenizers: dict[str, Tokenizer] = {}
+_loaded_lock = threading.Lock()
+
+
+def match_tokenizer_file(model: str, tokenizer_files: dict[str, str] | None) -> str | None:
+    """按模型名匹配词表文件：先精确匹配，再按通配符（如 "gpt-4o*"）匹配。"""
+    if not tokenizer_files or not model:
+        return None
+    if model in tokenizer_files:
+        return tokenizer_files[model]
+    for pattern, path in tokenizer_files.items():
+        if fnmatchcase(model, pattern):
+            return path
+    return None
+
+
+def get_tokenizer(model: str, tokenizer_files: dict[str, str] | None = None) -> Tokenizer:
+    """获取模型对应的分词器；未配置词表或加载失败时返回字符数估算。"""
+    path = match_tokenizer_file(model, tokenizer_files)
+    if path is None:
+        return HEURISTIC_TOKENIZER
+
+    tokenizer = _loaded_tokenizers.get(path)
+    if tokenizer is not None:
+        return tokenizer
+
+    with _loaded_lock:
+        tokenizer = _loaded_tokenizers.get(path)
+        if tokenizer is None:
+            try:
+                tokenizer = BPETokenizer(path)
+                logger.info("模型 %s 使用本地词表精确计数: %s", model, path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("加载词表失败，模型 %s 回退为估算计数: %s (%s)", model, path, e)
+                tokenizer = HEURISTIC_TOKENIZER
+            _loaded_tokenizers[path] = tokenizer
+    return tokenizer
+
+
+def reset_tokenizers():
+    """清空已加载的词表（主要用于测试）"""
+    with _loaded_lock:
+        _loaded_tokenizers.clear()
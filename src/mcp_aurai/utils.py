@@ -30,6 +30,33 @@ BINARY_EXTENSIONS = {
 # 文本文件常见编码尝试顺序
 TEXT_ENCODINGS = ("utf-8", "utf-8-sig", "gb18030", "utf-16")
 
+# 超大文本分块统计的块大小（字符数），限制临时内存占用
+ESTIMATE_CHUNK_CHARS = 1 << 18
+
+# UTF-16-BE 编码下，中文字符（CJK 统一表意文字 U+4E00–U+9FFF）的高位字节恰好落在 0x4E–0x9F；
+# 其余字节在统计时删除，剩下的字节数就是中文字符数
+_NON_CHINESE_HIGH_BYTES = bytes(b for b in range(256) if not 0x4E <= b <= 0x9F)
+
+
+def count_chinese_chars(text: str) -> int:
+    """
+    统计中文字符数，结果与逐字符判断 '\\u4e00' <= c <= '\\u9fff' 完全一致。
+
+    按块编码为 UTF-16-BE 后只取高位字节，再用 bytes.translate 在 C 层删掉非中文字节计数；
+    BMP 外的字符编码为代理对（高位 0xD8–0xDF），不会被误计。纯 ASCII 块直接跳过。
+    """
+    if text.isascii():
+        return 0
+
+    count = 0
+    for start in range(0, len(text), ESTIMATE_CHUNK_CHARS):
+        chunk = text[start:start + ESTIMATE_CHUNK_CHARS] if len(text) > ESTIMATE_CHUNK_CHARS else text
+        if chunk.isascii():
+            continue
+        high_bytes = chunk.encode("utf-16-be", "surrogatepass")[0::2]
+        count += len(high_bytes.translate(None, _NON_CHINESE_HIGH_BYTES))
+    return count
+
 
 def estimate_tokens(text: str) -> int:
     """
@@ -48,7 +75,7 @@ def estimate_tokens(text: str) -> int:
         return 0
 
     # 统计中文字符
-    chinese_chars = sum(1 for c in text if '\u4e00' <= c <= '\u9fff')
+    chinese_chars = count_chinese_chars(text)
 
     # 统计非中文字符
     other_chars = len(text) - chinese_chars
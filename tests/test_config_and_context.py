@@ -106,6 +106,229 @@ def test_summary_history_messages_are_included():
     assert "旧历史纪要" in messages[0]["content"]
 
 
+def test_chunker_splits_python_on_top_level_blocks_and_keeps_content():
+    from mcp_aurai.chunking import split_into_chunks
+
+    functions = [
+        f"@decorator\ndef handler_{index}(request):\n"
+        + "".join(f"    value_{line} = request.get('字段{line}')\n" for line in range(6))
+        + "    return value_0\n\n"
+        for index in range(8)
+    ]
+    content = "import os\n\n" + "".join(functions)
+    count_tokens = lambda text: len(text) // 4 + 1
+
+    chunks = split_into_chunks("app/handlers.py", content, 200, count_tokens)
+
+    assert len(chunks) > 1
+    assert "".join(chunk.text for chunk in chunks) == content
+    assert all(count_tokens(chunk.text) <= 200 for chunk in chunks)
+    lines = content.splitlines(keepends=True)
+    for chunk in chunks:
+        assert "".join(lines[chunk.start_line - 1:chunk.end_line]) == chunk.text
+    # 除第一段外，每段都从装饰器开始（不会把函数从中间切开）
+    assert all(chunk.text.startswith("@decorator\ndef handler_") for chunk in chunks[1:])
+
+
+def test_chunker_uses_original_language_and_lines_for_converted_files(tmp_path):
+    from mcp_aurai.chunking import split_into_chunks
+    from mcp_aurai.utils import prepare_file_for_sync
+
+    source = "import os\n\n" + "".join(
+        f"def handler_{index}():\n" + "    value = os.getcwd()\n" * 6 + "    return value\n\n"
+        for index in range(6)
+    )
+    source_file = tmp_path / "handlers.py"
+    source_file.write_text(source, encoding="utf-8")
+    prepared = prepare_file_for_sync(str(source_file))
+    count_tokens = lambda text: len(text) // 4 + 1
+
+    chunks = split_into_chunks(prepared["target_path"], prepared["content"], 120, count_tokens)
+
+    assert prepared["target_path"].endswith(".py.txt")
+    assert all(chunk.text.startswith("def handler_") for chunk in chunks[1:])
+    source_lines = source.splitlines(keepends=True)
+    for chunk in chunks[1:]:
+        assert "".join(source_lines[chunk.start_line - 1:chunk.end_line]) == chunk.text
+
+
+def test_chunker_keeps_brace_blocks_and_splits_oversized_lines():
+    from mcp_aurai.chunking import split_into_chunks
+
+    blocks = [
+        f"function f{index}() {{\n  const s = \"}}\"; // }}\n  return {index};\n}}\n"
+        for index in range(10)
+    ]
+    content = "".join(blocks)
+    count_tokens = lambda text: len(text) // 4 + 1
+
+    chunks = split_into_chunks("web/app.js", content, 40, count_tokens)
+
+    assert "".join(chunk.text for chunk in chunks) == content
+    assert all(chunk.text.startswith("function f") for chunk in chunks)
+
+    minified = "x" * 2000
+    pieces = split_into_chunks("bundle.min.js", minified, 100, count_tokens)
+    assert "".join(piece.text for piece in pieces) == minified
+    assert all(count_tokens(piece.text) <= 100 for piece in pieces)
+    assert all(piece.start_line == piece.end_line == 1 for piece in pieces)
+
+
+def test_split_file_messages_carry_line_ranges():
+    from mcp_aurai.llm import AuraiClient
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(max_message_tokens=200)
+    content = "".join(f"第 {index} 行：这是一段比较长的中文说明文字，用来撑大文件。\n" for index in range(60))
+
+    groups = client._build_message_groups_from_history([
+        {
+            "type": "sync_context",
+            "project_info": {},
+            "file_contents": {"docs/notes.md": content},
+        }
+    ])
+
+    messages = [message for group in groups for message in group["messages"]]
+    assert len(messages) > 1
+    assert "(第 1/" in messages[0]["content"]
+    assert "第 1-" in messages[0]["content"]
+    assert all(client.count_text_tokens(message["content"]) <= 300 for message in messages)
+    last_header = messages[-1]["content"].splitlines()[2]
+    assert last_header.endswith("-60 行)")
+
+
+def _large_python_module(functions: int = 40) -> str:
+    parts = ['"""订单服务。"""\n\nimport json\nfrom pathlib import Path\n\nMAX_ITEMS = 100\n\n\n']
+    parts.append("class OrderService:\n    \"\"\"订单读写。\"\"\"\n\n")
+    for index in range(functions):
+        parts.append(
+            f"    def handle_{index}(self, order_id: int) -> dict:\n"
+            f"        \"\"\"处理第 {index} 类订单。\"\"\"\n"
+            + "".join(f"        step_{line} = self.load(order_id, {line})\n" for line in range(12))
+            + "        return {\"id\": order_id}\n\n"
+        )
+    parts.append("\ndef load_orders(path: Path) -> list:\n    return json.loads(path.read_text())\n")
+    return "".join(parts)
+
+
+def test_python_outline_keeps_signatures_and_line_numbers():
+    from mcp_aurai.outline import build_outline
+
+    content = _large_python_module()
+    outline = build_outline("services/orders.py", content)
+
+    lines = content.splitlines()
+    handle_line = lines.index("    def handle_3(self, order_id: int) -> dict:") + 1
+    assert f"{handle_line}|     def handle_3(self, order_id: int) -> dict:" in outline.text
+    assert "import json" in outline.text
+    assert "MAX_ITEMS = 100" in outline.text
+    assert "step_5" not in outline.text
+    assert "已省略" in outline.text
+    assert len(outline.text) * 3 < len(content)
+
+    names = {symbol.name for symbol in outline.symbols}
+    assert {"OrderService", "OrderService.handle_3", "load_orders"} <= names
+    handle = next(symbol for symbol in outline.symbols if symbol.name == "OrderService.handle_3")
+    assert outline.source(handle).startswith("    def handle_3(")
+    assert outline.source(handle).rstrip().endswith('return {"id": order_id}')
+
+
+def test_heuristic_outline_for_c_like_files():
+    from mcp_aurai.outline import build_outline
+
+    content = (
+        "import java.util.List;\n\n"
+        "public class Orders {\n"
+        "    /** 读取订单。 */\n"
+        "    public List<Order> load(int id) {\n"
+        + "        int value = id * 2;\n" * 8
+        + "        return null;\n"
+        "    }\n\n"
+        "    private void save(Order order)\n"
+        "    {\n"
+        + "        order.touch();\n" * 8
+        + "    }\n"
+        "}\n"
+    )
+    outline = build_outline("Orders.java", content)
+
+    symbols = {symbol.name: symbol for symbol in outline.symbols}
+    assert set(symbols) == {"Orders", "Orders.load", "Orders.save"}
+    assert (symbols["Orders.load"].start_line, symbols["Orders.load"].end_line) == (5, 15)
+    assert (symbols["Orders.save"].start_line, symbols["Orders.save"].end_line) == (17, 27)
+    assert "4|     /** 读取订单。 */" in outline.text
+    assert "int value" not in outline.text
+    assert build_outline("notes.md", "# 标题\n\n正文\n") is None
+
+
+def test_outline_mode_sends_skeleton_and_expands_named_symbols():
+    from mcp_aurai.llm import AuraiClient
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(max_message_tokens=50000, outline_threshold_tokens=500)
+    module = _large_python_module()
+    # sync_context 自动转换后的发送名和说明行
+    content = "[原始文件: services/orders.py]\n[自动转换后发送名: services/orders.py.txt]\n\n" + module
+    sync_entry = {
+        "type": "sync_context",
+        "project_info": {},
+        "file_contents": {"services/orders.py.txt": content},
+    }
+
+    groups = client._build_message_groups_from_history([sync_entry])
+    outline_messages = groups[0]["messages"]
+    assert len(outline_messages) == 1
+    assert "已上传文件（大纲）" in outline_messages[0]["content"]
+    assert "step_5" not in outline_messages[0]["content"]
+    assert groups[0]["tokens"] * 3 < client.count_text_tokens(content)
+
+    handle_line = module.splitlines().index("    def handle_7(self, order_id: int) -> dict:") + 1
+    history = [
+        sync_entry,
+        {
+            "type": "consult",
+            "problem_type": "runtime_error",
+            "error_message": "订单加载失败",
+            "response": {
+                "status": "aligning",
+                "questions": ["请确认 load_orders 读到的文件内容"],
+                "code_changes": [
+                    {"file": "services/orders.py", "line": handle_line + 3, "old": "step_2", "new": "step_2b"}
+                ],
+            },
+        },
+    ]
+
+    groups = client._build_message_groups_from_history(history)
+    contents = [message["content"] for message in groups[0]["messages"]]
+    assert len(contents) == 3
+    assert f"中的函数 OrderService.handle_7（第 {handle_line}-{handle_line + 14} 行）" in contents[1]
+    assert "step_11 = self.load(order_id, 11)" in contents[1]
+    assert "中的函数 load_orders" in contents[2]
+    assert all("OrderService.handle_3" not in text for text in contents[1:])
+
+
+def test_outline_mode_leaves_small_and_non_code_files_intact():
+    from mcp_aurai.llm import AuraiClient
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(max_message_tokens=50000, outline_threshold_tokens=500)
+    notes = "说明文字。\n" * 400
+
+    groups = client._build_message_groups_from_history([
+        {
+            "type": "sync_context",
+            "project_info": {},
+            "file_contents": {"docs/notes.md": notes, "small.py": "def f():\n    return 1\n"},
+        }
+    ])
+
+    contents = [message["content"] for message in groups[0]["messages"]]
+    assert all("大纲" not in text for text in contents)
+    assert notes in contents[0]
+
+
 def test_context_window_prefers_latest_sync_context():
     from mcp_aurai.llm import AuraiClient
 
@@ -135,14 +358,138 @@ def test_context_window_prefers_latest_sync_context():
     assert selected == [sync_message]
 
 
+def test_bm25_index_updates_incrementally_and_ranks_matching_chunks():
+    from mcp_aurai.retrieval import BM25Index, index_terms
+
+    assert index_terms("HTTPServerError in load_orders 订单加载") == [
+        "httpservererror", "http", "server", "error", "in", "load_orders", "load", "orders", "订单", "单加", "加载",
+    ]
+
+    index = BM25Index()
+    index.add("orders", "def load_orders(path):\n    return json.loads(path.read_text())\n")
+    index.add("users", "def save_user(user):\n    db.save(user)\n")
+    assert index.add("orders", "重复添加是空操作") is False
+
+    scores = index.score("KeyError in load_orders: 'items'")
+    assert set(scores) == {"orders"}
+
+    index.add("payments", "def charge(order):\n    load_orders(order.path)\n    return gateway.charge(order)\n")
+    scores = index.score("load_orders failed")
+    assert scores["orders"] > 0 and scores["payments"] > 0
+
+    assert index.retain({"orders", "users"}) == 1
+    assert "payments" not in index
+    assert set(index.score("load_orders failed")) == {"orders"}
+    assert index.stats()["added"] == 3
+
+
+def _sync_entry(entry_id: str, files: dict[str, str]) -> dict:
+    return {"entry_id": entry_id, "type": "sync_context", "project_info": {}, "file_contents": files}
+
+
+def test_relevance_selection_keeps_the_file_with_the_failing_code():
+    from mcp_aurai.llm import AuraiClient
+    from mcp_aurai.retrieval import drop_session_index, get_session_index
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(max_message_tokens=5000)
+    filler = "".join(f"def helper_{index}(value):\n    return value + {index}\n" for index in range(60))
+    history = [
+        _sync_entry("relevance-1", {"billing/invoice.py": "def render_invoice(order):\n    return order.total_amount\n"}),
+        {
+            "entry_id": "relevance-2",
+            "type": "consult",
+            "problem_type": "runtime_error",
+            "error_message": "页面报错",
+            "response": {"analysis": "需要更多信息", "guidance": "请上传相关文件"},
+        },
+        _sync_entry("relevance-3", {"utils/helpers.py": filler, "utils/more_helpers.py": filler}),
+    ]
+    drop_session_index("relevance-test")
+    groups = client._build_message_groups_from_history(history)
+    invoice_message = groups[0]["messages"][0]
+    budget = groups[0]["tokens"] + groups[2]["message_tokens"][0] + 5
+
+    # 默认策略：最近一次同步优先，包含出错代码的旧文件被挤掉
+    default_selected, _ = client._select_history_messages_within_budget(groups, budget)
+    assert invoice_message not in default_selected
+
+    query = "AttributeError: 'Order' object has no attribute 'total_amount' in render_invoice"
+    chunk_scores = client._score_history_chunks(groups, query, "relevance-test")
+    selected, trimmed, used_tokens = client._select_history_by_relevance(groups, budget, chunk_scores)
+
+    assert trimmed is True
+    assert selected[0] is invoice_message
+    assert used_tokens <= budget
+    index = get_session_index("relevance-test")
+    assert index.stats()["added"] == 3
+
+    # 之后的调用只为新增片段分词，移出历史的片段从索引中删除
+    history.append(_sync_entry("relevance-4", {"billing/tax.py": "def tax_rate(region):\n    return 0.1\n"}))
+    client._score_history_chunks(client._build_message_groups_from_history(history[1:]), query, "relevance-test")
+    assert index.stats() == {"documents": 3, "terms": index.stats()["terms"], "added": 4, "removed": 1}
+    drop_session_index("relevance-test")
+
+
+def test_relevance_selection_falls_back_to_default_without_matches():
+    from mcp_aurai.llm import AuraiClient
+    from mcp_aurai.retrieval import drop_session_index
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(
+        max_message_tokens=5000,
+        max_tokens=1000,
+        context_window=20000,
+        context_high_watermark=0.99,
+    )
+    filler = "".join(f"def helper_{index}(value):\n    return value + {index}\n" for index in range(60))
+    history = [
+        {
+            "entry_id": "fallback-1",
+            "type": "consult",
+            "problem_type": "runtime_error",
+            "error_message": "页面报错",
+            "response": {"analysis": "需要更多信息", "guidance": "请上传相关文件"},
+        },
+        _sync_entry("fallback-2", {"utils/helpers.py": filler, "billing/invoice.py": "def render_invoice(order):\n    pass\n"}),
+    ]
+    drop_session_index("fallback-test")
+    groups = client._build_message_groups_from_history(history)
+    system_message = {"role": "system", "content": "系统提示词"}
+    question = {"role": "user", "content": "怎么办"}
+    history_limit = groups[1]["tokens"]
+
+    def fit(chunk_scores):
+        messages, _, _, _ = client._fit_messages_to_context_window(
+            [system_message], groups, question, history_token_limit=history_limit, chunk_scores=chunk_scores,
+        )
+        return messages
+
+    # 与任何片段都不重合的问题：得分全为 0，结果与默认策略一致，最近同步的文件不被旧轮次挤掉
+    chunk_scores = client._score_history_chunks(groups, "怎么办", "fallback-test")
+    assert chunk_scores and all(score == 0 for scores in chunk_scores.values() for score in scores)
+    baseline, _ = client._select_history_messages_within_budget(groups, history_limit)
+    assert fit(chunk_scores)[1:-1] == baseline == groups[1]["messages"]
+
+    # 有片段命中时只在文件片段之间调整顺序，最近一次同步的其余片段仍排在旧轮次之前
+    chunk_scores = client._score_history_chunks(groups, "render_invoice failed", "fallback-test")
+    selected, _, _ = client._select_history_by_relevance(groups, history_limit, chunk_scores)
+    assert selected == groups[1]["messages"]
+    drop_session_index("fallback-test")
+
+
 @pytest.mark.asyncio
 async def test_chat_caps_output_tokens_by_context_window():
-    from mcp_aurai.llm import AuraiClient
+    from mcp_aurai.calibration import TokenCalibrator
+    from mcp_aurai.capabilities import CapabilityStore
+    from mcp_aurai.endpoints import Endpoint, EndpointPool
+    from mcp_aurai.llm import AuraiClient, OutboundScheduler
+    from mcp_aurai.rate_limit import RateLimiter
 
     captured = {}
 
     class FakeCompletions:
-        def create(self, **kwargs):
+        async def create(self, **kwargs):
             captured.update(kwargs)
             return SimpleNamespace(
                 choices=[
@@ -162,10 +509,23 @@ async def test_chat_caps_output_tokens_by_context_window():
         max_tokens=40,
         context_window=60,
         context_high_watermark=1.0,
+        stream_responses=False,
+        retry_max_attempts=1,
+        retry_deadline=30,
+        capability_probe=False,
     )
-    client._client = SimpleNamespace(
-        chat=SimpleNamespace(completions=FakeCompletions())
-    )
+    client._pool = EndpointPool([
+        Endpoint(
+            name="default",
+            model="test-model",
+            client=SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions())),
+        )
+    ])
+    client._scheduler = OutboundScheduler(1)
+    client._rate_limiter = RateLimiter()
+    client.token_calibrator = TokenCalibrator(None)
+    client._capabilities = CapabilityStore(None, 3600)
+    client._hedge = None
 
     response, token_usage = await client.chat(
         user_message="U" * 80,
@@ -182,3 +542,135 @@ async def test_chat_caps_output_tokens_by_context_window():
     assert response["status"] == "ok"
     assert captured["temperature"] == 0.3
     assert captured["max_tokens"] == expected_max_tokens
+
+
+def test_estimate_tokens_matches_per_character_reference(monkeypatch):
+    import random
+
+    import mcp_aurai.utils as utils
+
+    def reference(text):
+        if not text:
+            return 0
+        chinese_chars = sum(1 for c in text if "\u4e00" <= c <= "\u9fff")
+        return int(chinese_chars / 1.5 + (len(text) - chinese_chars) / 4)
+
+    boundary_chars = ["\u4dff", "\u4e00", "\u4e01", "\u9ffe", "\u9fff", "\ua000", "\u4e4e", "\u9f4e", "😀", "\ud800", "a", "\n"]
+    rng = random.Random(7)
+    samples = ["", "plain ascii text", "".join(boundary_chars)]
+    for _ in range(50):
+        samples.append("".join(rng.choice(boundary_chars + ["x", "中", "文"]) for _ in range(rng.randint(1, 200))))
+
+    # 小块尺寸覆盖跨块边界的情况
+    monkeypatch.setattr(utils, "ESTIMATE_CHUNK_CHARS", 7)
+    for text in samples:
+        assert utils.estimate_tokens(text) == reference(text)
+
+
+def test_cache_friendly_layout_keeps_prefix_stable():
+    from mcp_aurai.llm import AuraiClient
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(
+        max_message_tokens=5000,
+        max_tokens=1000,
+        context_window=20000,
+        context_high_watermark=0.85,
+        prompt_cache_layout=True,
+    )
+    system_message = {"role": "system", "content": "系统提示词"}
+    history = [
+        {
+            "type": "sync_context",
+            "project_info": {"project_name": "示例项目"},
+            "file_contents": {"src/b.py": "print('b')", "src/a.py": "print('a v1')"},
+        },
+        {"type": "consult", "problem_type": "runtime_error", "error_message": "第一次", "response": {}},
+        {"type": "sync_context", "file_contents": {"src/a.py": "print('a v2')"}},
+        {"type": "consult", "problem_type": "runtime_error", "error_message": "第二次", "response": {}},
+    ]
+
+    def build(entries, question):
+        messages, _, _, _ = client._fit_messages_to_context_window(
+            [system_message],
+            client._build_message_groups_from_history(entries),
+            {"role": "user", "content": question},
+        )
+        return messages
+
+    first = build(history, "问题一")
+    contents = [message["content"] for message in first]
+    assert contents[0] == "系统提示词"
+    assert "示例项目" in contents[1]
+    assert "src/a.py" in contents[2] and "a v2" in contents[2]
+    assert "src/b.py" in contents[3]
+    assert not any("a v1" in content for content in contents)
+    assert "第一次" in contents[4] and "第二次" in contents[5]
+
+    # 新增一轮后，之前的消息保持为逐字节一致的前缀
+    second = build([*history, {
+        "type": "consult",
+        "problem_type": "runtime_error",
+        "error_message": "第三次",
+        "response": {},
+    }], "问题二")
+    assert second[:len(first) - 1] == first[:-1]
+
+
+def test_single_source_history_sends_each_turn_once():
+    from mcp_aurai.llm import AuraiClient
+    from mcp_aurai.prompts import build_progress_prompt
+
+    history = [
+        {
+            "type": "consult",
+            "problem_type": "runtime_error",
+            "error_message": "导入失败",
+            "response": {"analysis": "缺少依赖分析", "guidance": "安装依赖"},
+        },
+        {
+            "type": "progress",
+            "actions_taken": "pip install 依赖",
+            "result": "failed",
+            "response": {"guidance": "检查虚拟环境"},
+        },
+    ]
+
+    prompt_args = {"iteration": 2, "actions_taken": "重建虚拟环境", "result": "success", "conversation_history": history}
+    inline_prompt = build_progress_prompt(**prompt_args)
+    single_prompt = build_progress_prompt(**prompt_args, history_references=True)
+    assert "缺少依赖分析" in inline_prompt
+    assert "缺少依赖分析" not in single_prompt
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(
+        max_message_tokens=5000,
+        max_tokens=1000,
+        context_window=20000,
+        context_high_watermark=0.99,
+        history_rendering="inline",
+    )
+    assert [group["type"] for group in client._build_message_groups_from_history(history)] == ["consult"]
+
+    client.config.history_rendering = "single"
+    groups = client._build_message_groups_from_history(history)
+    assert [group["type"] for group in groups] == ["consult", "progress"]
+    assert "pip install 依赖" in groups[1]["messages"][0]["content"]
+    assert "检查虚拟环境" in groups[1]["messages"][1]["content"]
+
+    # 引用按裁剪后实际发送的历史生成
+    system_message = {"role": "system", "content": "系统提示词"}
+    messages, _, _, _ = client._fit_messages_to_context_window(
+        [system_message], groups, {"role": "user", "content": single_prompt},
+    )
+    assert "2 轮记录（咨询 1 轮、进度报告 1 轮）" in messages[-1]["content"]
+    assert "未发送" not in messages[-1]["content"]
+
+    messages, _, _, _ = client._fit_messages_to_context_window(
+        [system_message], groups, {"role": "user", "content": single_prompt},
+        history_token_limit=groups[1]["tokens"],
+    )
+    assert messages[1:-1] == groups[1]["messages"]
+    assert "1 轮记录（进度报告 1 轮）" in messages[-1]["content"]
+    assert "另有 1 轮记录因上下文窗口限制未发送" in messages[-1]["content"]
+    assert "<<aurai:" not in messages[-1]["content"]
@@ -1,3 +1,4 @@
+import asyncio
 import importlib
 import json
 import sys
@@ -64,7 +65,16 @@ def configure_persistence(server, tmp_path: Path) -> Path:
 
 
 def read_history(history_path: Path) -> list[dict]:
-    return json.loads(history_path.read_text(encoding="utf-8"))
+    history: list[dict] = []
+    for line in history_path.read_text(encoding="utf-8").splitlines():
+        record = json.loads(line)
+        if record["op"] == "checkpoint":
+            history = record["entries"]
+        elif record["op"] == "append":
+            history.append(record["entry"])
+        elif record["op"] == "remove":
+            history = [entry for entry in history if entry["entry_id"] not in record["entry_ids"]]
+    return history
 
 
 @pytest.mark.asyncio
@@ -115,9 +125,10 @@ async def test_sync_context_auto_converts_code_file_to_text(server_module, tmp_p
 
     latest_entry = server._get_session_history(None)[-1]
     sent_as_path = uploaded["sent_as_path"]
-    assert sent_as_path in latest_entry["file_contents"]
-    assert "[原始文件:" in latest_entry["file_contents"][sent_as_path]
-    assert "print('hello')" in latest_entry["file_contents"][sent_as_path]
+    assert "file_contents" not in latest_entry
+    stored_content = server.get_blob_store().get(latest_entry["file_refs"][sent_as_path])
+    assert "[原始文件:" in stored_content
+    assert "print('hello')" in stored_content
 
 
 @pytest.mark.asyncio
@@ -144,6 +155,52 @@ async def test_sync_context_skips_binary_file_but_keeps_text_file(server_module,
     assert "二进制" in result["skipped_files"][0]["reason"]
 
 
+@pytest.mark.asyncio
+async def test_sync_indexes_files_and_consult_sends_relevance_query(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+    recorder: dict = {}
+    config = SimpleNamespace(
+        max_iterations=10,
+        provider="custom",
+        model="test-model",
+        max_message_tokens=5000,
+        relevance_selection=True,
+        prompt_cache_layout=False,
+    )
+    monkeypatch.setattr(server, "get_aurai_config", lambda: config)
+    monkeypatch.setattr(
+        server,
+        "get_aurai_client",
+        lambda: FakeClient({"status": "guiding", "analysis": "a", "guidance": "g"}, recorder),
+    )
+    server.drop_session_index("relevance")
+
+    code_file = tmp_path / "invoice.py"
+    code_file.write_text("def render_invoice(order):\n    return order.total_amount\n", encoding="utf-8")
+    await server.sync_context.fn(operation="sync", files=[str(code_file)], project_info=None, session_id="relevance")
+
+    stats = server.get_relevance_index_stats("relevance")
+    assert (stats["documents"], stats["added"]) == (1, 1)
+
+    await server.consult_aurai.fn(
+        problem_type="runtime_error",
+        error_message="AttributeError: total_amount",
+        code_snippet="render_invoice(order)",
+        context={"terminal_output": "Traceback: invoice.py line 2"},
+        attempts_made=None,
+        answers_to_questions=None,
+        is_new_question=False,
+        session_id="relevance",
+    )
+    assert recorder["kwargs"]["relevance_query"] == (
+        "AttributeError: total_amount\nrender_invoice(order)\nTraceback: invoice.py line 2"
+    )
+
+    await server.sync_context.fn(operation="clear", files=None, project_info=None, session_id="relevance")
+    assert server.get_relevance_index_stats("relevance") is None
+
+
 @pytest.mark.asyncio
 async def test_sync_context_returns_error_when_all_files_are_binary(server_module, tmp_path):
     server = server_module
@@ -211,6 +268,90 @@ async def test_consult_resolved_clears_persisted_history(server_module, tmp_path
     assert read_history(history_path) == []
 
 
+@pytest.mark.asyncio
+async def test_cache_friendly_layout_keeps_history_out_of_prompt(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+    await server._add_to_history({
+        "type": "consult",
+        "problem_type": "runtime_error",
+        "error_message": "旧错误",
+        "response": {"resolved": False},
+    })
+
+    prompt_kwargs = {}
+    recorder = {}
+
+    def fake_prompt(**kwargs):
+        prompt_kwargs.update(kwargs)
+        return "prompt"
+
+    monkeypatch.setattr(
+        server,
+        "get_aurai_config",
+        lambda: SimpleNamespace(max_iterations=10, provider="custom", model="test-model", prompt_cache_layout=True),
+    )
+    monkeypatch.setattr(server, "build_consult_prompt", fake_prompt)
+    monkeypatch.setattr(
+        server,
+        "get_aurai_client",
+        lambda: FakeClient({"status": "guiding", "analysis": "a", "guidance": "g"}, recorder),
+    )
+
+    await server.consult_aurai.fn(
+        problem_type="other",
+        error_message="新问题",
+        code_snippet=None,
+        context=None,
+        attempts_made=None,
+        answers_to_questions=None,
+        is_new_question=False,
+        session_id=None,
+    )
+
+    # 历史只作为独立消息发送，提示词里只保留引用
+    assert prompt_kwargs["history_references"] is True
+    assert len(recorder["kwargs"]["conversation_history"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_consult_does_not_write_history(server_module, tmp_path, monkeypatch):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    started = asyncio.Event()
+
+    class BlockingClient:
+        async def chat(self, **kwargs):
+            started.set()
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(
+        server,
+        "get_aurai_config",
+        lambda: SimpleNamespace(max_iterations=10, provider="custom", model="test-model"),
+    )
+    monkeypatch.setattr(server, "build_consult_prompt", lambda **kwargs: "prompt")
+    monkeypatch.setattr(server, "get_aurai_client", lambda: BlockingClient())
+
+    task = asyncio.create_task(server.consult_aurai.fn(
+        problem_type="other",
+        error_message="会被取消的问题",
+        code_snippet=None,
+        context=None,
+        attempts_made=None,
+        answers_to_questions=None,
+        is_new_question=False,
+        session_id=None,
+    ))
+    await started.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert server._get_session_history(None) == []
+    assert read_history(history_path) == []
+
+
 @pytest.mark.asyncio
 async def test_report_progress_resolved_clears_persisted_history(server_module, tmp_path, monkeypatch):
     server = server_module
@@ -374,6 +515,7 @@ async def test_save_history_uses_atomic_replace_and_cleans_temp_files(server_mod
         "error_message": "原子写入测试",
         "response": {"resolved": False},
     })
+    server._save_history_to_file()
 
     assert replace_calls
     temp_path, target_path = replace_calls[-1]
@@ -439,6 +581,8 @@ async def test_history_summary_compacts_older_entries(server_module, tmp_path, m
             },
         })
 
+    await server._wait_for_history_compaction()
+
     history = server._get_session_history(None)
     assert history[0]["type"] == server.SUMMARY_ENTRY_TYPE
     assert len(history) == 4  # 1 summary + 3 kept recent
@@ -497,6 +641,419 @@ async def test_history_summary_keeps_latest_sync_context(server_module, tmp_path
         "response": {"resolved": False},
     })
 
+    await server._wait_for_history_compaction()
+
     history = server._get_session_history(None)
     assert history[0]["type"] == server.SUMMARY_ENTRY_TYPE
     assert any(entry.get("type") == "sync_context" for entry in history[1:])
+
+
+@pytest.mark.asyncio
+async def test_clear_history_invalidates_message_group_cache(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+
+    invalidated = []
+    monkeypatch.setattr(server, "invalidate_history_cache", lambda entries: invalidated.extend(entries))
+
+    entry = {
+        "type": "consult",
+        "problem_type": "other",
+        "error_message": "缓存测试",
+        "response": {"resolved": False},
+    }
+    await server._add_to_history(entry)
+    assert entry["entry_id"]
+
+    server._clear_history(None, "unit-test")
+
+    assert [item["entry_id"] for item in invalidated] == [entry["entry_id"]]
+
+
+@pytest.mark.asyncio
+async def test_add_to_history_appends_journal_without_rewriting(server_module, tmp_path, monkeypatch):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    server.server_config.enable_history_summary = False
+
+    replace_calls = []
+    original_replace = server.os.replace
+    monkeypatch.setattr(
+        server.os,
+        "replace",
+        lambda src, dst: replace_calls.append(dst) or original_replace(src, dst),
+    )
+
+    entries = [
+        {
+            "type": "consult",
+            "problem_type": "other",
+            "error_message": f"问题{index}",
+            "response": {"resolved": False},
+        }
+        for index in range(3)
+    ]
+    for entry in entries:
+        await server._add_to_history(entry)
+
+    lines = history_path.read_text(encoding="utf-8").splitlines()
+    assert replace_calls == []
+    assert [json.loads(line)["op"] for line in lines] == ["checkpoint", "append", "append", "append"]
+    assert read_history(history_path) == entries
+
+
+@pytest.mark.asyncio
+async def test_journal_replays_hard_cap_removals(server_module, tmp_path):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    server.server_config.enable_history_summary = False
+    server.server_config.max_history = 2
+
+    for index in range(3):
+        await server._add_to_history({
+            "type": "consult",
+            "problem_type": "other",
+            "error_message": f"问题{index}",
+            "response": {"resolved": False},
+        })
+
+    reset_server_state(server)
+    reloaded = server._get_session_history(None)
+
+    assert [entry["error_message"] for entry in reloaded] == ["问题1", "问题2"]
+    assert read_history(history_path) == reloaded
+
+
+@pytest.mark.asyncio
+async def test_journal_writes_checkpoint_after_interval(server_module, tmp_path, monkeypatch):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    server.server_config.enable_history_summary = False
+    monkeypatch.setattr(server, "HISTORY_JOURNAL_CHECKPOINT_INTERVAL", 2)
+
+    for index in range(3):
+        await server._add_to_history({
+            "type": "consult",
+            "problem_type": "other",
+            "error_message": f"问题{index}",
+            "response": {"resolved": False},
+        })
+
+    lines = history_path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 1
+    assert len(read_history(history_path)) == 3
+
+
+def test_legacy_history_formats_still_load_and_migrate(server_module, tmp_path):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    legacy_entry = {
+        "type": "consult",
+        "problem_type": "other",
+        "error_message": "旧格式",
+        "response": {"resolved": False},
+    }
+    history_path.write_text(json.dumps([legacy_entry], ensure_ascii=False, indent=2), encoding="utf-8")
+    alpha_path = server._get_history_file_for_session("alpha")
+    alpha_path.write_text(json.dumps({"sessions": {"alpha": [legacy_entry]}}), encoding="utf-8")
+
+    reset_server_state(server)
+    default_history = server._get_session_history(None)
+    alpha_history = server._get_session_history("alpha")
+
+    assert default_history[0]["error_message"] == "旧格式"
+    assert alpha_history[0]["error_message"] == "旧格式"
+    assert default_history[0]["entry_id"]
+    first_record = json.loads(history_path.read_text(encoding="utf-8").splitlines()[0])
+    assert first_record["op"] == "checkpoint"
+    assert read_history(history_path) == default_history
+
+
+def test_journal_skips_torn_trailing_line(server_module, tmp_path):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    entry = {"entry_id": "e1", "type": "consult", "error_message": "完整", "response": {}}
+    history_path.write_text(
+        json.dumps({"op": "checkpoint", "entries": []}) + "\n"
+        + json.dumps({"op": "append", "entry": entry}, ensure_ascii=False) + "\n"
+        + '{"op": "append", "entry": {"entry_id": "e2", "type": "cons',
+        encoding="utf-8",
+    )
+
+    reset_server_state(server)
+
+    assert server._get_session_history(None) == [entry]
+
+    server._append_history_records(None, [{"op": "append", "entry": {"entry_id": "e3", "type": "consult"}}])
+    reset_server_state(server)
+
+    assert [item["entry_id"] for item in server._get_session_history(None)] == ["e1", "e3"]
+
+
+@pytest.mark.asyncio
+async def test_sync_context_deduplicates_file_contents_across_sessions(server_module, tmp_path):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+
+    code_file = tmp_path / "shared.py"
+    code_file.write_text("print('shared')\n" * 50, encoding="utf-8")
+
+    for session_id in ("alpha", "beta", "alpha"):
+        await server.sync_context.fn(
+            operation="sync",
+            files=[str(code_file)],
+            project_info=None,
+            session_id=session_id,
+        )
+
+    refs = {
+        ref
+        for session_id in ("alpha", "beta")
+        for entry in server._get_session_history(session_id)
+        for ref in entry["file_refs"].values()
+    }
+    blob_files = list((history_path.parent / "blobs").glob("*/*.z"))
+
+    assert len(refs) == 1
+    assert len(blob_files) == 1
+    assert "print('shared')" not in server._get_history_file_for_session("alpha").read_text(encoding="utf-8")
+
+
+@pytest.mark.asyncio
+async def test_clear_history_collects_unreferenced_blobs(server_module, tmp_path, monkeypatch):
+    import mcp_aurai.blob_store as blob_store
+
+    server = server_module
+    configure_persistence(server, tmp_path)
+    monkeypatch.setattr(blob_store, "BLOB_GC_GRACE_SECONDS", 0)
+
+    only_alpha = tmp_path / "alpha.py"
+    only_alpha.write_text("alpha = 1\n", encoding="utf-8")
+    shared = tmp_path / "shared.py"
+    shared.write_text("shared = 1\n", encoding="utf-8")
+
+    await server.sync_context.fn(
+        operation="sync", files=[str(only_alpha), str(shared)], project_info=None, session_id="alpha",
+    )
+    await server.sync_context.fn(
+        operation="sync", files=[str(shared)], project_info=None, session_id="beta",
+    )
+    alpha_refs = dict(server._get_session_history("alpha")[-1]["file_refs"])
+    beta_ref = next(iter(server._get_session_history("beta")[-1]["file_refs"].values()))
+
+    # beta 只存在于磁盘上时也必须保留其引用的 blob
+    server._conversation_history.pop("beta")
+    server._loaded_sessions.discard("beta")
+    server._clear_history("alpha", "unit-test")
+    await server._wait_for_blob_gc()
+
+    store = server.get_blob_store()
+    assert store.get(beta_ref) is not None
+    assert [ref for ref in alpha_refs.values() if ref != beta_ref]
+    assert all(store.get(ref) is None for ref in alpha_refs.values() if ref != beta_ref)
+
+    # 未变化的历史文件不再重新解析
+    def fail_parse(*args, **kwargs):
+        raise AssertionError("未变化的历史文件不应重新解析")
+
+    monkeypatch.setattr(server, "_parse_history_content", fail_parse)
+    assert beta_ref in server._history_file_refs(server._get_history_file_for_session("beta"))
+
+    # 间隔内的多次触发合并为一次延后的回收，不阻塞请求
+    monkeypatch.setattr(server, "BLOB_GC_MIN_INTERVAL_SECONDS", 3600)
+    server._schedule_blob_gc()
+    pending_task = server._blob_gc_task
+    server._schedule_blob_gc()
+    assert server._blob_gc_task is pending_task
+    await asyncio.sleep(0)
+    assert not pending_task.done()
+    pending_task.cancel()
+    await asyncio.gather(pending_task, return_exceptions=True)
+
+
+def test_message_groups_load_file_contents_from_blob_store(server_module, tmp_path):
+    from mcp_aurai.llm import AuraiClient
+
+    server = server_module
+    configure_persistence(server, tmp_path)
+    ref = server.get_blob_store().put("def handler():\n    return 42\n")
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = SimpleNamespace(max_message_tokens=5000)
+    groups = client._build_message_groups_from_history([
+        {
+            "type": "sync_context",
+            "project_info": {},
+            "file_refs": {"handler.py.txt": ref},
+        }
+    ])
+
+    assert "return 42" in groups[0]["messages"][0]["content"]
+    assert "handler.py.txt" in groups[0]["messages"][0]["content"]
+
+
+class BlockingSummaryClient:
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def chat(self, **kwargs):
+        self.started.set()
+        await self.release.wait()
+        return {"status": "guiding", "guidance": "后台摘要", "analysis": ""}, {}
+
+
+def make_consult_entry(index: int) -> dict:
+    return {
+        "type": "consult",
+        "problem_type": "runtime_error",
+        "error_message": f"问题{index}",
+        "response": {"resolved": False},
+    }
+
+
+@pytest.mark.asyncio
+async def test_history_compaction_runs_in_background(server_module, tmp_path, monkeypatch):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    server.server_config.max_history = 5
+    summary_client = BlockingSummaryClient()
+    monkeypatch.setattr(server, "get_aurai_client", lambda: summary_client)
+
+    for index in range(4):
+        await server._add_to_history(make_consult_entry(index))
+
+    # 第 4 条触发压缩，但 _add_to_history 不等待摘要
+    await asyncio.wait_for(summary_client.started.wait(), timeout=1)
+    assert server._get_session_history(None)[0]["type"] == "consult"
+
+    # 摘要进行期间继续追加，硬上限依然生效
+    for index in range(4, 7):
+        await server._add_to_history(make_consult_entry(index))
+    assert len(server._get_session_history(None)) == 5
+
+    summary_client.release.set()
+    await server._wait_for_history_compaction()
+
+    history = server._get_session_history(None)
+    assert history[0]["type"] == server.SUMMARY_ENTRY_TYPE
+    assert history[-1]["error_message"] == "问题6"
+    assert len(history) <= server.server_config.max_history
+    assert read_history(history_path) == history
+
+
+@pytest.mark.asyncio
+async def test_clear_history_discards_running_compaction(server_module, tmp_path, monkeypatch):
+    server = server_module
+    history_path = configure_persistence(server, tmp_path)
+    server.server_config.max_history = 5
+    summary_client = BlockingSummaryClient()
+    monkeypatch.setattr(server, "get_aurai_client", lambda: summary_client)
+
+    for index in range(4):
+        await server._add_to_history(make_consult_entry(index))
+    await asyncio.wait_for(summary_client.started.wait(), timeout=1)
+
+    server._clear_history(None, "unit-test")
+    summary_client.release.set()
+    await server._wait_for_history_compaction()
+
+    assert server._get_session_history(None) == []
+    assert read_history(history_path) == []
+
+
+def make_token_budget_config(**overrides):
+    from mcp_aurai.config import AuraiConfig
+
+    settings = {
+        "api_key": "test-api-key-12345",
+        "base_url": "https://example.com/v1",
+        "model": "test-model",
+        "max_tokens": 1000,
+        "context_window": 10000,
+        "max_message_tokens": 5000,
+    }
+    settings.update(overrides)
+    return AuraiConfig(**settings)
+
+
+@pytest.mark.asyncio
+async def test_history_summary_triggers_on_token_budget(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+    config = make_token_budget_config()
+    monkeypatch.setattr(server, "get_aurai_config", lambda: config)
+    monkeypatch.setattr(
+        server,
+        "get_aurai_client",
+        lambda: FakeClient({"status": "guiding", "guidance": "大段日志的摘要", "analysis": ""}),
+    )
+
+    # 条数远低于 max_history 的 80%，但每条都很大
+    for index in range(3):
+        entry = make_consult_entry(index)
+        entry["error_message"] = f"日志{index} " + "x" * 6000
+        await server._add_to_history(entry)
+
+    await server._wait_for_history_compaction()
+
+    history = server._get_session_history(None)
+    assert history[0]["type"] == server.SUMMARY_ENTRY_TYPE
+    assert history[0]["covered_entry_count"] == 2
+    assert [entry["error_message"][:3] for entry in history[1:]] == ["日志2"]
+
+
+def test_many_small_entries_do_not_trigger_token_compaction(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+    server.server_config.max_history = 50
+    monkeypatch.setattr(server, "get_aurai_config", lambda: make_token_budget_config())
+
+    history = [server._ensure_entry_id(make_consult_entry(index)) for index in range(20)]
+
+    assert server._select_entries_to_compact(history) == []
+
+
+def test_lone_large_sync_does_not_trigger_repeated_compaction(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+    monkeypatch.setattr(server, "get_aurai_config", lambda: make_token_budget_config())
+
+    history = [
+        server._ensure_entry_id({"type": "summary", "summary_text": "旧纪要", "covered_entry_count": 4}),
+        server._ensure_entry_id({
+            "type": "sync_context",
+            "files": ["big.log"],
+            "project_info": {},
+            "file_contents": {"big.log": "y" * 24000},
+        }),
+        server._ensure_entry_id(make_consult_entry(0)),
+    ]
+
+    # 大文件同步本身占满预算，但可回收的只有一条很小的咨询，不值得再摘要
+    assert server._select_entries_to_compact(history) == []
+
+
+@pytest.mark.asyncio
+async def test_rolling_summary_folds_previous_summary(server_module, tmp_path, monkeypatch):
+    server = server_module
+    configure_persistence(server, tmp_path)
+    recorder = {}
+    monkeypatch.setattr(
+        server,
+        "get_aurai_client",
+        lambda: FakeClient({"status": "guiding", "guidance": "合并后的摘要", "analysis": ""}, recorder),
+    )
+
+    previous = {"type": "summary", "summary_text": "第一阶段：定位到配置加载顺序问题", "covered_entry_count": 6}
+    long_consult = make_consult_entry(1)
+    long_consult["error_message"] = "z" * 5000
+
+    summary = await server._generate_llm_summary([previous, make_consult_entry(0), long_consult])
+
+    prompt = recorder["kwargs"]["user_message"]
+    assert "既有摘要" in prompt
+    assert "第一阶段：定位到配置加载顺序问题" in prompt
+    assert "z" * 5000 not in prompt
+    assert summary["summary_text"] == "合并后的摘要"
+    assert summary["covered_entry_count"] == 8
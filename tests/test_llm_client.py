@@ -0,0 +1,1496 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+
+def make_completion(content: str):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+    )
+
+
+def make_client(completions, **overrides):
+    from mcp_aurai.calibration import TokenCalibrator
+    from mcp_aurai.capabilities import CapabilityStore
+    from mcp_aurai.config import AuraiConfig
+    from mcp_aurai.endpoints import Endpoint, EndpointPool
+    from mcp_aurai.hedging import HedgePolicy
+    from mcp_aurai.llm import AuraiClient, OutboundScheduler
+    from mcp_aurai.rate_limit import RateLimiter
+
+    settings = {
+        "api_key": "test-api-key-12345",
+        "base_url": "https://example.com/v1",
+        "model": "test-model",
+        "max_tokens": 1000,
+        "context_window": 20000,
+        "max_message_tokens": 5000,
+        "capability_probe": False,
+    }
+    settings.update(overrides)
+
+    client = AuraiClient.__new__(AuraiClient)
+    client.config = AuraiConfig(**settings)
+    client._pool = EndpointPool([
+        Endpoint(
+            name="default",
+            model=client.config.model,
+            client=SimpleNamespace(chat=SimpleNamespace(completions=completions)),
+            base_url=client.config.base_url,
+        )
+    ])
+    client._scheduler = OutboundScheduler(client.config.max_concurrent_requests)
+    client._rate_limiter = RateLimiter(
+        rpm=client.config.rate_limit_rpm,
+        tpm=client.config.rate_limit_tpm,
+        max_wait_seconds=client.config.rate_limit_max_wait,
+    )
+    client.token_calibrator = TokenCalibrator(None)
+    client._capabilities = CapabilityStore(None, client.config.capability_ttl)
+    client._hedge = None
+    if client.config.hedge_enabled:
+        client._hedge = HedgePolicy(
+            percentile=client.config.hedge_percentile,
+            min_delay=client.config.hedge_min_delay,
+            max_per_minute=client.config.hedge_max_per_minute,
+        )
+    return client
+
+
+@pytest.mark.asyncio
+async def test_chat_calls_from_two_sessions_overlap():
+    in_flight = 0
+    max_in_flight = 0
+    both_started = asyncio.Event()
+
+    class SlowCompletions:
+        async def create(self, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            if in_flight >= 2:
+                both_started.set()
+            # 串行执行时第二个请求永远进不来，这里会超时
+            await asyncio.wait_for(both_started.wait(), timeout=2)
+            in_flight -= 1
+            return make_completion('{"status": "guiding"}')
+
+    client = make_client(SlowCompletions())
+
+    results = await asyncio.gather(
+        client.chat(user_message="alpha", conversation_history=[]),
+        client.chat(user_message="beta", conversation_history=[]),
+    )
+
+    assert max_in_flight == 2
+    assert [response["status"] for response, _ in results] == ["guiding", "guiding"]
+
+
+@pytest.mark.asyncio
+async def test_chat_does_not_block_event_loop_while_waiting():
+    ticks = 0
+    release = asyncio.Event()
+
+    class WaitingCompletions:
+        async def create(self, **kwargs):
+            await release.wait()
+            return make_completion('{"status": "guiding"}')
+
+    async def ticker():
+        nonlocal ticks
+        for _ in range(5):
+            ticks += 1
+            await asyncio.sleep(0)
+        release.set()
+
+    client = make_client(WaitingCompletions())
+    (response, _), _ = await asyncio.gather(
+        client.chat(user_message="hello", conversation_history=[]),
+        ticker(),
+    )
+
+    assert ticks == 5
+    assert response["status"] == "guiding"
+
+
+def make_chunk(content: str | None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=None)]
+    )
+
+
+class FakeStream:
+    def __init__(self, pieces: list[str], stall_after: int | None = None):
+        self.pieces = pieces
+        self.stall_after = stall_after
+        self.closed = False
+        # 开始卡住时置位，测试据此确认流已在消费中
+        self.stalled = asyncio.Event()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for index, piece in enumerate(self.pieces):
+            if self.stall_after is not None and index >= self.stall_after:
+                self.stalled.set()
+                await asyncio.sleep(10)
+            yield make_chunk(piece)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_streaming_field_extractor_handles_split_escapes():
+    from mcp_aurai.llm import StreamingFieldExtractor
+
+    extractor = StreamingFieldExtractor()
+    text = '{"status": "guiding", "questions": ["x"], "analysis": "第一行\\n引号\\"\\u4e2d", "guidance": "改'
+    for index in range(0, len(text), 3):
+        extractor.feed(text[index:index + 3])
+
+    assert extractor.snapshot() == {"analysis": '第一行\n引号"中', "guidance": "改"}
+
+
+@pytest.mark.asyncio
+async def test_chat_streaming_collects_deltas_and_reports_progress(monkeypatch):
+    import mcp_aurai.llm as llm
+
+    monkeypatch.setattr(llm, "STREAM_PROGRESS_MIN_CHARS", 5)
+    captured = {}
+    body = '{"status": "guiding", "analysis": "根因在配置加载顺序", "guidance": "先调用 load_dotenv 再读取配置"}'
+    stream = FakeStream([body[index:index + 7] for index in range(0, len(body), 7)])
+
+    class StreamingCompletions:
+        async def create(self, **kwargs):
+            captured.update(kwargs)
+            return stream
+
+    progress_events = []
+
+    async def on_progress(partial):
+        progress_events.append(partial)
+
+    client = make_client(StreamingCompletions(), stream_responses=True)
+    response, _ = await client.chat(
+        user_message="hello",
+        conversation_history=[],
+        on_progress=on_progress,
+    )
+
+    assert captured["stream"] is True
+    assert stream.closed is True
+    assert response["guidance"] == "先调用 load_dotenv 再读取配置"
+    assert progress_events
+    assert progress_events[0]["analysis"].startswith("根因")
+
+
+@pytest.mark.asyncio
+async def test_chat_streaming_times_out_per_chunk():
+    stream = FakeStream(['{"status": ', '"guiding"}'], stall_after=1)
+
+    class StallingCompletions:
+        async def create(self, **kwargs):
+            return stream
+
+    client = make_client(
+        StallingCompletions(),
+        stream_responses=True,
+        stream_chunk_timeout=0.05,
+        retry_max_attempts=1,
+    )
+    response, _ = await client.chat(user_message="hello", conversation_history=[])
+
+    assert response["analysis"] == "请求失败"
+    assert response["requires_human_intervention"] is True
+    assert stream.closed is True
+
+
+@pytest.mark.asyncio
+async def test_chat_cancellation_aborts_upstream_stream():
+    import mcp_aurai.llm as llm
+
+    stream = FakeStream(['{"status": ', '"guiding"}'], stall_after=1)
+
+    class StallingCompletions:
+        async def create(self, **kwargs):
+            return stream
+
+    client = make_client(StallingCompletions(), stream_responses=True, stream_chunk_timeout=30)
+    before = llm.get_call_stats()
+
+    task = asyncio.create_task(client.chat(user_message="hello", conversation_history=[]))
+    await asyncio.wait_for(stream.stalled.wait(), timeout=5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert stream.closed is True
+    assert client._scheduler.in_flight == 0
+    assert client._pool.endpoints[0].in_flight == 0
+    assert llm.get_call_stats()["cancelled"] == before["cancelled"] + 1
+
+
+@pytest.mark.asyncio
+async def test_chat_deadline_returns_timed_out_result():
+    import mcp_aurai.llm as llm
+
+    class HangingCompletions:
+        async def create(self, **kwargs):
+            await asyncio.sleep(10)
+
+    client = make_client(HangingCompletions())
+    before = llm.get_call_stats()
+
+    response, token_usage = await client.chat(
+        user_message="hello",
+        conversation_history=[],
+        deadline_seconds=0.05,
+    )
+
+    assert response["analysis"] == "请求超时"
+    assert response["requires_human_intervention"] is False
+    assert token_usage["timed_out"] is True
+    assert token_usage["estimated_input_tokens"] > 0
+    assert client._scheduler.in_flight == 0
+    assert llm.get_call_stats()["timed_out"] == before["timed_out"] + 1
+
+
+def test_history_groups_are_cached_per_entry(monkeypatch):
+    import mcp_aurai.llm as llm
+
+    llm.invalidate_history_cache()
+    client = make_client(None)
+    history = [
+        {
+            "entry_id": "sync-1",
+            "type": "sync_context",
+            "project_info": {},
+            "file_contents": {"main.py.txt": "print('hello')\n" * 200},
+        },
+        {
+            "entry_id": "consult-1",
+            "type": "consult",
+            "problem_type": "runtime_error",
+            "error_message": "boom",
+            "response": {"analysis": "原因", "guidance": "修复"},
+        },
+    ]
+    first_groups = client._build_message_groups_from_history(history)
+    assert first_groups[0]["tokens"] == client._estimate_messages_tokens(first_groups[0]["messages"])
+
+    estimated_texts = []
+    original_features = llm.text_features
+
+    def counting_features(text):
+        estimated_texts.append(text)
+        return original_features(text)
+
+    monkeypatch.setattr(llm, "text_features", counting_features)
+    history.append({
+        "entry_id": "consult-2",
+        "type": "consult",
+        "problem_type": "runtime_error",
+        "error_message": "second",
+        "response": {},
+    })
+    second_groups = client._build_message_groups_from_history(history)
+
+    assert second_groups[:2] == first_groups
+    assert second_groups[0] is first_groups[0]
+    assert all("print('hello')" not in text for text in estimated_texts)
+    assert any("second" in text for text in estimated_texts)
+
+
+def test_invalidate_history_cache_drops_entries():
+    import mcp_aurai.llm as llm
+
+    llm.invalidate_history_cache()
+    client = make_client(None)
+    entry = {"entry_id": "summary-1", "type": "summary", "summary_text": "旧纪要"}
+
+    client._build_message_groups_from_history([entry])
+    assert len(llm._history_group_cache) == 1
+
+    llm.invalidate_history_cache([entry])
+    assert len(llm._history_group_cache) == 0
+
+
+class FakeStatusError(Exception):
+    def __init__(self, status_code: int, headers: dict | None = None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class ScriptedCompletions:
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return make_completion(outcome)
+
+
+@pytest.mark.asyncio
+async def test_chat_retries_rate_limit_honouring_retry_after():
+    completions = ScriptedCompletions([
+        FakeStatusError(429, {"retry-after": "0.05"}),
+        FakeStatusError(503),
+        '{"status": "guiding"}',
+    ])
+    client = make_client(completions, retry_base_delay=0.01, retry_jitter=0)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert response["status"] == "guiding"
+    assert completions.calls == 3
+    assert token_usage["attempts"] == 3
+    # 第一次按 Retry-After 等待 0.05s，第二次按指数退避等待 0.02s
+    assert token_usage["retry_backoff_seconds"] == pytest.approx(0.07)
+
+
+@pytest.mark.asyncio
+async def test_chat_does_not_retry_fatal_errors():
+    completions = ScriptedCompletions([FakeStatusError(401), '{"status": "guiding"}'])
+    client = make_client(completions, retry_base_delay=0.01)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert response["analysis"] == "请求失败"
+    assert completions.calls == 1
+    assert token_usage["attempts"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_gives_up_when_retry_after_exceeds_deadline():
+    completions = ScriptedCompletions([
+        FakeStatusError(429, {"retry-after": "30"}),
+        '{"status": "guiding"}',
+    ])
+    client = make_client(completions, retry_deadline=1)
+
+    response, token_usage = await asyncio.wait_for(
+        client.chat(user_message="hello", conversation_history=[]),
+        timeout=1,
+    )
+
+    assert response["requires_human_intervention"] is True
+    assert completions.calls == 1
+    assert token_usage["retry_backoff_seconds"] == 0
+
+
+def test_backoff_grows_exponentially_and_is_capped():
+    from mcp_aurai.llm import _compute_backoff
+
+    config = SimpleNamespace(retry_base_delay=1.0, retry_max_delay=5.0, retry_jitter=0.0)
+    assert [_compute_backoff(attempt, config) for attempt in range(1, 5)] == [1.0, 2.0, 4.0, 5.0]
+
+    config.retry_jitter = 0.5
+    assert all(0.5 <= _compute_backoff(1, config) <= 1.0 for _ in range(20))
+
+
+def make_endpoint(name: str, completions=None, **kwargs):
+    from mcp_aurai.endpoints import Endpoint
+
+    return Endpoint(
+        name=name,
+        model=f"{name}-model",
+        client=SimpleNamespace(chat=SimpleNamespace(completions=completions)),
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+async def test_endpoint_pool_spreads_requests_by_weight():
+    from mcp_aurai.endpoints import EndpointPool
+
+    pool = EndpointPool([make_endpoint("a", weight=2), make_endpoint("b", weight=1)])
+    picked = []
+    for _ in range(6):
+        endpoint = await pool.acquire()
+        picked.append(endpoint.name)
+        await pool.release(endpoint)
+
+    assert picked.count("a") == 4
+    assert picked.count("b") == 2
+
+
+@pytest.mark.asyncio
+async def test_endpoint_pool_respects_concurrency_limit():
+    from mcp_aurai.endpoints import EndpointPool
+
+    pool = EndpointPool([make_endpoint("a", max_concurrency=1)])
+    first = await pool.acquire()
+    waiter = asyncio.create_task(pool.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    await pool.release(first)
+    second = await asyncio.wait_for(waiter, timeout=1)
+    assert second is first
+    assert first.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_endpoint_pool_ejects_failing_endpoint_until_cooldown():
+    from mcp_aurai.endpoints import EndpointPool
+
+    endpoint_a = make_endpoint("a")
+    endpoint_b = make_endpoint("b", weight=1)
+    pool = EndpointPool([endpoint_a, endpoint_b], failure_threshold=2, cooldown_seconds=60)
+
+    for _ in range(2):
+        endpoint_a.in_flight += 1
+        await pool.release(endpoint_a, failed=True)
+
+    assert endpoint_a.is_ejected(time.monotonic())
+    for _ in range(3):
+        endpoint = await pool.acquire()
+        assert endpoint is endpoint_b
+        await pool.release(endpoint)
+
+    # 冷却期满后恢复分配
+    endpoint_a.ejected_until = 0
+    await pool.release(await pool.acquire())
+    assert endpoint_a.total_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_fails_over_to_another_endpoint_without_backoff():
+    from mcp_aurai.endpoints import EndpointPool
+
+    failing = ScriptedCompletions([FakeStatusError(502)])
+    healthy = ScriptedCompletions(['{"status": "guiding"}'])
+    client = make_client(None, retry_base_delay=30)
+    client._pool = EndpointPool([make_endpoint("a", failing, weight=2), make_endpoint("b", healthy)])
+
+    response, token_usage = await asyncio.wait_for(
+        client.chat(user_message="hello", conversation_history=[]),
+        timeout=1,
+    )
+
+    assert response["status"] == "guiding"
+    assert (failing.calls, healthy.calls) == (1, 1)
+    assert token_usage["attempts"] == 2
+    assert token_usage["retry_backoff_seconds"] == 0
+    assert token_usage["endpoint"] == "b"
+    assert [stats["total_failures"] for stats in client.endpoint_stats()] == [1, 0]
+
+
+class HangingCompletions:
+    def __init__(self):
+        self.cancelled = False
+
+    async def create(self, **kwargs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def make_hedging_client(primary, secondary, **overrides):
+    from mcp_aurai.endpoints import EndpointPool
+
+    client = make_client(
+        None,
+        hedge_enabled=True,
+        hedge_min_delay=0.02,
+        hedge_max_per_minute=1,
+        **overrides,
+    )
+    client._pool = EndpointPool([make_endpoint("a", primary, weight=2), make_endpoint("b", secondary)])
+    for _ in range(20):
+        client._hedge.latency.observe(0.01)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_chat_hedges_slow_primary_and_cancels_loser():
+    primary = HangingCompletions()
+    secondary = ScriptedCompletions(['{"status": "guiding", "analysis": "对冲结果"}'])
+    client = make_hedging_client(primary, secondary)
+
+    response, token_usage = await asyncio.wait_for(
+        client.chat(user_message="hello", conversation_history=[]),
+        timeout=1,
+    )
+
+    assert response["analysis"] == "对冲结果"
+    assert token_usage["hedged"] is True
+    assert token_usage["hedge_won"] is True
+    assert token_usage["endpoint"] == "b"
+    assert primary.cancelled is True
+    assert [stats["in_flight"] for stats in client.endpoint_stats()] == [0, 0]
+    assert [stats["total_failures"] for stats in client.endpoint_stats()] == [0, 0]
+    assert client.hedge_stats()["hedge_wins"] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedging_respects_per_minute_budget():
+    secondary = ScriptedCompletions(['{"status": "guiding"}'])
+    client = make_hedging_client(HangingCompletions(), secondary)
+    await client.chat(user_message="hello", conversation_history=[])
+
+    # 额度用完后不再对冲，慢请求只能等到调用时限
+    response, token_usage = await client.chat(
+        user_message="hello",
+        conversation_history=[],
+        deadline_seconds=0.2,
+    )
+
+    assert token_usage["timed_out"] is True
+    assert "hedged" not in token_usage
+    assert secondary.calls == 1
+    stats = client.hedge_stats()
+    assert stats["hedged"] == 1
+    assert stats["budget_remaining"] == 0
+    assert stats["budget_skipped"] == 1
+
+
+class RecordingCompletions:
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return make_completion(self.content)
+
+
+@pytest.mark.asyncio
+async def test_hedge_request_skips_capability_probe():
+    from mcp_aurai.capabilities import CapabilityStore, EndpointCapabilities
+
+    secondary = RecordingCompletions('{"status": "guiding", "analysis": "对冲结果"}')
+    client = make_hedging_client(HangingCompletions(), secondary, capability_probe=True)
+    client._capabilities.put(
+        CapabilityStore.key(None, "a-model"),
+        EndpointCapabilities({"json_schema": True, "streaming": False, "probed_at": time.time()}),
+    )
+
+    response, token_usage = await asyncio.wait_for(
+        client.chat(user_message="hello", conversation_history=[]),
+        timeout=1,
+    )
+
+    assert response["analysis"] == "对冲结果"
+    assert token_usage["hedge_won"] is True
+    # 对冲端点没有能力记录：不探测，直接用 json_object 发出请求
+    assert len(secondary.requests) == 1
+    assert not max_tokens_is_probe(secondary.requests[0])
+    assert secondary.requests[0]["response_format"] == {"type": "json_object"}
+
+
+def test_first_byte_signal_times_from_start():
+    from mcp_aurai.hedging import FirstByteSignal
+
+    signal = FirstByteSignal()
+    signal.started_at -= 5
+    signal.start()
+    signal()
+
+    assert signal.started.is_set()
+    assert signal.latency < 1
+
+
+@pytest.mark.asyncio
+async def test_fast_primary_is_not_hedged():
+    primary = ScriptedCompletions(['{"status": "guiding"}'])
+    secondary = ScriptedCompletions([])
+    client = make_hedging_client(primary, secondary)
+    client.config.hedge_min_delay = 1
+
+    _, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert token_usage["endpoint"] == "a"
+    assert "hedged" not in token_usage
+    assert secondary.calls == 0
+    assert len(client._hedge.latency) == 21
+
+
+def test_hedge_policy_needs_enough_samples():
+    from mcp_aurai.hedging import HEDGE_MIN_SAMPLES, HedgePolicy, LatencyTracker
+
+    policy = HedgePolicy(percentile=0.9, min_delay=0.5, max_per_minute=2)
+    for seconds in range(1, HEDGE_MIN_SAMPLES):
+        policy.latency.observe(seconds)
+    assert policy.delay() is None
+
+    policy.latency.observe(HEDGE_MIN_SAMPLES)
+    assert policy.delay() == 18
+    policy.latency = LatencyTracker()
+    for _ in range(HEDGE_MIN_SAMPLES):
+        policy.latency.observe(0.1)
+    assert policy.delay() == 0.5
+
+
+@pytest.mark.asyncio
+async def test_chat_records_cached_prompt_tokens():
+    import mcp_aurai.llm as llm
+
+    class CachedCompletions:
+        async def create(self, **kwargs):
+            completion = make_completion('{"status": "guiding"}')
+            completion.usage = SimpleNamespace(
+                prompt_tokens=1200,
+                completion_tokens=30,
+                total_tokens=1230,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=1024),
+            )
+            return completion
+
+    before = llm.get_prompt_cache_stats()
+    client = make_client(CachedCompletions())
+    _, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert token_usage["actual_prompt_tokens"] == 1200
+    assert token_usage["cached_prompt_tokens"] == 1024
+    stats = llm.get_prompt_cache_stats()
+    assert stats["hit_requests"] == before["hit_requests"] + 1
+    assert stats["cached_tokens"] == before["cached_tokens"] + 1024
+    assert stats["avg_hit_latency_seconds"] is not None
+
+
+def test_endpoints_config_inherits_defaults():
+    from mcp_aurai.config import AuraiConfig
+
+    config = AuraiConfig(
+        api_key="test-api-key-12345",
+        base_url="https://example.com/v1",
+        model="default-model",
+        endpoints='[{"base_url": "https://backup.example.com/v1", "weight": 3}, {"name": "eu", "model": "eu-model"}]',
+    )
+
+    endpoints = config.resolved_endpoints()
+    assert [(e.name, e.base_url, e.model, e.weight) for e in endpoints] == [
+        ("endpoint-1", "https://backup.example.com/v1", "default-model", 3),
+        ("eu", "https://example.com/v1", "eu-model", 1),
+    ]
+    assert all(e.api_key == "test-api-key-12345" for e in endpoints)
+
+
+def test_endpoints_with_own_keys_do_not_need_global_key(monkeypatch):
+    from pydantic import ValidationError
+
+    from mcp_aurai.config import AuraiConfig
+
+    monkeypatch.delenv("AURAI_API_KEY", raising=False)
+    config = AuraiConfig(
+        base_url="https://example.com/v1",
+        endpoints='[{"name": "a", "api_key": "key-for-endpoint-a"}, {"name": "b", "api_key": "key-for-endpoint-b"}]',
+    )
+    assert [e.api_key for e in config.resolved_endpoints()] == ["key-for-endpoint-a", "key-for-endpoint-b"]
+
+    # 有端点没有自己的密钥时仍需要 AURAI_API_KEY
+    with pytest.raises(ValidationError, match="端点 b 未配置 api_key"):
+        AuraiConfig(
+            base_url="https://example.com/v1",
+            endpoints='[{"name": "a", "api_key": "key-for-endpoint-a"}, {"name": "b"}]',
+        )
+    with pytest.raises(ValidationError, match="API密钥不能为空"):
+        AuraiConfig(base_url="https://example.com/v1")
+    with pytest.raises(ValidationError, match="长度不能少于10个字符"):
+        AuraiConfig(base_url="https://example.com/v1", endpoints='[{"api_key": "short"}]')
+
+
+async def drain_grants(scheduler, waiters):
+    order = []
+    for _ in waiters:
+        scheduler.release()
+        await asyncio.sleep(0)
+        newly_done = [name for name, task in waiters if task.done() and name not in order]
+        order.extend(newly_done)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_outbound_scheduler_rotates_between_sessions():
+    from mcp_aurai.llm import OutboundScheduler
+
+    scheduler = OutboundScheduler(1)
+    await scheduler.acquire("busy")
+
+    waiters = []
+    for name, session in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b")]:
+        waiters.append((name, asyncio.create_task(scheduler.acquire(session))))
+        await asyncio.sleep(0)
+    assert scheduler.queued() == 4
+
+    assert await drain_grants(scheduler, waiters) == ["a1", "b1", "a2", "a3"]
+
+
+@pytest.mark.asyncio
+async def test_outbound_scheduler_serves_interactive_before_background():
+    from mcp_aurai.llm import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, OutboundScheduler
+
+    scheduler = OutboundScheduler(1)
+    await scheduler.acquire("busy")
+
+    waiters = [
+        ("summary", asyncio.create_task(scheduler.acquire("a", PRIORITY_BACKGROUND))),
+    ]
+    await asyncio.sleep(0)
+    waiters.append(("consult", asyncio.create_task(scheduler.acquire("b", PRIORITY_INTERACTIVE))))
+    await asyncio.sleep(0)
+
+    assert await drain_grants(scheduler, waiters) == ["consult", "summary"]
+
+
+@pytest.mark.asyncio
+async def test_outbound_scheduler_cancelled_waiter_does_not_leak_slot():
+    from mcp_aurai.llm import OutboundScheduler
+
+    scheduler = OutboundScheduler(1)
+    await scheduler.acquire("busy")
+    cancelled = asyncio.create_task(scheduler.acquire("a"))
+    waiting = asyncio.create_task(scheduler.acquire("b"))
+    await asyncio.sleep(0)
+
+    cancelled.cancel()
+    await asyncio.gather(cancelled, return_exceptions=True)
+    scheduler.release()
+    await asyncio.wait_for(waiting, timeout=1)
+
+    assert scheduler.in_flight == 1
+    assert scheduler.queued() == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_reports_queue_wait_when_over_global_cap():
+    release = asyncio.Event()
+    entered = asyncio.Event()
+
+    class GatedCompletions:
+        async def create(self, **kwargs):
+            entered.set()
+            await release.wait()
+            return make_completion('{"status": "guiding"}')
+
+    async def until_queued():
+        while client._scheduler.queued() < 1:
+            await asyncio.sleep(0)
+
+    client = make_client(GatedCompletions(), max_concurrent_requests=1)
+    first = asyncio.create_task(client.chat(user_message="a", conversation_history=[], session_id="a"))
+    await asyncio.wait_for(entered.wait(), timeout=5)
+    second = asyncio.create_task(client.chat(user_message="b", conversation_history=[], session_id="b"))
+    await asyncio.wait_for(until_queued(), timeout=5)
+    assert client.outbound_stats() == {"max_in_flight": 1, "in_flight": 1, "queued": 1}
+
+    # 已确认第二个请求在排队，这里只是让排队时间可测
+    await asyncio.sleep(0.01)
+    release.set()
+    (_, first_usage), (_, second_usage) = await asyncio.gather(first, second)
+
+    assert first_usage["queue_wait_seconds"] == 0
+    assert second_usage["queue_wait_seconds"] > 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_while_queued_refunds_rate_limit_charge():
+    release = asyncio.Event()
+    entered = asyncio.Event()
+
+    class GatedCompletions:
+        async def create(self, **kwargs):
+            entered.set()
+            await release.wait()
+            return make_completion('{"status": "guiding"}')
+
+    async def until_queued():
+        while client._scheduler.queued() < 1:
+            await asyncio.sleep(0)
+
+    client = make_client(GatedCompletions(), max_concurrent_requests=1, rate_limit_rpm=60)
+    first = asyncio.create_task(client.chat(user_message="a", conversation_history=[], session_id="a"))
+    await asyncio.wait_for(entered.wait(), timeout=5)
+    second = asyncio.create_task(client.chat(user_message="b", conversation_history=[], session_id="b"))
+    await asyncio.wait_for(until_queued(), timeout=5)
+    assert client.rate_limit_stats()["rpm_available"] == pytest.approx(58, abs=0.1)
+
+    # 排队中的请求被取消：没有发出，预约的请求额度退还
+    second.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await second
+    assert client.rate_limit_stats()["rpm_available"] == pytest.approx(59, abs=0.1)
+
+    release.set()
+    await first
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_waits_locally_then_rejects_beyond_max_wait():
+    from mcp_aurai.rate_limit import RateLimiter, RateLimitExceeded
+
+    limiter = RateLimiter(rpm=60, tpm=600, max_wait_seconds=0.5)
+    # 每秒恢复 1 个请求额度：余额 0.95 时下一个请求需要等待约 0.05s
+    limiter.request_bucket.level = 0.95
+    wait_seconds, charged = await limiter.acquire(100)
+    assert 0.03 < wait_seconds < 0.1
+    assert charged == 100
+
+    # TPM 每秒恢复 10：还差约 500 tokens，需要等待约 50s，超过上限直接拒绝
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await limiter.acquire(1000)
+    assert exc_info.value.reason == "TPM 额度不足"
+    assert limiter.rejected == 1
+
+    # 实际只用了 20 tokens：退还多扣的 80
+    before = limiter.token_bucket.available(time.monotonic())
+    limiter.reconcile(charged, 20)
+    assert limiter.token_bucket.available(time.monotonic()) == pytest.approx(before + 80, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_chat_rejected_by_local_rate_limit_without_calling_provider():
+    completions = ScriptedCompletions(['{"status": "guiding"}'])
+    client = make_client(completions, rate_limit_tpm=1000, rate_limit_max_wait=0)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert completions.calls == 0
+    assert response["analysis"] == "请求被本地限流拒绝"
+    assert response["requires_human_intervention"] is False
+    assert response["retry_after_seconds"] > 0
+    assert token_usage["rate_limited"] is True
+
+
+@pytest.mark.asyncio
+async def test_chat_reconciles_tpm_with_reported_usage():
+    class UsageCompletions:
+        async def create(self, **kwargs):
+            completion = make_completion('{"status": "guiding"}')
+            completion.usage = SimpleNamespace(prompt_tokens=300, completion_tokens=50, total_tokens=350)
+            return completion
+
+    client = make_client(UsageCompletions(), rate_limit_tpm=100000)
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert response["status"] == "guiding"
+    assert token_usage["actual_prompt_tokens"] == 300
+    assert token_usage["actual_completion_tokens"] == 50
+    # 预扣的是“输入估算 + 输出上限”，完成后只保留实际的 350
+    assert client.rate_limit_stats()["tpm_available"] == pytest.approx(100000 - 350, abs=2)
+
+
+def test_token_calibrator_fits_per_content_factors(tmp_path):
+    from mcp_aurai.calibration import TokenCalibrator, text_features
+
+    chinese = text_features("配置加载顺序错误导致环境变量没有生效" * 20)
+    latin = text_features("the config loader reads environment variables first " * 20)
+    calibrator = TokenCalibrator(tmp_path / "token_calibration.json")
+
+    # 未校准时与 estimate_tokens 完全一致
+    assert calibrator.estimate_message(chinese, 7, "m") == int(sum(chinese)) + 7
+
+    # 该模型的分词器对中文更省（0.6 倍），对英文更费（1.3 倍）
+    for _ in range(40):
+        calibrator.observe("m", chinese, int(sum(chinese) * 0.6))
+        calibrator.observe("m", latin, int(sum(latin) * 1.3))
+
+    factors = calibrator.factors("m")
+    assert factors[0] == pytest.approx(0.6, abs=0.05)
+    assert factors[1] == pytest.approx(1.3, abs=0.05)
+    assert calibrator.factors("other-model") == (1.0, 1.0, 1.0)
+
+    stats = calibrator.stats()["m"]
+    assert stats["samples"] == 80
+    assert stats["calibrated_error_pct"] < stats["raw_error_pct"]
+
+    # 持久化后重新加载，系数保持不变
+    calibrator.flush()
+    reloaded = TokenCalibrator(tmp_path / "token_calibration.json")
+    assert reloaded.stats()["m"]["factors"] == stats["factors"]
+    assert reloaded.factors("m") == pytest.approx(factors, rel=0.02)
+
+
+def test_token_calibrator_debounces_writes_and_version_bumps(tmp_path, monkeypatch):
+    import mcp_aurai.calibration as calibration
+    from mcp_aurai.calibration import TokenCalibrator, text_features
+
+    path = tmp_path / "token_calibration.json"
+    calibrator = TokenCalibrator(path)
+    latin = text_features("the config loader reads environment variables first " * 20)
+    saves = []
+    original_save = calibrator._save
+    monkeypatch.setattr(calibrator, "_save", lambda: (saves.append(1), original_save()))
+
+    for _ in range(calibration.CALIBRATION_SAVE_EVERY - 1):
+        calibrator.observe("m", latin, int(sum(latin) * 1.3))
+    assert saves == [] and not path.exists()
+    calibrator.observe("m", latin, int(sum(latin) * 1.3))
+    assert len(saves) == 1 and path.exists()
+
+    # 系数收敛后，细小的变化不再使历史分组缓存失效
+    for _ in range(100):
+        calibrator.observe("m", latin, int(sum(latin) * 1.3))
+    version = calibrator.version
+    for _ in range(10):
+        calibrator.observe("m", latin, int(sum(latin) * 1.3))
+    assert calibrator.version == version
+    assert calibrator.factors("m")[1] == pytest.approx(1.3, rel=calibration.CALIBRATION_VERSION_THRESHOLD * 2)
+
+    # 退出时补写未落盘的观测
+    calibrator.observe("m", latin, int(sum(latin) * 1.3))
+    calibrator.flush()
+    assert TokenCalibrator(path).stats()["m"]["samples"] == calibrator.stats()["m"]["samples"]
+
+
+@pytest.mark.asyncio
+async def test_chat_calibrates_history_budget_with_reported_usage():
+    import mcp_aurai.llm as llm
+    from mcp_aurai.calibration import prompt_features
+
+    llm.invalidate_history_cache()
+
+    class UsageCompletions:
+        def __init__(self):
+            self.prompt_tokens = 0
+
+        async def create(self, **kwargs):
+            completion = make_completion('{"status": "guiding"}')
+            # 服务商实际计数是未校准估算的 2 倍
+            self.prompt_tokens = int(sum(prompt_features(kwargs["messages"])) * 2)
+            completion.usage = SimpleNamespace(
+                prompt_tokens=self.prompt_tokens,
+                completion_tokens=10,
+                total_tokens=self.prompt_tokens + 10,
+            )
+            return completion
+
+    completions = UsageCompletions()
+    client = make_client(completions)
+    history = [{"entry_id": "summary-1", "type": "summary", "summary_text": "the earlier summary " * 50}]
+    first_groups = client._build_message_groups_from_history(history)
+    raw_tokens = first_groups[0]["tokens"]
+
+    messages = ["hello world " * 300, "你好世界" * 300, "if (x) { y[i] = f(z); }\n" * 100]
+    for index in range(45):
+        await client.chat(user_message=messages[index % 3], conversation_history=[])
+
+    groups = client._build_message_groups_from_history(history)
+    # 缓存的分组保留，token 数按新系数重算
+    assert groups[0] is first_groups[0]
+    assert groups[0]["tokens"] == pytest.approx(raw_tokens * 2, rel=0.1)
+    assert client.calibrator.stats()["test-model"]["last_error_pct"] < 10
+
+
+def write_tiktoken_vocab(path):
+    import base64
+
+    merges = [b"he", b"ll", b"hell", b"hello", b" w", b"or"]
+    lines = [f"{base64.b64encode(bytes([value])).decode()} {value}" for value in range(256)]
+    lines += [f"{base64.b64encode(token).decode()} {256 + index}" for index, token in enumerate(merges)]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return path
+
+
+def test_bpe_tokenizer_counts_exactly_from_local_vocab(tmp_path):
+    import json
+
+    from mcp_aurai.tokenizer import BPETokenizer
+
+    tokenizer = BPETokenizer(write_tiktoken_vocab(tmp_path / "tiny.tiktoken"))
+    # "hello" 合并为 1 个 token；" world" 得到 " w" / "or" / "l" / "d"
+    assert tokenizer.count("hello world") == 5
+
+    # GPT-2 格式（vocab.json + merges.txt）按合并顺序得到相同的结果
+    gpt2_dir = tmp_path / "gpt2"
+    gpt2_dir.mkdir()
+    (gpt2_dir / "merges.txt").write_text(
+        "#version: 0.2\nh e\nl l\nhe ll\nhell o\nĠ w\no r\n",
+        encoding="utf-8",
+    )
+    (gpt2_dir / "vocab.json").write_text(json.dumps({"hello": 0, "Ġw": 1}), encoding="utf-8")
+    assert BPETokenizer(gpt2_dir).count("hello world") == 5
+
+    # 长文本按内容哈希缓存，重复计数不再分词
+    text = "hello world " * 20
+    first = tokenizer.count(text)
+    assert tokenizer.count(text) == first
+    assert tokenizer.stats()["cache_hits"] == 1
+    assert tokenizer.stats()["cache_misses"] == 1
+
+    # 精确预分词依赖 regex（或 tiktoken）
+    pytest.importorskip("regex")
+    assert tokenizer.exact is True
+
+
+def test_bpe_tokenizer_picks_pattern_per_vocab_and_reports_approximation(tmp_path, monkeypatch):
+    import mcp_aurai.tokenizer as tokenizer_module
+
+    # o200k 按大小写切分驼峰词，cl100k 不切分
+    o200k = tokenizer_module.BPETokenizer(write_tiktoken_vocab(tmp_path / "o200k_base.tiktoken"))
+    cl100k = tokenizer_module.BPETokenizer(write_tiktoken_vocab(tmp_path / "cl100k_base.tiktoken"))
+    assert o200k._pattern.findall("HelloWorld") == ["Hello", "World"]
+    assert cl100k._pattern.findall("HelloWorld") == ["HelloWorld"]
+    assert tokenizer_module.tiktoken_pattern(tmp_path / "r50k_base.tiktoken") == tokenizer_module.GPT2_PATTERN
+
+    # 没有 regex 和 tiktoken 时只能近似预分词，计数不再视为精确（交给自校准）
+    monkeypatch.setattr(tokenizer_module, "_regex", None)
+    monkeypatch.setattr(tokenizer_module, "_tiktoken", None)
+    approximate = tokenizer_module.BPETokenizer(write_tiktoken_vocab(tmp_path / "o200k_base.tiktoken"))
+    assert approximate.exact is False
+    assert approximate._pattern.findall("HelloWorld") == ["Hello", "World"]
+    assert approximate.count("hello world") == 5
+
+
+def test_history_budget_uses_configured_tokenizer(tmp_path):
+    from mcp_aurai.tokenizer import HEURISTIC_TOKENIZER
+    from mcp_aurai.utils import estimate_tokens
+
+    import mcp_aurai.llm as llm
+
+    llm.invalidate_history_cache()
+    vocab_path = write_tiktoken_vocab(tmp_path / "tiny.tiktoken")
+    entry = {"entry_id": "summary-1", "type": "summary", "summary_text": "hello world " * 30}
+
+    # 默认使用字符数估算
+    heuristic_client = make_client(None)
+    assert heuristic_client.tokenizer is HEURISTIC_TOKENIZER
+    heuristic_tokens = heuristic_client.estimate_entry_tokens(entry)
+
+    # 词表加载失败时回退为估算
+    broken_client = make_client(None, tokenizer_files={"test-model": str(tmp_path / "missing.tiktoken")})
+    assert broken_client.tokenizer is HEURISTIC_TOKENIZER
+
+    pytest.importorskip("regex")
+    client = make_client(None, tokenizer_files={"test-*": str(vocab_path)})
+    assert client.tokenizer.exact is True
+    message = client._build_message_groups_from_history([entry])[0]["messages"][0]
+    expected = client.tokenizer.count(message["content"]) + estimate_tokens("system") + 6
+    assert client.estimate_entry_tokens(entry) == expected
+    assert expected != heuristic_tokens
+
+
+def test_history_budget_falls_back_to_estimate_without_exact_pretokenizer(tmp_path, monkeypatch):
+    import mcp_aurai.llm as llm
+    import mcp_aurai.tokenizer as tokenizer_module
+
+    llm.invalidate_history_cache()
+    monkeypatch.setattr(tokenizer_module, "_regex", None)
+    monkeypatch.setattr(tokenizer_module, "_tiktoken", None)
+    vocab_path = write_tiktoken_vocab(tmp_path / "tiny.tiktoken")
+    entry = {"entry_id": "summary-1", "type": "summary", "summary_text": "hello world " * 30}
+
+    # 词表能加载，但只能近似预分词：不视为精确，历史预算按校准后的字符数估算
+    client = make_client(None, tokenizer_files={"test-*": str(vocab_path)})
+    assert isinstance(client.tokenizer, tokenizer_module.BPETokenizer)
+    assert client.tokenizer.exact is False
+    assert client.estimate_entry_tokens(entry) == make_client(None).estimate_entry_tokens(entry)
+
+
+class FakeContextLengthError(FakeStatusError):
+    def __init__(self, message: str):
+        super().__init__(400)
+        self.code = "context_length_exceeded"
+        self.body = {"error": {"message": message, "code": "context_length_exceeded"}}
+
+
+def test_context_overflow_tokens_parses_provider_messages():
+    from mcp_aurai.llm import _context_overflow_tokens
+
+    openai_error = FakeContextLengthError(
+        "This model's maximum context length is 8192 tokens. "
+        "However, your messages resulted in 9000 tokens. Please reduce the length of the messages."
+    )
+    assert _context_overflow_tokens(openai_error) == 808
+
+    comparison_error = FakeStatusError(400)
+    comparison_error.body = {"error": {"message": "prompt is too long: 210000 tokens > 200000 maximum"}}
+    assert _context_overflow_tokens(comparison_error) == 10000
+
+    unknown_overshoot = FakeStatusError(400)
+    unknown_overshoot.body = {"error": {"message": "Prompt 超长"}}
+    assert _context_overflow_tokens(unknown_overshoot) == 0
+
+    # 429 的 “tokens per min” 等错误不是上下文超长
+    assert _context_overflow_tokens(FakeStatusError(429)) is None
+    assert _context_overflow_tokens(FakeStatusError(400)) is None
+
+
+@pytest.mark.asyncio
+async def test_chat_shrinks_history_and_retries_on_context_overflow():
+    import mcp_aurai.llm as llm
+
+    llm.invalidate_history_cache()
+
+    class OverflowingCompletions:
+        def __init__(self):
+            self.prompt_sizes = []
+
+        async def create(self, **kwargs):
+            self.prompt_sizes.append(sum(len(message["content"]) for message in kwargs["messages"]))
+            if len(self.prompt_sizes) == 1:
+                raise FakeContextLengthError(
+                    "This model's maximum context length is 8000 tokens. "
+                    "However, your messages resulted in 9500 tokens."
+                )
+            return make_completion('{"status": "guiding"}')
+
+    completions = OverflowingCompletions()
+    client = make_client(completions)
+    history = [
+        {"entry_id": f"summary-{index}", "type": "summary", "summary_text": "history text " * 150}
+        for index in range(8)
+    ]
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=history)
+
+    assert response["status"] == "guiding"
+    assert len(completions.prompt_sizes) == 2
+    assert completions.prompt_sizes[1] < completions.prompt_sizes[0]
+    assert token_usage["context_overflow_retries"] == 1
+    # 超出 1500 tokens，按 1.2 倍余量缩减
+    assert token_usage["context_shrink_tokens"] == 1801
+
+
+@pytest.mark.asyncio
+async def test_chat_reports_context_overflow_when_nothing_left_to_shrink():
+    completions = ScriptedCompletions([FakeContextLengthError("maximum context length exceeded")])
+    client = make_client(completions)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert completions.calls == 1
+    assert response["analysis"] == "请求失败：上下文超长"
+    assert token_usage["context_overflow"] is True
+
+
+def make_truncated_completion(content: str, finish_reason: str = "length"):
+    completion = make_completion(content)
+    completion.choices[0].finish_reason = finish_reason
+    return completion
+
+
+def test_repair_truncated_json_keeps_generated_fields():
+    from mcp_aurai.response_parser import repair_truncated_json
+
+    assert repair_truncated_json('{"analysis": "原因", "guidance": "先检查配') == {
+        "analysis": "原因",
+        "guidance": "先检查配",
+    }
+    assert repair_truncated_json('{"analysis": "原因", "action_items": ["a", "b"') == {
+        "analysis": "原因",
+        "action_items": ["a", "b"],
+    }
+    # 截断在字段名或字面量中间：丢弃不完整的最后一个字段
+    assert repair_truncated_json('{"analysis": "原因", "resol') == {"analysis": "原因"}
+    assert repair_truncated_json('{"analysis": "原因", "resolved": tr') == {"analysis": "原因"}
+    assert repair_truncated_json("not json") is None
+
+
+@pytest.mark.asyncio
+async def test_chat_continues_truncated_json_response():
+    class TruncatingCompletions:
+        def __init__(self):
+            self.requests = []
+
+        async def create(self, **kwargs):
+            self.requests.append(kwargs)
+            if len(self.requests) == 1:
+                return make_truncated_completion('{"analysis": "原因", "guidance": "先检查')
+            return make_truncated_completion('配置文件", "resolved": false}', finish_reason="stop")
+
+    completions = TruncatingCompletions()
+    client = make_client(completions)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert response["analysis"] == "原因"
+    assert response["guidance"] == "先检查配置文件"
+    assert response["resolved"] is False
+    assert token_usage["continuations"] == 1
+    assert token_usage["finish_reason"] == "stop"
+    continuation_request = completions.requests[1]
+    assert "response_format" not in continuation_request
+    assert continuation_request["messages"][-2] == {
+        "role": "assistant",
+        "content": '{"analysis": "原因", "guidance": "先检查',
+    }
+
+
+@pytest.mark.asyncio
+async def test_continuation_is_pinned_to_the_truncating_endpoint():
+    from mcp_aurai.endpoints import EndpointPool
+
+    class TruncatingOnce:
+        def __init__(self):
+            self.calls = 0
+
+        async def create(self, **kwargs):
+            self.calls += 1
+            if self.calls == 1:
+                return make_truncated_completion('{"analysis": "原因", "guidance": "先检查')
+            return make_truncated_completion('配置文件"}', finish_reason="stop")
+
+    first, other = TruncatingOnce(), TruncatingOnce()
+    client = make_client(None)
+    client._pool = EndpointPool([make_endpoint("a", first, weight=2), make_endpoint("b", other)])
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    # 端点池本来会把第二个请求分给空闲的 b，续写仍固定发往 a
+    assert response["guidance"] == "先检查配置文件"
+    assert token_usage["continuations"] == 1
+    assert (first.calls, other.calls) == (2, 0)
+
+    # 原端点被摘除后才回到端点池
+    client._pool.endpoints[0].ejected_until = time.monotonic() + 60
+    fallback = ScriptedCompletions(['配置文件"}'])
+    client._pool.endpoints[1].client.chat.completions = fallback
+    token_usage = {"finish_reason": "length", "endpoint": "a", "estimated_input_tokens": 10}
+    content = await client._continue_truncated_response(
+        {"messages": [{"role": "user", "content": "hello"}]},
+        '{"analysis": "原因", "guidance": "先检查',
+        token_usage,
+    )
+
+    assert fallback.calls == 1
+    assert content == '{"analysis": "原因", "guidance": "先检查配置文件"}'
+
+
+@pytest.mark.asyncio
+async def test_chat_repairs_json_when_continuations_run_out():
+    class AlwaysTruncated:
+        def __init__(self):
+            self.calls = 0
+
+        async def create(self, **kwargs):
+            self.calls += 1
+            if self.calls == 1:
+                return make_truncated_completion('{"analysis": "原因", "guidance": "第一段')
+            return make_truncated_completion("，继续")
+
+    completions = AlwaysTruncated()
+    client = make_client(completions)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert completions.calls == 3
+    assert token_usage["continuations"] == 2
+    assert token_usage["json_repaired"] is True
+    assert response["guidance"] == "第一段，继续，继续"
+    assert response.get("requires_human_intervention") is not True
+
+
+def test_parse_advisor_response_repairs_common_defects():
+    from mcp_aurai.response_parser import get_response_parse_stats, parse_advisor_response, reset_response_parse_stats
+
+    reset_response_parse_stats()
+
+    # 前后夹带说明文字
+    result, repair = parse_advisor_response('好的，分析如下：\n{"status": "guiding", "guidance": "改配置"}\n希望有帮助')
+    assert repair == "extracted"
+    assert result["guidance"] == "改配置"
+
+    # 单引号、尾随逗号、Python 字面量、注释、正则里的非法转义、缺少结尾括号
+    result, repair = parse_advisor_response(
+        "{'status': 'guiding', // 信息充足\n"
+        " 'guidance': '用 \\d+ 匹配数字', 'resolved': True, 'action_items': ['a', 'b',],"
+    )
+    assert repair == "normalized"
+    assert result["guidance"] == "用 \\d+ 匹配数字"
+    assert result["resolved"] is True
+    assert result["action_items"] == ["a", "b"]
+
+    # 缺失字段按 schema 补默认值，类型偏差被修正
+    result, repair = parse_advisor_response('{"questions": ["哪个文件？"], "needs_another_iteration": "true"}')
+    assert repair is None
+    assert result["status"] == "aligning"
+    assert result["needs_another_iteration"] is True
+    assert result["analysis"] is None
+    assert result["code_changes"] == []
+
+    assert parse_advisor_response("完全不是 JSON") == (None, None)
+
+    stats = get_response_parse_stats()
+    assert stats["parsed"] == 3
+    assert stats["recovered"] == 2
+    assert stats["failed"] == 1
+    assert stats["fields_filled"] > 0
+
+
+def test_schema_validator_reports_violations():
+    from mcp_aurai.response_parser import CONSULT_RESPONSE_VALIDATOR, normalize_consult_response
+
+    result, filled, errors = normalize_consult_response({"status": "guiding"})
+    assert errors == []
+    assert "guidance" in filled
+
+    errors = CONSULT_RESPONSE_VALIDATOR.validate({**result, "status": "done", "resolved": 1, "extra": True})
+    assert "$.status: 取值应为 aligning/guiding" in errors
+    assert "$.resolved: 类型应为 boolean" in errors
+    assert "$.extra: 不允许的字段" in errors
+
+
+class CapabilityCompletions:
+    """模拟不支持 json_schema、流式不返回 usage 的网关。"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        response_format = kwargs.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            error = FakeStatusError(400)
+            error.body = {"error": {"message": "response_format.type json_schema is not supported"}}
+            raise error
+        if kwargs.get("stream"):
+            if "stream_options" in kwargs:
+                raise FakeStatusError(400)
+            return FakeStream(['{"ok": ', "true}"])
+        if max_tokens_is_probe(kwargs):
+            return make_completion('{"ok": true}')
+        return make_completion('{"status": "guiding", "guidance": "ok"}')
+
+
+def max_tokens_is_probe(kwargs):
+    from mcp_aurai.capabilities import PROBE_MAX_TOKENS
+
+    return kwargs.get("max_tokens") == PROBE_MAX_TOKENS
+
+
+@pytest.mark.asyncio
+async def test_capabilities_are_probed_once_and_cached_on_disk(tmp_path):
+    from mcp_aurai.capabilities import CapabilityStore
+
+    completions = CapabilityCompletions()
+    client = make_client(completions, capability_probe=True)
+    client._capabilities = CapabilityStore(tmp_path / "caps.json", 3600)
+
+    for _ in range(2):
+        response, _ = await client.chat(user_message="hello", conversation_history=[])
+        assert response["status"] == "guiding"
+
+    probe_requests = [request for request in completions.requests if max_tokens_is_probe(request)]
+    # json_schema、json_object、带 stream_options 的流式、不带 stream_options 的流式各一次
+    assert len(probe_requests) == 4
+    chat_requests = [request for request in completions.requests if not max_tokens_is_probe(request)]
+    assert [request["response_format"] for request in chat_requests] == [{"type": "json_object"}] * 2
+
+    capabilities = client.endpoint_stats()[0]["capabilities"]
+    assert capabilities["json_schema"] is False
+    assert capabilities["json_object"] is True
+    assert capabilities["streaming"] is True
+    assert capabilities["stream_usage"] is False
+    assert capabilities["response_format"] == "json_object"
+
+    # 重新加载磁盘缓存后不再探测；过期后重新探测
+    reloaded = CapabilityStore(tmp_path / "caps.json", 3600)
+    assert reloaded.get("https://example.com/v1|test-model").json_object is True
+    assert CapabilityStore(tmp_path / "caps.json", 1e-9).get("https://example.com/v1|test-model") is None
+
+
+@pytest.mark.asyncio
+async def test_truncated_probe_is_inconclusive_and_aborted_probe_is_not_retried(tmp_path, monkeypatch):
+    import mcp_aurai.capabilities as capabilities_module
+
+    class ReasoningCompletions:
+        """推理模型：输出预算被思考内容耗尽，回复为空。"""
+
+        def __init__(self):
+            self.requests = []
+
+        async def create(self, **kwargs):
+            self.requests.append(kwargs)
+            if kwargs.get("stream"):
+                return FakeStream(["{}"])
+            if max_tokens_is_probe(kwargs):
+                return SimpleNamespace(
+                    choices=[SimpleNamespace(message=SimpleNamespace(content=""), finish_reason="length")]
+                )
+            return make_completion('{"status": "guiding", "guidance": "ok"}')
+
+    completions = ReasoningCompletions()
+    client = make_client(completions, capability_probe=True)
+    client._capabilities = capabilities_module.CapabilityStore(None, 3600)
+    await client.chat(user_message="hello", conversation_history=[])
+
+    capabilities = client.endpoint_stats()[0]["capabilities"]
+    assert capabilities["json_schema"] is None
+    assert capabilities["json_object"] is None
+    assert capabilities["response_format"] == "json_schema"
+    assert completions.requests[-1]["response_format"]["type"] == "json_schema"
+
+    # 限流等与能力无关的错误：本轮探测中止，短时间内不再重复探测
+    failing = ScriptedCompletions([FakeStatusError(429)])
+    store = capabilities_module.CapabilityStore(None, 3600)
+    endpoint_client = SimpleNamespace(chat=SimpleNamespace(completions=failing))
+    assert await store.resolve("gateway|model", endpoint_client, "model") is None
+    assert await store.resolve("gateway|model", endpoint_client, "model") is None
+    assert failing.calls == 1
+
+    monkeypatch.setattr(capabilities_module, "PROBE_RETRY_SECONDS", 0.0)
+    failing.outcomes = [FakeStatusError(503)]
+    assert await store.resolve("gateway|model", endpoint_client, "model") is None
+    assert failing.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_expired_record_without_probing_downgrades_at_most_twice():
+    from mcp_aurai.capabilities import CapabilityStore, EndpointCapabilities
+
+    class RejectingCompletions:
+        """json_schema 和 json_object 都不支持的网关。"""
+
+        def __init__(self):
+            self.requests = []
+
+        async def create(self, **kwargs):
+            self.requests.append(kwargs)
+            if kwargs.get("response_format"):
+                error = FakeStatusError(400)
+                error.body = {"error": {"message": "response_format is not supported"}}
+                raise error
+            return make_completion('{"status": "guiding", "guidance": "ok"}')
+
+    completions = RejectingCompletions()
+    client = make_client(completions)
+    client._capabilities = CapabilityStore(None, 1e-9)
+    key = "https://example.com/v1|test-model"
+    client._capabilities.put(key, EndpointCapabilities({"probed_at": 1.0}))
+
+    response, _ = await client.chat(user_message="hello", conversation_history=[])
+    assert response["status"] == "guiding"
+    assert [(request.get("response_format") or {}).get("type") for request in completions.requests] == [
+        "json_schema", "json_object", None,
+    ]
+    # 过期的记录在不探测时照样生效，之后直接不发送 response_format
+    await client.chat(user_message="hello", conversation_history=[])
+    assert completions.requests[-1].get("response_format") is None
+    assert len(completions.requests) == 4
+
+
+@pytest.mark.asyncio
+async def test_rejected_response_format_is_downgraded_without_probing():
+    completions = CapabilityCompletions()
+    client = make_client(completions)
+
+    response, token_usage = await client.chat(user_message="hello", conversation_history=[])
+
+    assert response["status"] == "guiding"
+    assert token_usage["attempts"] == 1
+    assert [request["response_format"]["type"] for request in completions.requests] == ["json_schema", "json_object"]
+
+    # 之后的请求直接使用 json_object
+    await client.chat(user_message="hello", conversation_history=[])
+    assert completions.requests[-1]["response_format"] == {"type": "json_object"}
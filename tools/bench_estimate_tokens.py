@@ -0,0 +1,91 @@
+"""
+estimate_tokens 微基准
+
+生成约 10 MB（UTF-8）的中英文混合文本，对比逐字符生成器的旧实现与当前实现的耗时，
+并校验两者结果完全一致。
+
+用法：
+    python tools/bench_estimate_tokens.py [目标字节数]
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+# 获取项目根目录
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+from mcp_aurai.utils import estimate_tokens  # noqa: E402
+
+# 默认输入大小（UTF-8 字节数）
+DEFAULT_TARGET_BYTES = 10 * 1024 * 1024
+
+# 每种实现重复测量的次数（取最快一次）
+REPEAT = 3
+
+CHINESE_SAMPLES = [
+    "配置加载顺序错误导致环境变量没有生效",
+    "请检查数据库连接池的超时设置",
+    "这个函数在并发场景下会出现竞态条件",
+    "上级顾问建议先复现问题再修改代码",
+]
+
+ENGLISH_SAMPLES = [
+    "def load_config(path: str) -> dict:\n    return json.loads(Path(path).read_text())\n",
+    "Traceback (most recent call last):\n  File \"server.py\", line 42, in handle\n",
+    "const result = await fetch(`${baseUrl}/v1/chat/completions`, { method: 'POST' });\n",
+    "SELECT id, name FROM users WHERE created_at > NOW() - INTERVAL '1 day';\n",
+]
+
+
+def legacy_estimate_tokens(text: str) -> int:
+    """旧实现：逐字符生成器统计中文字符。"""
+    if not text:
+        return 0
+    chinese_chars = sum(1 for c in text if '\u4e00' <= c <= '\u9fff')
+    other_chars = len(text) - chinese_chars
+    return int(chinese_chars / 1.5 + other_chars / 4)
+
+
+def build_mixed_text(target_bytes: int) -> str:
+    rng = random.Random(20240601)
+    parts: list[str] = []
+    size = 0
+    while size < target_bytes:
+        piece = rng.choice(CHINESE_SAMPLES) if rng.random() < 0.5 else rng.choice(ENGLISH_SAMPLES)
+        parts.append(piece)
+        size += len(piece.encode("utf-8"))
+    return "".join(parts)
+
+
+def measure(func, text: str) -> tuple[int, float]:
+    best = float("inf")
+    result = 0
+    for _ in range(REPEAT):
+        started_at = time.perf_counter()
+        result = func(text)
+        best = min(best, time.perf_counter() - started_at)
+    return result, best
+
+
+def main():
+    target_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TARGET_BYTES
+    text = build_mixed_text(target_bytes)
+    print(f"输入: {len(text):,} 字符 / {len(text.encode('utf-8')):,} 字节")
+
+    legacy_result, legacy_seconds = measure(legacy_estimate_tokens, text)
+    current_result, current_seconds = measure(estimate_tokens, text)
+
+    print(f"旧实现:   {legacy_seconds * 1000:8.1f} ms  → {legacy_result:,} tokens")
+    print(f"当前实现: {current_seconds * 1000:8.1f} ms  → {current_result:,} tokens")
+    print(f"加速比:   {legacy_seconds / current_seconds:8.1f}x")
+
+    if legacy_result != current_result:
+        print("结果不一致！")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
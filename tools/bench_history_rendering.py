@@ -0,0 +1,168 @@
+"""
+对话历史发送方式基准
+
+在录制的会话（历史目录下的 JSONL 历史文件）上逐轮重放 consult_aurai / report_progress 调用，
+分别按 inline（历史既作为消息发送、又在提示词中复述）和 single（每轮只发送一次，
+提示词中只保留引用）两种方式构造请求，统计输入 tokens 与节省量。
+不指定文件时使用固定随机种子生成的示例会话。
+
+用法：
+    python tools/bench_history_rendering.py [历史文件 ...]
+"""
+
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+# 获取项目根目录
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+from mcp_aurai.llm import HistoryMessageBuilder  # noqa: E402
+from mcp_aurai.prompts import SYSTEM_PROMPT, build_consult_prompt, build_progress_prompt  # noqa: E402
+from mcp_aurai.server import _parse_history_content  # noqa: E402
+
+# 与服务端默认值一致：提示词中复述最近多少轮
+PROMPT_HISTORY_TURNS = 10
+
+# 单个消息的 token 上限（与 AURAI_MAX_MESSAGE_TOKENS 默认值一致）
+MAX_MESSAGE_TOKENS = 150000
+
+# 示例会话的数量与每个会话的轮数
+SAMPLE_SESSIONS = 5
+SAMPLE_TURNS = 12
+
+SAMPLE_ANALYSES = [
+    "配置在 load_dotenv 之前就被读取，环境变量没有生效，导致连接了默认的本地数据库。",
+    "连接池的 max_overflow 为 0，高并发时请求排队超过 30 秒后超时，日志里的 TimeoutError 来自这里。",
+    "异步函数里调用了同步的 requests.get，阻塞了事件循环，其他协程都在等待。",
+]
+
+SAMPLE_GUIDANCE = [
+    "把 load_dotenv() 移到模块顶部，在导入 config 之前执行；然后重新运行测试确认配置值。",
+    "将 pool_size 调整为 20、max_overflow 调整为 10，并在请求结束时确保 session.close() 被调用。",
+    "改用 httpx.AsyncClient 并 await 请求；如必须使用同步库，放进 asyncio.to_thread 中执行。",
+]
+
+
+def load_session(path: Path) -> list[dict]:
+    """读取历史文件（与服务端加载历史使用同一套解析：JSONL 日志回放，兼容旧版整文件 JSON）。"""
+    history, _, _ = _parse_history_content(path.read_text(encoding="utf-8"), None)
+    return [entry for entry in history or [] if isinstance(entry, dict)]
+
+
+def build_sample_sessions() -> list[list[dict]]:
+    rng = random.Random(20240601)
+    sessions = []
+    for session_index in range(SAMPLE_SESSIONS):
+        history: list[dict] = []
+        for turn in range(SAMPLE_TURNS):
+            response = {
+                "analysis": rng.choice(SAMPLE_ANALYSES),
+                "guidance": rng.choice(SAMPLE_GUIDANCE),
+                "resolved": False,
+            }
+            if turn == 0 or rng.random() < 0.4:
+                history.append({
+                    "type": "consult",
+                    "problem_type": "runtime_error",
+                    "error_message": f"会话 {session_index}: 服务启动后请求全部超时",
+                    "response": response,
+                })
+            else:
+                history.append({
+                    "type": "progress",
+                    "actions_taken": f"第 {turn} 次按建议修改：" + rng.choice(SAMPLE_GUIDANCE),
+                    "result": rng.choice(["failed", "partial"]),
+                    "new_error": "TimeoutError: pool timeout" if rng.random() < 0.5 else None,
+                    "response": response,
+                })
+        sessions.append(history)
+    return sessions
+
+
+def build_prompt(entry: dict, history: list[dict], single_source: bool) -> str | None:
+    """按历史条目还原当时的 consult_aurai / report_progress 提示词；其他条目返回 None。"""
+    options = {
+        "conversation_history": history,
+        "history_turns": PROMPT_HISTORY_TURNS,
+        "history_references": single_source,
+    }
+    if entry.get("type") == "consult":
+        return build_consult_prompt(
+            problem_type=entry.get("problem_type", "other"),
+            error_message=entry.get("error_message", ""),
+            iteration=len(history),
+            **options,
+        )
+    if entry.get("type") == "progress":
+        return build_progress_prompt(
+            iteration=len(history),
+            actions_taken=entry.get("actions_taken", ""),
+            result=entry.get("result", ""),
+            new_error=entry.get("new_error"),
+            feedback=entry.get("feedback"),
+            **options,
+        )
+    return None
+
+
+def request_tokens(builder: HistoryMessageBuilder, history: list[dict], prompt: str) -> int:
+    """一次请求的输入 tokens（系统提示词 + 全部历史消息 + 当前问题，不做预算裁剪）。"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    groups = builder._build_message_groups_from_history(history)
+    for group in groups:
+        messages.extend(group["messages"])
+    messages.append(builder._render_history_references({"role": "user", "content": prompt}, groups))
+    return builder._estimate_messages_tokens(messages)
+
+
+def replay(session: list[dict], builder: HistoryMessageBuilder, single_source: bool) -> tuple[int, int]:
+    """逐轮重放会话，返回 (调用次数, 累计输入 tokens)。"""
+    calls = 0
+    total = 0
+    for index, entry in enumerate(session):
+        history = session[:index]
+        prompt = build_prompt(entry, history, single_source)
+        if prompt is None:
+            continue
+        calls += 1
+        total += request_tokens(builder, history, prompt)
+    return calls, total
+
+
+def main():
+    paths = [Path(arg) for arg in sys.argv[1:]]
+    sessions = [load_session(path) for path in paths] if paths else build_sample_sessions()
+    source = f"{len(paths)} 个历史文件" if paths else f"{len(sessions)} 个示例会话"
+
+    inline_builder = HistoryMessageBuilder(SimpleNamespace(
+        max_message_tokens=MAX_MESSAGE_TOKENS,
+        history_rendering="inline",
+    ))
+    single_builder = HistoryMessageBuilder(SimpleNamespace(
+        max_message_tokens=MAX_MESSAGE_TOKENS,
+        history_rendering="single",
+    ))
+
+    total_calls = 0
+    inline_total = 0
+    single_total = 0
+    for session in sessions:
+        calls, inline_tokens = replay(session, inline_builder, single_source=False)
+        _, single_tokens = replay(session, single_builder, single_source=True)
+        total_calls += calls
+        inline_total += inline_tokens
+        single_total += single_tokens
+
+    print(f"输入: {source}，共 {total_calls} 次调用")
+    print(f"inline: {inline_total:>12,} tokens")
+    print(f"single: {single_total:>12,} tokens")
+    if inline_total:
+        saved = inline_total - single_total
+        print(f"节省:   {saved:>12,} tokens ({saved / inline_total * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
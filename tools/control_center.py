@@ -331,6 +331,43 @@ class AuraiConfigTool:
 
         return history_files
 
+    def _read_history_file(self, history_file: Path):
+        """读取历史文件：支持 JSONL 日志（回放检查点与追加记录）和旧版整文件 JSON。"""
+        content = history_file.read_text(encoding="utf-8").strip()
+        if not content:
+            return []
+
+        try:
+            document = json.loads(content)
+        except json.JSONDecodeError:
+            document = None
+
+        if document is not None and not (isinstance(document, dict) and "op" in document):
+            return document
+
+        history = []
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(record, dict):
+                continue
+
+            op = record.get("op")
+            if op == "checkpoint":
+                history = list(record.get("entries") or [])
+            elif op == "append":
+                history.append(record.get("entry"))
+            elif op == "remove":
+                removed_ids = set(record.get("entry_ids") or [])
+                history = [
+                    entry for entry in history
+                    if not (isinstance(entry, dict) and entry.get("entry_id") in removed_ids)
+                ]
+
+        return history
+
     def _build_history_display_text(self, audit_entry: dict) -> str:
         """构建历史记录列表显示文本。"""
         session_name = audit_entry["session"]
@@ -414,8 +451,7 @@ class AuraiConfigTool:
                     sessions.append(session_name)
 
                 try:
-                    with open(history_file, "r", encoding="utf-8") as f:
-                        history = json.load(f)
+                    history = self._read_history_file(history_file)
                 except Exception as e:
                     self.audit_entries.append({
                         "session": session_name,